@@ -0,0 +1,268 @@
+#!/usr/bin/python3
+
+import argparse
+import array
+import configparser
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from mqtt_dispatch import Dispatcher
+from payload_codec import PayloadDecoder
+
+"""
+Columnar telemetry archive
+
+Every numeric field of the archived topics is appended to its own file, one directory per day and source:
+
+  <path>/2024-05-01/smartmeter/ts.f64          float64 time.time() per row
+  <path>/2024-05-01/smartmeter/power.f32       float32 per row, NaN if the field was missing
+  <path>/2024-05-01/smartmeter/columns.json    column names
+
+The files are plain little endian arrays without header, numpy.memmap / numpy.fromfile read them without copy
+(see load). Rows are buffered and written every flush_interval seconds (the sd card is not written per sample),
+at most one row per source and clock aligned interval slot is kept (a 1 Hz source jittering around its
+period keeps every sample at interval=1). After a crash the columns of a day are cut to the
+shortest one on the next start.
+
+[ARCHIVE]
+path=/var/lib/victron/archive
+sources=smartmeter:SMARTMETER,victron:VICTRON,bms1:BMS1,mppt:MPPT     name:config section with topic
+"""
+
+log = logging.getLogger(__name__)
+
+TS = 'ts.f64'
+
+
+DEFAULT_SOURCES = 'smartmeter:SMARTMETER,victron:VICTRON,bms1:BMS1,mppt:MPPT'
+
+
+def parse_sources(text):
+    """
+    'smartmeter:SMARTMETER,mppt:MPPT' -> [('smartmeter', 'SMARTMETER'), ('mppt', 'MPPT')]
+    """
+    return [tuple(item.strip().split(':', 1)) for item in (text or DEFAULT_SOURCES).split(',')]
+
+
+def column_file(name):
+    return ''.join(c if c.isalnum() or c in '_-' else '_' for c in name) + '.f32'
+
+
+class SourceDay:
+    """
+    Open column files of one source and day
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.columns = []
+        try:
+            with open(os.path.join(directory, 'columns.json')) as f:
+                self.columns = json.load(f)
+        except (OSError, ValueError):
+            pass
+        self.rows = self.repair()
+
+    def repair(self):
+        """
+        Cut all columns to the shortest (a crash during a flush)
+
+        :return: number of complete rows
+        """
+        sizes = {TS: self._size(TS) // 8}
+        sizes.update({name: self._size(column_file(name)) // 4 for name in self.columns})
+        rows = min(sizes.values())
+        for name, n in sizes.items():
+            if n != rows:
+                log.warning(f"{self.directory}: cut {name} from {n} to {rows} rows")
+                os.truncate(os.path.join(self.directory, name if name == TS else column_file(name)),
+                            rows * (8 if name == TS else 4))
+        return rows
+
+    def _size(self, name):
+        try:
+            return os.path.getsize(os.path.join(self.directory, name))
+        except OSError:
+            return 0
+
+    def append(self, rows):
+        """
+        :param rows: list of (ts, record)
+        """
+        new = []
+        for ts, record in rows:
+            for key in record:
+                if key not in self.columns and key not in new:
+                    new.append(key)
+        nan = float('nan')
+        for name in new:  # earlier rows of a new column are NaN
+            with open(os.path.join(self.directory, column_file(name)), 'ab') as f:
+                array.array('f', [nan] * self.rows).tofile(f)
+        if new:
+            self.columns += new
+            with open(os.path.join(self.directory, 'columns.json.tmp'), 'w') as f:
+                json.dump(self.columns, f)
+            os.replace(os.path.join(self.directory, 'columns.json.tmp'), os.path.join(self.directory, 'columns.json'))
+
+        for name in self.columns:
+            values = array.array('f', [_number(record.get(name), nan) for ts, record in rows])
+            with open(os.path.join(self.directory, column_file(name)), 'ab') as f:
+                values.tofile(f)
+        with open(os.path.join(self.directory, TS), 'ab') as f:  # last, a row is complete with its ts
+            array.array('d', [ts for ts, record in rows]).tofile(f)
+        self.rows += len(rows)
+
+
+def _number(value, default):
+    if isinstance(value, (int, float)):
+        return float(value)
+    return default
+
+
+class Archive:
+    def __init__(self, config, client=None, dispatcher=None):
+        """
+        :param config: ConfigParser with [ARCHIVE]
+        :param client: connected mqtt client (shared) or None to write with add() only
+        :param dispatcher: mqtt_dispatch.Dispatcher of the shared client, None = own one
+        """
+        cfg = config['ARCHIVE']
+        self.path = cfg.get('path', 'archive')
+        self.flush_interval = cfg.getfloat('flush_interval', fallback=300)
+        self.interval = cfg.getfloat('interval', fallback=1)
+        self.client = client
+        self.dispatcher = dispatcher or (Dispatcher(client) if client else None)
+        self.decoder = PayloadDecoder()
+        self.topics = {}  # topic -> source name
+        for name, section in parse_sources(cfg.get('sources')):
+            if config.has_option(section, 'topic'):
+                self.topics[config[section]['topic']] = name
+        self.lock = threading.Lock()  # buffer
+        self.flush_lock = threading.Lock()  # files
+        self.buffer = {}  # source -> [(ts, record)]
+        self.last_slot = {}  # source -> interval slot of the last row
+        self.days = {}  # (day, source) -> SourceDay
+        self.stopped = threading.Event()
+        self.rows = 0
+
+    def add(self, source, record, ts=None):
+        """
+        Buffer one record, numeric fields only
+        """
+        ts = time.time() if ts is None else ts
+        if self.interval:
+            slot = int(ts // self.interval)
+            if self.last_slot.get(source) == slot:
+                return False
+            self.last_slot[source] = slot
+        row = {key: value for key, value in record.items() if isinstance(value, (int, float))}
+        with self.lock:
+            self.buffer.setdefault(source, []).append((ts, row))
+        return True
+
+    def flush(self):
+        with self.flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self.lock:
+            buffer, self.buffer = self.buffer, {}
+        for source, rows in buffer.items():
+            by_day = {}
+            for row in rows:
+                by_day.setdefault(datetime.date.fromtimestamp(row[0]).isoformat(), []).append(row)
+            for day, day_rows in by_day.items():
+                key = (day, source)
+                if key not in self.days:
+                    self.days = {k: v for k, v in self.days.items() if k[0] >= day}  # forget older days
+                    self.days[key] = SourceDay(os.path.join(self.path, day, source))
+                try:
+                    self.days[key].append(day_rows)
+                    self.rows += len(day_rows)
+                except OSError as ex:
+                    log.error(f"archive {source} {day}: {ex}")
+        log.debug(f"archive flushed, {self.rows} rows")
+
+    def on_message(self, client, userdata, message):
+        try:
+            data = self.decoder.decode(message.topic, message.payload)
+            if isinstance(data, dict):
+                self.add(self.topics[message.topic], data)
+        except Exception as ex:
+            log.error(f"{message.topic}: {ex}")
+
+    def subscribe(self):
+        for topic in list(self.topics) + [topic + '/schema' for topic in self.topics]:
+            self.dispatcher.subscribe(topic, self.on_message)
+        log.info(f"archive {', '.join(self.topics)} to {self.path}")
+
+    def run(self):
+        if self.client:
+            self.subscribe()
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def close(self):
+        self.stopped.set()
+        if self.dispatcher:
+            self.dispatcher.remove(self.on_message)
+        self.flush()  # synchronous, the process may exit right after
+
+
+def load(path, day, source, columns=None, mode='r'):
+    """
+    Columns of one day as numpy memmaps (zero copy, the file is mapped), cut to complete rows
+
+    :param path: archive directory
+    :param day: 'YYYY-MM-DD' or datetime.date
+    :param columns: names, None = all
+    :return: {'ts': float64 array, name: float32 array, ...}
+    """
+    import numpy
+    directory = os.path.join(path, str(day), source)
+    with open(os.path.join(directory, 'columns.json')) as f:
+        names = json.load(f)
+    ts = numpy.memmap(os.path.join(directory, TS), dtype='<f8', mode=mode) \
+        if os.path.getsize(os.path.join(directory, TS)) else numpy.zeros(0)
+    rows = len(ts)
+    r = {'ts': ts}
+    for name in columns or names:
+        if name not in names:
+            raise KeyError(f"{source} {day}: no column {name}")
+        r[name] = numpy.memmap(os.path.join(directory, column_file(name)), dtype='<f4', mode=mode)[:rows] \
+            if rows else numpy.zeros(0, dtype='<f4')
+    return r
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="config.ini file", default="config.ini")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+
+    client = mqtt.Client("ARCHIVE")
+    if config['MQTT'].get('user'):
+        client.username_pw_set(config['MQTT']['user'], config['MQTT']['password'])
+    client.connect(config['MQTT']['host'], int(config['MQTT']['port']))
+    client.loop_start()
+
+    archive = Archive(config, client)
+    try:
+        archive.run()
+    except KeyboardInterrupt:
+        archive.close()
+
+
+if __name__ == '__main__':
+    main()
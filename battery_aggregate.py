@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+
+import argparse
+import configparser
+import json
+import logging
+import time
+
+import paho.mqtt.client as mqtt
+
+"""
+Combined view of all Seplos shelves of a battery
+
+Keeps the latest telemetry per shelf (topic, topic/2, topic/3, ... as published by seplos.py) and publishes one
+record on [BMS1] system_topic every system_interval seconds:
+
+  soc         capacity weighted, sum(soc * capacity_total) / sum(capacity_total)
+  cell_low    lowest cell of all shelves, cell_high highest cell
+  current     sum of all shelves, voltage mean (shelves are in parallel)
+  temp_max    worst (highest) temperature of all shelves, temp_min lowest
+  stale       shelves without telemetry for stale_after seconds, not part of the values above
+  time        time.time() of the oldest shelf value
+
+The record is retained, a restarted controller has a soc before the next interval.
+
+update_setpoint.py uses this record instead of the soc of shelf 1 if system_topic is configured.
+"""
+
+log = logging.getLogger(__name__)
+
+TEMPERATURE_KEYS = ('cellblock1_temp', 'cellblock2_temp', 'cellblock3_temp', 'cellblock4_temp',
+                    'environment_temp', 'power_temp')
+
+
+class ShelfState:
+    __slots__ = ('time', 'soc', 'capacity', 'residual', 'current', 'voltage', 'cell_low', 'cell_high',
+                 'temp_min', 'temp_max')
+
+    def __init__(self, data, t):
+        self.time = t
+        self.soc = data['soc']
+        self.capacity = data.get('capacity_total') or data.get('rated_capacity') or 0
+        self.residual = data.get('capacity_residual', 0)
+        self.current = data.get('current', 0)
+        self.voltage = data.get('voltage')
+        self.cell_low = data.get('cell_low')
+        self.cell_high = data.get('cell_high')
+        temps = [data[k] for k in TEMPERATURE_KEYS if data.get(k) is not None]
+        self.temp_min = min(temps) if temps else None
+        self.temp_max = max(temps) if temps else None
+
+
+class PackAggregator:
+    def __init__(self, shelves, stale_after=30):
+        """
+        :param shelves: expected shelf numbers, a shelf that never answered counts as stale
+        :param stale_after: seconds without telemetry until a shelf is left out
+        """
+        self.shelves = list(shelves)
+        self.stale_after = stale_after
+        self.state = {}  # shelf -> ShelfState
+        # running sums over the fresh shelves, changed per update instead of per result
+        self.fresh = set()
+        self.soc_capacity = 0.0
+        self.capacity = 0.0
+        self.residual = 0.0
+        self.current = 0.0
+
+    def _remove(self, shelf):
+        s = self.state[shelf]
+        self.fresh.discard(shelf)
+        self.soc_capacity -= s.soc * s.capacity
+        self.capacity -= s.capacity
+        self.residual -= s.residual
+        self.current -= s.current
+
+    def _add(self, shelf, s):
+        self.state[shelf] = s
+        self.fresh.add(shelf)
+        self.soc_capacity += s.soc * s.capacity
+        self.capacity += s.capacity
+        self.residual += s.residual
+        self.current += s.current
+
+    def update(self, shelf, data, t=None):
+        """
+        :param shelf: shelf number
+        :param data: telemetry dictionary of the shelf
+        """
+        if t is None:
+            t = time.monotonic()
+            if data.get('time'):  # retained telemetry of seplos.py may be old
+                t -= max(0, time.time() - data['time'])
+        if shelf in self.fresh:
+            self._remove(shelf)
+        self._add(shelf, ShelfState(data, t))
+
+    def expire(self, t):
+        for shelf in [s for s in self.fresh if t - self.state[s].time > self.stale_after]:
+            log.warning(f"shelf {shelf}: no telemetry for {self.stale_after}s")
+            self._remove(shelf)
+        if not self.fresh:  # no rounding residue of the running sums
+            self.soc_capacity = self.capacity = self.residual = self.current = 0.0
+
+    def result(self, t=None):
+        """
+        :return: combined dictionary, soc None if no shelf is fresh
+        """
+        t = time.monotonic() if t is None else t
+        self.expire(t)
+        fresh = [self.state[s] for s in sorted(self.fresh)]
+        r = {'soc': None,
+             'shelves': len(fresh),
+             'stale': [s for s in self.shelves if s not in self.fresh]}
+        if not fresh:
+            return r
+
+        if self.capacity > 0:
+            r['soc'] = round(self.soc_capacity / self.capacity, 1)
+        else:
+            r['soc'] = round(sum(s.soc for s in fresh) / len(fresh), 1)
+        r['capacity_residual'] = round(self.residual, 2)
+        r['capacity_total'] = round(self.capacity, 2)
+        r['current'] = round(self.current, 2)
+        voltages = [s.voltage for s in fresh if s.voltage is not None]
+        r['voltage'] = round(sum(voltages) / len(voltages), 2) if voltages else None
+        for key, func in (('cell_low', min), ('cell_high', max), ('temp_min', min), ('temp_max', max)):
+            values = [getattr(s, key) for s in fresh if getattr(s, key) is not None]
+            r[key] = func(values) if values else None
+        if r['cell_low'] is not None and r['cell_high'] is not None:
+            r['cell_diff'] = round(r['cell_high'] - r['cell_low'], 4)
+        r['age'] = round(t - min(s.time for s in fresh), 1)
+        r['time'] = round(time.time() - r['age'], 1)  # oldest shelf value, retained messages can be old
+        return r
+
+
+def shelf_topics(topic, shelves):
+    """
+    Telemetry topic per shelf as published by seplos.py: shelf 1 on topic, the others on topic/<shelf>
+    """
+    return {(topic if shelf == 1 else f"{topic}/{shelf}"): shelf for shelf in shelves}
+
+
+def on_message(client, aggregator, message):
+    try:
+        shelf = client.shelf_topics[message.topic]
+        aggregator.update(shelf, json.loads(message.payload))
+    except Exception as ex:
+        log.error(f"{message.topic}: {ex}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="config.ini file", default="config.ini")
+    parser.add_argument("--section", help="config section of the bms", default="BMS1")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    cfg = config[args.section]
+
+    shelves = [int(s) for s in cfg.get('shelves', '1,2,3').split(',')]
+    aggregator = PackAggregator(shelves, stale_after=cfg.getfloat('stale_after', fallback=30))
+    system_topic = cfg.get('system_topic', cfg['topic'] + '/system')
+    interval = cfg.getfloat('system_interval', fallback=1)
+
+    client = mqtt.Client(args.section + "_AGGREGATE")
+    client.shelf_topics = shelf_topics(cfg['topic'], shelves)
+    client.user_data_set(aggregator)
+    client.on_message = on_message
+    if config['MQTT'].get('user'):
+        client.username_pw_set(config['MQTT']['user'], config['MQTT']['password'])
+    client.connect(config['MQTT']['host'], int(config['MQTT']['port']))
+    for topic in client.shelf_topics:
+        client.subscribe(topic)
+    client.loop_start()
+
+    log.info(f"publish {', '.join(client.shelf_topics)} every {interval}s to {system_topic}")
+    next_time = time.monotonic()
+    while True:
+        next_time += interval
+        time.sleep(max(0, next_time - time.monotonic()))
+        client.publish(system_topic, json.dumps(aggregator.result()), retain=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+import json
+import logging
+import threading
+import time
+
+"""
+Cell voltage history of all Seplos shelves in fixed numpy ring buffers
+
+volts    float32 [shelves, cells, samples]  V
+current  float32 [shelves, samples]         A, positive = charge
+time     float64 [shelves, samples]         time.time()
+
+Memory is allocated once (shelves * samples * (cells + 3) * 4 bytes, 3 shelves, 16 cells, 3 days at 10 s
+about 6 MB) and does not grow. At most one sample per shelf and interval is kept.
+
+Queries (vectorized over cells and samples, window in seconds back from now, default all):
+
+  drift        per cell mean deviation from the pack mean [mV] and its trend [mV/day]
+  imbalance    cell spread (max - min) [mV] per bucket, mean and max, and its trend [mV/day]
+  resistance   internal resistance per cell [mOhm] from current steps >= min_step A between two samples,
+               median over all steps (a short interval gives better estimates)
+  percentiles  per cell voltage percentiles [V] and of the spread [mV]
+
+seplos.py fills the history and answers queries sent as json to [BMS1] history_cmd_topic, e.g.
+{"query": "drift", "shelf": 2, "window": 86400}, on history_topic.
+numpy is imported only if the history is enabled.
+"""
+
+log = logging.getLogger(__name__)
+
+
+class CellHistory:
+    def __init__(self, shelves, cells=16, samples=25920, interval=10):
+        """
+        :param shelves: shelf numbers
+        :param cells: maximum cells per shelf
+        :param samples: ring buffer length per shelf
+        :param interval: minimum seconds between two samples of a shelf
+        """
+        import numpy
+        self.index = {shelf: i for i, shelf in enumerate(shelves)}
+        self.cells = cells
+        self.samples = samples
+        self.interval = interval
+        n = len(self.index)
+        self.volts = numpy.full((n, cells, samples), numpy.nan, numpy.float32)
+        self.current = numpy.full((n, samples), numpy.nan, numpy.float32)
+        self.time = numpy.full((n, samples), numpy.nan, numpy.float64)
+        self.pos = [0] * n  # next write position
+        self.count = [0] * n
+        self.ncells = [0] * n  # cells reported by the shelf
+        self.last_time = [0.0] * n
+        self.lock = threading.Lock()
+        self.queries = {'drift': self.drift,
+                        'imbalance': self.imbalance,
+                        'resistance': self.resistance,
+                        'percentiles': self.percentiles}
+
+    def add(self, shelf, cells, current, t=None):
+        """
+        :param cells: cell voltages [V]
+        :return: True if the sample was stored
+        """
+        t = time.time() if t is None else t
+        i = self.index[shelf]
+        if t - self.last_time[i] < self.interval:
+            return False
+        n = min(len(cells), self.cells)
+        with self.lock:
+            p = self.pos[i]
+            self.volts[i, :n, p] = cells[:n]
+            self.current[i, p] = current
+            self.time[i, p] = t
+            self.pos[i] = (p + 1) % self.samples
+            self.count[i] = min(self.count[i] + 1, self.samples)
+            self.ncells[i] = n
+            self.last_time[i] = t
+        return True
+
+    def window(self, shelf, window=None, now=None):
+        """
+        Samples of a shelf in chronological order (copies)
+
+        :return: (time [samples], volts [cells, samples], current [samples])
+        """
+        import numpy
+        i = self.index[shelf]
+        with self.lock:
+            count, pos, n = self.count[i], self.pos[i], self.ncells[i]
+            if count < self.samples:
+                order = numpy.arange(count)
+            else:
+                order = numpy.r_[pos:self.samples, 0:pos]
+            t = self.time[i, order]
+            v = self.volts[i, :n][:, order]
+            c = self.current[i, order]
+        if window:
+            now = time.time() if now is None else now
+            keep = t >= now - window
+            t, v, c = t[keep], v[:, keep], c[keep]
+        return t, v, c
+
+    def _slope_per_day(self, t, y):
+        """
+        Least squares slope of y [..., samples] over t, per day
+        """
+        t0 = t - t.mean()
+        denominator = (t0 * t0).sum()
+        if denominator == 0:
+            import numpy
+            return numpy.zeros(y.shape[:-1])
+        return ((y - y.mean(axis=-1, keepdims=True)) * t0).sum(axis=-1) / denominator * 86400
+
+    def drift(self, shelf, window=None, **kwargs):
+        t, v, c = self.window(shelf, window)
+        if t.size < 2:
+            return {'samples': int(t.size)}
+        deviation = (v - v.mean(axis=0)) * 1000
+        return {'samples': int(t.size),
+                'deviation': _round(deviation.mean(axis=1), 1),
+                'trend': _round(self._slope_per_day(t, deviation), 2)}
+
+    def imbalance(self, shelf, window=None, bucket=3600, **kwargs):
+        import numpy
+        t, v, c = self.window(shelf, window)
+        if t.size < 2:
+            return {'samples': int(t.size)}
+        spread = (v.max(axis=0) - v.min(axis=0)) * 1000
+        bins = ((t - t[0]) // bucket).astype(numpy.int64)
+        n = numpy.bincount(bins)
+        mean = numpy.bincount(bins, weights=spread) / numpy.maximum(n, 1)
+        high = numpy.full(n.size, -numpy.inf)
+        numpy.maximum.at(high, bins, spread)
+        used = n > 0
+        return {'samples': int(t.size),
+                'bucket': bucket,
+                'time': _round((t[0] + numpy.arange(n.size) * bucket)[used], 0),
+                'mean': _round(mean[used], 1),
+                'max': _round(high[used], 1),
+                'trend': round(float(self._slope_per_day(t, spread)), 2)}
+
+    def resistance(self, shelf, window=None, min_step=5, max_gap=None, **kwargs):
+        import numpy
+        t, v, c = self.window(shelf, window)
+        max_gap = max_gap or 3 * self.interval
+        d_current = numpy.diff(c)
+        steps = (numpy.abs(d_current) >= min_step) & (numpy.diff(t) <= max_gap)
+        if not steps.any():
+            return {'steps': 0}
+        r = numpy.diff(v, axis=1)[:, steps] / d_current[steps] * 1000
+        return {'steps': int(steps.sum()),
+                'resistance': _round(numpy.median(r, axis=1), 2)}
+
+    def percentiles(self, shelf, window=None, q=(5, 50, 95), **kwargs):
+        import numpy
+        t, v, c = self.window(shelf, window)
+        if t.size == 0:
+            return {'samples': 0}
+        spread = (v.max(axis=0) - v.min(axis=0)) * 1000
+        return {'samples': int(t.size),
+                'q': list(q),
+                'cells': _round(numpy.percentile(v, q, axis=1), 4),
+                'spread': _round(numpy.percentile(spread, q), 1)}
+
+    def query(self, request):
+        """
+        :param request: dictionary with query, shelf and the parameters of the query
+        :return: result dictionary
+        """
+        request = dict(request)
+        name = request.pop('query', None)
+        func = self.queries.get(name)
+        if func is None:
+            return {'error': f"unknown query {name}, use one of {', '.join(self.queries)}"}
+        shelf = int(request.pop('shelf', next(iter(self.index))))
+        if shelf not in self.index:
+            return {'error': f"unknown shelf {shelf}"}
+        r = func(shelf, **request)
+        r['query'] = name
+        r['shelf'] = shelf
+        return r
+
+    def on_query(self, client, topic, payload):
+        """
+        Answer a json query on topic
+        """
+        try:
+            result = self.query(json.loads(payload))
+        except Exception as ex:
+            log.error(f"history query {payload}: {ex}", exc_info=True)
+            result = {'error': str(ex)}
+        client.publish(topic, json.dumps(result))
+
+
+def _round(array, digits):
+    return array.astype('float64').round(digits).tolist()  # float32 would keep digits like 0.699999988
@@ -0,0 +1,105 @@
+import json
+import logging
+import time
+
+"""
+Lazy debug tracing for the serial hot paths
+
+Call sites check one attribute before they build anything:
+
+    if self.trace.enabled:
+        self.trace.emit('tx', cmd=cmd, frame=frame)
+
+enabled is False unless the logger is at DEBUG or a sink is set, so a disabled trace costs one attribute lookup
+per frame. The fields are kept as they are (bytes, dictionaries) and only formatted by the handler / sink
+that writes them, frames as hex. Per byte / per frame noise is emitted with sample=True, only every
+sample_every-th record of such an event passes.
+
+The sink is switched at runtime, e.g. with {"cmd": "trace", "enable": true, "sample_every": 10} on the VICTRON
+cmd_topic: the records go as json to a topic (MqttSink) instead of the log.
+"""
+
+log = logging.getLogger(__name__)
+
+
+def _value(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex(' ').upper()
+    return value
+
+
+class _Fields:
+    """
+    Formatted by logging only if a handler writes the record
+    """
+    __slots__ = ('fields',)
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join(f"{key}={_value(value)}" for key, value in self.fields.items())
+
+
+class DebugTrace:
+    def __init__(self, logger, sample_every=100):
+        """
+        :param logger: log records go to logger.debug
+        :param sample_every: every n-th record of a sampled event passes
+        """
+        self.logger = logger
+        self.sample_every = sample_every
+        self.sink = None
+        self.counts = {}  # event -> records of sampled events
+        self.enabled = False
+        self.refresh()
+
+    def refresh(self):
+        """
+        Recompute enabled, call after the log level was changed
+        """
+        self.enabled = self.sink is not None or self.logger.isEnabledFor(logging.DEBUG)
+
+    def set_sink(self, sink, sample_every=None):
+        """
+        :param sink: function(record dictionary) or None
+        """
+        self.sink = sink
+        if sample_every:
+            self.sample_every = sample_every
+        self.refresh()
+        log.warning(f"{self.logger.name} trace {'to ' + repr(sink) if sink else 'off'}, sample every {self.sample_every}")
+
+    def emit(self, event, sample=False, **fields):
+        """
+        Only called if enabled
+
+        :param event: short name (tx, rx, ac_info, ...)
+        :param sample: noisy event, only every sample_every-th record passes
+        """
+        if sample:
+            n = self.counts[event] = self.counts.get(event, 0) + 1
+            if n % self.sample_every != 1 and self.sample_every > 1:
+                return
+            fields['count'] = n
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("%s %s", event, _Fields(fields))
+        sink = self.sink
+        if sink:
+            try:
+                sink(dict(t=time.time(), event=event, **{key: _value(value) for key, value in fields.items()}))
+            except Exception as ex:
+                log.warning(f"trace sink failed, off: {ex}")
+                self.set_sink(None)
+
+
+class MqttSink:
+    def __init__(self, client, topic):
+        self.client = client
+        self.topic = topic
+
+    def __call__(self, record):
+        self.client.publish(self.topic, json.dumps(record, default=str))
+
+    def __repr__(self):
+        return self.topic
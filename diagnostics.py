@@ -0,0 +1,202 @@
+import collections
+import cProfile
+import datetime
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+
+"""
+Profiling and memory tracing of the running controller, started with commands on the VICTRON cmd_topic
+
+{"cmd": "profile", "seconds": 30}                      cProfile of the control loop thread. It is started and
+                                                       stopped by the control tick itself (tick()), the stop time
+                                                       is checked once per tick.
+{"cmd": "profile", "seconds": 30, "mode": "sampling"}  all threads sampled every interval s (default 0.01) from a
+                                                       thread, stacks written in collapsed format (flamegraph.pl)
+{"cmd": "tracemalloc", "action": "start", "frames": 10}
+{"cmd": "tracemalloc", "action": "snapshot"}           snapshot to file, top allocations or the diff to the last
+{"cmd": "tracemalloc", "action": "stop"}               snapshot
+{"cmd": "stacks"}                                      stacks of all threads
+
+The results are written to <path>/<kind>-<time>-<ms>.<ext>, a summary (file, top entries) is published on the
+diagnostics topic or logged. Nothing runs while no command is active, the control tick checks one attribute.
+"""
+
+log = logging.getLogger(__name__)
+
+COMMANDS = ('profile', 'tracemalloc', 'stacks')
+TOP = 15
+
+
+def _where(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+class Diagnostics:
+    def __init__(self, client=None, topic=None, path='diagnostics'):
+        """
+        :param client: mqtt client for the summaries, None = log only
+        :param topic: diagnostics topic
+        :param path: directory for the result files
+        """
+        self.client = client
+        self.topic = topic
+        self.path = path
+        self.active = False  # a cProfile waits for or runs in the control loop, tick() has to be called
+        self.profile_seconds = 0
+        self.profiler = None
+        self.profile_end = None
+        self.sampling = False
+        self.snapshot = None  # last tracemalloc snapshot
+
+    def command(self, data):
+        """
+        :param data: command dictionary, see module doc
+        """
+        cmd = data.get('cmd')
+        if cmd == 'profile':
+            seconds = float(data.get('seconds', 30))
+            if data.get('mode') == 'sampling':
+                self.start_sampling(seconds, float(data.get('interval', 0.01)))
+            elif self.active:
+                log.warning("profile already running")
+            else:
+                self.profile_seconds = seconds
+                self.active = True  # the next control tick starts the profiler in its thread
+        elif cmd == 'tracemalloc':
+            action = data.get('action', 'snapshot')
+            if action == 'start':
+                tracemalloc.start(int(data.get('frames', 10)))
+                self.snapshot = None
+                self.publish({'diag': 'tracemalloc', 'action': 'start'})
+            elif action == 'stop':
+                tracemalloc.stop()
+                self.snapshot = None
+                self.publish({'diag': 'tracemalloc', 'action': 'stop'})
+            else:
+                threading.Thread(target=self.take_snapshot, name='diag-tracemalloc', daemon=True).start()
+        elif cmd == 'stacks':
+            self.dump_stacks()
+        else:
+            log.warning(f"unknown diagnostics cmd {cmd}")
+
+    def file_name(self, kind, ext):
+        os.makedirs(self.path, exist_ok=True)
+        now = datetime.datetime.now()
+        return os.path.join(self.path, f"{kind}-{now:%Y%m%d-%H%M%S}-{now.microsecond // 1000:03d}.{ext}")
+
+    def publish(self, doc):
+        if self.client and self.topic:
+            self.client.publish(self.topic, json.dumps(doc))
+        else:
+            log.info(json.dumps(doc))
+
+    def tick(self):
+        """
+        Control thread, once per tick while active: start cProfile here (it profiles the calling thread) and
+        stop it after profile_seconds
+        """
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profile_end = time.monotonic() + self.profile_seconds
+            log.warning(f"cProfile of thread {threading.current_thread().name} for {self.profile_seconds}s")
+            self.profiler.enable()
+        elif time.monotonic() > self.profile_end:
+            self.profiler.disable()
+            profiler, self.profiler = self.profiler, None
+            self.active = False
+            threading.Thread(target=self.write_profile, args=(profiler,), name='diag-profile', daemon=True).start()
+
+    def write_profile(self, profiler):
+        try:
+            name = self.file_name('profile', 'pstats')
+            profiler.dump_stats(name)
+            stats = pstats.Stats(profiler).stats  # (file, line, function) -> (cc, calls, tottime, cumtime, callers)
+            top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP]
+            self.publish({'diag': 'profile', 'file': name, 'seconds': self.profile_seconds,
+                          'top': [[f"{func} ({os.path.basename(file)}:{line})", calls, round(tt, 4), round(ct, 4)]
+                                  for (file, line, func), (cc, calls, tt, ct, callers) in top]})
+        except Exception as ex:
+            log.error(f"profile: {ex}", exc_info=True)
+
+    def start_sampling(self, seconds, interval):
+        if self.sampling:
+            log.warning("sampling profile already running")
+            return
+        self.sampling = True
+        threading.Thread(target=self.sample, args=(seconds, interval), name='diag-sampling', daemon=True).start()
+
+    def sample(self, seconds, interval):
+        """
+        Count the stacks of all other threads every interval seconds
+        """
+        try:
+            own = threading.get_ident()
+            stacks = collections.Counter()  # 'thread;outer;...;inner' -> samples
+            leaves = collections.Counter()
+            samples = 0
+            end = time.monotonic() + seconds
+            while time.monotonic() < end:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    leaves[_where(frame)] += 1
+                    stack = []
+                    while frame is not None:
+                        stack.append(frame.f_code.co_name)
+                        frame = frame.f_back
+                    stacks[';'.join([names.get(ident, str(ident))] + stack[::-1])] += 1
+                samples += 1
+                time.sleep(interval)
+
+            name = self.file_name('sampling', 'folded')
+            with open(name, 'w') as f:
+                for stack, n in stacks.most_common():
+                    f.write(f"{stack} {n}\n")
+            self.publish({'diag': 'sampling', 'file': name, 'seconds': seconds, 'samples': samples,
+                          'top': [[where, n, round(100 * n / samples, 1)] for where, n in leaves.most_common(TOP)]})
+        except Exception as ex:
+            log.error(f"sampling profile: {ex}", exc_info=True)
+        finally:
+            self.sampling = False
+
+    def take_snapshot(self):
+        try:
+            if not tracemalloc.is_tracing():
+                log.warning("tracemalloc not started, use {\"cmd\": \"tracemalloc\", \"action\": \"start\"}")
+                return
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")))
+            name = self.file_name('tracemalloc', 'snapshot')
+            snapshot.dump(name)
+            if self.snapshot is not None:
+                top = [str(stat) for stat in snapshot.compare_to(self.snapshot, 'lineno')[:TOP]]
+            else:
+                top = [str(stat) for stat in snapshot.statistics('lineno')[:TOP]]
+            current, peak = tracemalloc.get_traced_memory()
+            self.publish({'diag': 'tracemalloc', 'file': name, 'diff': self.snapshot is not None,
+                          'current': current, 'peak': peak, 'top': top})
+            self.snapshot = snapshot
+        except Exception as ex:
+            log.error(f"tracemalloc: {ex}", exc_info=True)
+
+    def dump_stacks(self):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        frames = sys._current_frames()
+        name = self.file_name('stacks', 'txt')
+        with open(name, 'w') as f:
+            for ident, frame in frames.items():
+                f.write(f"--- {names.get(ident, ident)} ({ident})\n")
+                f.write(''.join(traceback.format_stack(frame)))
+                f.write('\n')
+        self.publish({'diag': 'stacks', 'file': name,
+                      'threads': {str(names.get(ident, ident)): _where(frame) for ident, frame in frames.items()}})
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+
+import argparse
+import configparser
+import json
+import logging
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from mqtt_dispatch import Dispatcher
+from payload_codec import PayloadDecoder
+
+"""
+Display pages from the telemetry topics, rate limited
+
+The display shows one page per source ({"title", "color", "main": {...}, "stand...": {...}}). Instead of every
+process publishing a page per sample, this component subscribes the telemetry topics, renders the pages and
+publishes a page only if its rendered content changed, at most max_rate pages per second (the latest content
+of a page wins while it waits).
+
+Other scripts can send complete pages to <topic>/page/<name>, they are rate limited the same way.
+
+[DISPLAY]
+topic=display
+max_rate=2
+"""
+
+log = logging.getLogger(__name__)
+
+
+def smartmeter_page(data):
+    return {"title": "Smartmeter",
+            "color": 24555,
+            "main": {"unit": "W",
+                     "PwrSM": data["power"]
+                     },
+            "stand": {"unit": "KWh",
+                      "In": "{:.1f}".format(data["total_in"]),
+                      "Out": "{:.1f}".format(data["total_out"])
+                      }
+            }
+
+
+def one_decimal(value):
+    """
+    '12.3', '-' for a missing value (binary payloads and partial records decode missing fields as None)
+    """
+    return '-' if value is None else f"{value:.1f}"
+
+
+def victron_page(data):
+    return {"title": "Victron",
+            "color": 22142,
+            "main": {"unit": "%",
+                     "Bat": data.get("soc")
+                     },
+            "stand0": {"unit": "",
+                       "State": f"{data.get('state')}/{data.get('device_state_id')}",
+                       },
+            "stand1": {"unit": "W",
+                       "Bat": one_decimal(data.get("bat_p")),
+                       },
+            "stand2": {"unit": "A",
+                       "Bat": one_decimal(data.get("bat_i")),
+                       }
+            }
+
+
+# config section -> page renderer for the records on its topic
+PAGES = {'SMARTMETER': smartmeter_page,
+         'VICTRON': victron_page}
+
+
+class DisplayPublisher:
+    def __init__(self, client, topic='display', max_rate=2):
+        """
+        :param client: connected mqtt client
+        :param topic: display topic
+        :param max_rate: pages per second
+        """
+        self.client = client
+        self.topic = topic
+        self.min_interval = 1 / max_rate
+        self.published = {}  # page name -> payload
+        self.pending = {}  # page name -> payload waiting for a slot
+        self.next_time = 0
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.skipped = 0  # unchanged pages
+
+    def update(self, name, page):
+        payload = json.dumps(page)
+        with self.condition:
+            if self.published.get(name) == payload:
+                self.pending.pop(name, None)
+                self.skipped += 1
+                return
+            self.pending[name] = payload
+            self.condition.notify()
+
+    def run(self):
+        """
+        Publish pending pages, one per slot, oldest change first
+        """
+        with self.condition:
+            while not self.stopped:
+                wait = self.next_time - time.monotonic()
+                if not self.pending or wait > 0:
+                    self.condition.wait(timeout=wait if self.pending else None)
+                    continue
+                name = next(iter(self.pending))
+                payload = self.pending.pop(name)
+                self.published[name] = payload
+                self.next_time = time.monotonic() + self.min_interval
+                self.client.publish(self.topic, payload)
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+
+class Display:
+    def __init__(self, config, client, dispatcher=None):
+        """
+        :param config: ConfigParser, [DISPLAY] and the sections in PAGES
+        :param client: connected mqtt client (shared)
+        :param dispatcher: mqtt_dispatch.Dispatcher of the shared client, None = own one
+        """
+        cfg = config['DISPLAY'] if config.has_section('DISPLAY') else {}
+        self.client = client
+        self.dispatcher = dispatcher or Dispatcher(client)
+        self.topic = cfg.get('topic', 'display')
+        self.publisher = DisplayPublisher(client, self.topic, float(cfg.get('max_rate', 2)))
+        self.decoder = PayloadDecoder()
+        self.renderers = {config[section]['topic']: (section, render)
+                          for section, render in PAGES.items() if config.has_option(section, 'topic')}
+
+    def on_message(self, client, userdata, message):
+        try:
+            if message.topic.startswith(self.topic + '/page/'):
+                self.publisher.update(message.topic[len(self.topic) + 6:], json.loads(message.payload))
+                return
+            data = self.decoder.decode(message.topic, message.payload)
+            if data is None:
+                return
+            name, render = self.renderers[message.topic]
+            self.publisher.update(name, render(data))
+        except Exception as ex:
+            log.error(f"{message.topic}: {ex}")
+
+    def subscribe(self):
+        for topic in list(self.renderers) + [topic + '/schema' for topic in self.renderers] + [self.topic + '/page/+']:
+            self.dispatcher.subscribe(topic, self.on_message)
+
+    def run(self):
+        self.subscribe()
+        self.publisher.run()
+
+    def close(self):
+        self.dispatcher.remove(self.on_message)
+        self.publisher.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="config.ini file", default="config.ini")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+
+    client = mqtt.Client("DISPLAY")
+    if config['MQTT'].get('user'):
+        client.username_pw_set(config['MQTT']['user'], config['MQTT']['password'])
+    client.connect(config['MQTT']['host'], int(config['MQTT']['port']))
+    client.loop_start()
+
+    Display(config, client).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+#!/usr/bin/python3
+
+import argparse
+import configparser
+import datetime
+import json
+import logging
+
+import archive
+
+"""
+Energy accounting over the telemetry archive (archive.py)
+
+Power series are integrated per day with the trapezoid rule, positive and negative parts separately. A missing
+value (NaN, the row was written for other fields) holds the last value of the column for up to max_gap seconds,
+longer gaps (process down, ...) are not bridged. Everything is vectorized with numpy over memmapped
+columns, a month of 1 Hz data takes a fraction of a second.
+
+  grid_import / grid_export        smartmeter power (+ = import), *_meter from the total_in / total_out counters
+  pv                               MPPT PPV (all MPPT sources)
+  ac_charge / ac_discharge         MultiPlus inv_p (+ = AC into the MultiPlus)
+  mp2_dc_charge / mp2_dc_discharge MultiPlus bat_p (+ = into the battery)
+  charge_efficiency                mp2_dc_charge / ac_charge, inverter_efficiency ac_discharge / mp2_dc_discharge
+  battery_in / battery_out         BMS voltage * current, battery_round_trip out / in
+  cycles                           battery_out / capacity_kwh (config or BMS capacity_total * voltage)
+  consumption                      grid_import - grid_export + ac_discharge - ac_charge (house load)
+  self_sufficiency                 1 - grid_import / consumption, self_consumption 1 - grid_export / pv
+
+Energies in kWh.
+
+  python energy_report.py --from 2024-05-01 --to 2024-05-31 [--publish]
+"""
+
+log = logging.getLogger(__name__)
+
+ENERGIES = ('grid_import', 'grid_export', 'grid_import_meter', 'grid_export_meter', 'pv', 'ac_charge',
+            'ac_discharge', 'mp2_dc_charge', 'mp2_dc_discharge', 'battery_in', 'battery_out')
+
+
+def integrate(ts, power, max_gap=60):
+    """
+    :param ts: seconds
+    :param power: W, NaN = missing, the last value is held for up to max_gap seconds
+    :return: (kWh of the positive part, kWh of the negative part as positive number)
+    """
+    import numpy
+    if len(ts) < 2:
+        return 0.0, 0.0
+    ts = numpy.asarray(ts, dtype=numpy.float64)
+    dt = numpy.diff(ts)
+    p = numpy.asarray(power, dtype=numpy.float64)
+    last = numpy.where(~numpy.isnan(p), numpy.arange(len(p)), 0)  # index of the last valid value
+    numpy.maximum.accumulate(last, out=last)
+    p = numpy.where(ts - ts[last] <= max_gap, p[last], numpy.nan)  # sample and hold
+    mid = (p[1:] + p[:-1]) * 0.5
+    valid = (dt > 0) & (dt <= max_gap) & ~numpy.isnan(mid)
+    energy = numpy.where(valid, mid * dt, 0.0)
+    positive = float(energy[energy > 0].sum()) / 3.6e6
+    negative = float(-energy[energy < 0].sum()) / 3.6e6
+    return positive, negative
+
+
+def ratio(a, b):
+    return round(a / b, 3) if a is not None and b else None
+
+
+class EnergyReport:
+    def __init__(self, path, sources, capacity_kwh=None, max_gap=60):
+        """
+        :param path: archive directory
+        :param sources: [(archive source name, config section), ...] as in [ARCHIVE] sources
+        :param capacity_kwh: battery capacity for cycles, None = from the BMS record
+        :param max_gap: seconds, longer gaps are not integrated
+        """
+        self.path = path
+        self.capacity_kwh = capacity_kwh
+        self.max_gap = max_gap
+        self.smartmeter = [name for name, section in sources if section == 'SMARTMETER']
+        self.victron = [name for name, section in sources if section == 'VICTRON']
+        self.mppt = [name for name, section in sources if section.startswith('MPPT')]
+        self.bms = [name for name, section in sources if section.startswith('BMS')]
+
+    def _load(self, day, source, columns):
+        try:
+            return archive.load(self.path, day, source, columns)
+        except (OSError, KeyError):
+            return None
+
+    def _split(self, day, sources, column):
+        """
+        :return: (positive, negative) summed over sources, None if no source has the column
+        """
+        r = None
+        for source in sources:
+            data = self._load(day, source, [column])
+            if data is not None:
+                pos, neg = integrate(data['ts'], data[column], self.max_gap)
+                r = (r[0] + pos, r[1] + neg) if r else (pos, neg)
+        return r
+
+    def _counter(self, day, source, column):
+        import numpy
+        data = self._load(day, source, [column])
+        if data is None or not len(data[column]) or numpy.isnan(data[column]).all():
+            return None
+        return float(numpy.nanmax(data[column]) - numpy.nanmin(data[column]))
+
+    def _battery(self, day):
+        import numpy
+        r = dict.fromkeys(('battery_in', 'battery_out', 'capacity_kwh'))
+        for source in self.bms:
+            data = self._load(day, source, ['voltage', 'current'])
+            if data is None:
+                continue
+            power = data['voltage'].astype(numpy.float64) * data['current']
+            battery_in, battery_out = integrate(data['ts'], power, self.max_gap)
+            r['battery_in'] = (r['battery_in'] or 0) + battery_in
+            r['battery_out'] = (r['battery_out'] or 0) + battery_out
+            capacity = self._load(day, source, ['capacity_total'])
+            if capacity is not None and len(capacity['capacity_total']):
+                r['capacity_kwh'] = (r['capacity_kwh'] or 0) + \
+                    float(numpy.nanmedian(capacity['capacity_total']) * numpy.nanmedian(data['voltage'])) / 1000
+        return r
+
+    def day(self, day):
+        """
+        :param day: datetime.date or 'YYYY-MM-DD'
+        :return: dictionary, values None if the data is missing
+        """
+        r = {'day': str(day)}
+        for key, sources, column in (('grid', self.smartmeter, 'power'),
+                                     ('ac', self.victron, 'inv_p'),
+                                     ('mp2_dc', self.victron, 'bat_p')):
+            split = self._split(day, sources, column)
+            positive, negative = ('import', 'export') if key == 'grid' else ('charge', 'discharge')
+            r[f'{key}_{positive}'], r[f'{key}_{negative}'] = split if split else (None, None)
+        pv = self._split(day, self.mppt, 'PPV')
+        r['pv'] = pv[0] if pv else None
+        for name in self.smartmeter[:1]:
+            r['grid_import_meter'] = self._counter(day, name, 'total_in')
+            r['grid_export_meter'] = self._counter(day, name, 'total_out')
+        battery = self._battery(day)
+        r['battery_in'] = battery['battery_in']
+        r['battery_out'] = battery['battery_out']
+        r['capacity_kwh'] = self.capacity_kwh or battery['capacity_kwh']
+        return self.derive(r)
+
+    def derive(self, r):
+        r['charge_efficiency'] = ratio(r.get('mp2_dc_charge'), r.get('ac_charge'))
+        r['inverter_efficiency'] = ratio(r.get('ac_discharge'), r.get('mp2_dc_discharge'))
+        r['battery_round_trip'] = ratio(r.get('battery_out'), r.get('battery_in'))
+        r['cycles'] = ratio(r.get('battery_out'), r.get('capacity_kwh'))
+        if r.get('grid_import') is not None and r.get('ac_charge') is not None:
+            r['consumption'] = r['grid_import'] - r['grid_export'] + r['ac_discharge'] - r['ac_charge']
+        else:
+            r['consumption'] = None
+        r['self_sufficiency'] = round(1 - r['grid_import'] / r['consumption'], 3) if r['consumption'] else None
+        r['self_consumption'] = round(1 - r['grid_export'] / r['pv'], 3) if r.get('pv') and r.get('grid_export') is not None else None
+        for key in ENERGIES + ('consumption', 'capacity_kwh'):
+            if r.get(key) is not None:
+                r[key] = round(r[key], 3)
+        return r
+
+    def range(self, start, end):
+        """
+        :return: {'days': [per day], 'total': sums, efficiencies of the sums}
+        """
+        days = []
+        day = start
+        while day <= end:
+            days.append(self.day(day))
+            day += datetime.timedelta(days=1)
+        total = {'day': f"{start}..{end}"}
+        for key in ENERGIES:
+            values = [d[key] for d in days if d.get(key) is not None]
+            total[key] = sum(values) if values else None
+        capacities = [d['capacity_kwh'] for d in days if d.get('capacity_kwh')]
+        total['capacity_kwh'] = capacities[-1] if capacities else None
+        return {'days': days, 'total': self.derive(total)}
+
+
+def parse_day(text):
+    return datetime.date.fromisoformat(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='energy report from the telemetry archive')
+    parser.add_argument("--config", help="config.ini file", default="config.ini")
+    parser.add_argument("--from", dest='start', help="first day YYYY-MM-DD (default today)", type=parse_day,
+                        default=datetime.date.today())
+    parser.add_argument("--to", dest='end', help="last day YYYY-MM-DD (default --from)", type=parse_day)
+    parser.add_argument("--json", help="print json", action="store_true")
+    parser.add_argument("--publish", help="publish the summary on [REPORT] topic", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    cfg = config['REPORT'] if config.has_section('REPORT') else {}
+
+    report = EnergyReport(config['ARCHIVE'].get('path', 'archive'),
+                          archive.parse_sources(config['ARCHIVE'].get('sources')),
+                          capacity_kwh=float(cfg['capacity_kwh']) if cfg.get('capacity_kwh') else None,
+                          max_gap=float(cfg.get('max_gap', 60)))
+    result = report.range(args.start, args.end or args.start)
+
+    if args.json:
+        print(json.dumps(result, indent=1))
+    else:
+        columns = result['days'] + ([result['total']] if len(result['days']) > 1 else [])
+        print(f"{'':24}" + ''.join(f"{d['day']:>12}" for d in columns))
+        for key in result['total']:
+            if key != 'day':
+                print(f"{key:24}" + ''.join(f"{d[key]:>12}" if d.get(key) is not None else f"{'-':>12}" for d in columns))
+
+    if args.publish:
+        import paho.mqtt.client as mqtt
+        client = mqtt.Client("ENERGY_REPORT")
+        if config['MQTT'].get('user'):
+            client.username_pw_set(config['MQTT']['user'], config['MQTT']['password'])
+        client.connect(config['MQTT']['host'], int(config['MQTT']['port']))
+        client.loop_start()
+        info = client.publish(cfg.get('topic', 'tele/energy/report'), json.dumps(result['total']), retain=True)
+        info.wait_for_publish()
+        client.loop_stop()
+        client.disconnect()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import errno
+import logging
+import os
+import socket
+import struct
+import time
+
+"""
+Direct smartmeter -> controller transport for processes on the same host
+
+The meter reader writes one fixed-size binary sample per decoded frame to a Unix datagram socket,
+update_setpoint.py reads it without going through the broker and json. MQTT stays the fan-out path
+for dashboards and databases.
+
+Sample (little endian, 56 bytes):
+
+<magic B> <pad 3x> <seq I> <t_frame d> <t_decoded d> <t_sent d> <power_in i> <power_out i> <total_in d> <total_out d>
+
+t_* are time.monotonic() stamps of the latency trace stages frame/decoded/published (see latency_trace.py).
+CLOCK_MONOTONIC is shared by all processes of a host, so the receiver can compute the age of the sample directly.
+"""
+
+log = logging.getLogger(__name__)
+
+SAMPLE = struct.Struct("<BxxxIdddiidd")
+SAMPLE_MAGIC = 0xA5
+
+
+class SampleSender:
+    def __init__(self, path):
+        self.path = path
+        self.seq = 0
+        self.sent = 0
+        self.dropped = 0  # receiver not running or socket buffer full
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def send(self, t_frame, t_decoded, power_in, power_out, total_in, total_out):
+        """
+        Send a sample, never blocks. A missing receiver is not an error, the sample is dropped.
+
+        :return: True if the sample was handed to the kernel
+        """
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        frame = SAMPLE.pack(SAMPLE_MAGIC, self.seq, t_frame, t_decoded, time.monotonic(),
+                            int(power_in), int(power_out), total_in, total_out)
+        try:
+            self.sock.sendto(frame, self.path)
+            self.sent += 1
+            return True
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ECONNREFUSED, errno.EAGAIN):
+                log.error(f"fastlink send to {self.path} failed: {e}")
+            self.dropped += 1
+            return False
+
+    def close(self):
+        self.sock.close()
+
+
+class SampleReceiver:
+    def __init__(self, path):
+        self.path = path
+        self.last_seq = None
+        self.received = 0
+        self.lost = 0  # gaps in the sequence counter
+        self.invalid = 0
+        self.last_rx = None  # time.monotonic() of the last valid sample
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+
+    def receive(self, timeout=None):
+        """
+        Wait for the next valid sample. Old or duplicated samples (seq not increasing) are skipped.
+
+        :param timeout: seconds, None = wait forever
+        :return: dictionary like the smartmeter mqtt payload (incl. 'trace'), or None on timeout
+        """
+        self.sock.settimeout(timeout)
+        while True:
+            try:
+                frame = self.sock.recv(SAMPLE.size)
+            except socket.timeout:
+                return None
+            if len(frame) != SAMPLE.size:
+                self.invalid += 1
+                continue
+            magic, seq, t_frame, t_decoded, t_sent, power_in, power_out, total_in, total_out = SAMPLE.unpack(frame)
+            if magic != SAMPLE_MAGIC:
+                self.invalid += 1
+                continue
+            if self.last_seq is not None:
+                gap = (seq - self.last_seq) & 0xFFFFFFFF
+                if gap == 0 or gap > 0x7FFFFFFF:  # duplicate or reordered
+                    continue
+                self.lost += gap - 1
+            self.last_seq = seq
+            self.received += 1
+            self.last_rx = time.monotonic()
+            return {'trace': {'id': seq, 'frame': t_frame, 'decoded': t_decoded, 'published': t_sent},
+                    'power_in': power_in,
+                    'power_out': power_out,
+                    'power': power_in - power_out,
+                    'total_in': total_in,
+                    'total_out': total_out}
+
+    def is_active(self, max_age=5):
+        """
+        :return: True if a sample was received within max_age seconds
+        """
+        return self.last_rx is not None and time.monotonic() - self.last_rx < max_age
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
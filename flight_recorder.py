@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+
+import argparse
+import datetime
+import itertools
+import json
+import logging
+import os
+import struct
+import threading
+import time
+
+"""
+Flight recorder: always on binary ring buffer of the control loop, dumped to disk on faults
+
+Every control tick, VE.Bus frame (TX/RX), input (bms soc, mppt power) and event (cmd, offline, ...) is one fixed size record
+in a preallocated bytearray, written with Struct.pack_into, nothing is formatted or allocated per record. The
+last `records` records are kept (16384 records ~ 15-20 minutes at one tick per second).
+
+Record (48 bytes, little endian):
+  seq      uint32   running number (ordering after the ring wrapped)
+  time     float64  time.time()
+  kind     uint8    KINDS
+  code     uint8    input source / event code
+  length   uint16   full frame length (frames longer than 32 bytes are cut)
+  data     32 bytes frame bytes or the packed values of the kind (TICK, INPUT)
+
+The buffer is written to <path>/flight-<time>-<reason>.bin on
+  offline      MultiPlus data timeout
+  set_power    set_power failed
+  exception    update_sm_power raised
+  cmd          {"cmd": "dump"} on the VICTRON cmd_topic
+at most once per min_interval seconds (cmd always), in a thread (the control loop does not wait for the sd card).
+
+  python flight_recorder.py flight-20240501-120000-offline.bin [--json] [--last 200]
+"""
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'FREC'
+VERSION = 1
+HEADER = struct.Struct('<4sBHI')  # magic, version, record size, records
+RECORD = struct.Struct('<IdBBH32s')
+
+TICK, TX, RX, INPUT, EVENT = range(1, 6)
+KINDS = {TICK: 'tick', TX: 'tx', RX: 'rx', INPUT: 'input', EVENT: 'event'}
+
+# sm_power, mp2_power, mp2_power_old, bms_soc, bat_u, inv_p, set_power_ok, online
+TICK_DATA = struct.Struct('<ffffffBB')
+TICK_FIELDS = ('sm_power', 'mp2_power', 'mp2_power_old', 'bms_soc', 'bat_u', 'inv_p', 'set_power_ok', 'online')
+INPUT_DATA = struct.Struct('<f')
+INPUTS = {1: 'bms_soc', 2: 'mppt'}  # the smartmeter power is part of every tick
+INPUT_CODES = {name: code for code, name in INPUTS.items()}
+EVENTS = {1: 'offline', 2: 'set_power', 3: 'exception', 4: 'cmd', 5: 'online'}
+EVENT_CODES = {name: code for code, name in EVENTS.items()}
+
+
+def _float(value):
+    return float('nan') if value is None else float(value)
+
+
+class FlightRecorder:
+    def __init__(self, records=16384, path='flight_records', min_interval=60):
+        """
+        :param records: ring buffer size
+        :param path: directory for the dumps
+        :param min_interval: seconds between automatic dumps
+        """
+        self.records = records
+        self.path = path
+        self.min_interval = min_interval
+        self.buffer = bytearray(records * RECORD.size)
+        self.seq = itertools.count(1)  # next() is atomic, callers in several threads need no lock
+        self.dump_time = None
+        self.dumps = 0
+
+    def _put(self, kind, code, length, data, t=None):
+        seq = next(self.seq)
+        RECORD.pack_into(self.buffer, (seq % self.records) * RECORD.size,
+                         seq & 0xFFFFFFFF, time.time() if t is None else t, kind, code, length, data)
+
+    def frame(self, kind, frame):
+        """
+        :param kind: TX or RX
+        :param frame: bytes
+        """
+        self._put(kind, 0, len(frame), bytes(frame[:32]))
+
+    def tick(self, sm_power, mp2_power, mp2_power_old, bms_soc, bat_u, inv_p, set_power_ok, online):
+        self._put(TICK, 0, TICK_DATA.size,
+                  TICK_DATA.pack(_float(sm_power), _float(mp2_power), _float(mp2_power_old), _float(bms_soc),
+                                 _float(bat_u), _float(inv_p), bool(set_power_ok), bool(online)))
+
+    def input(self, source, value):
+        """
+        :param source: name in INPUTS
+        """
+        try:
+            value = _float(value)
+        except (TypeError, ValueError):
+            value = float('nan')
+        self._put(INPUT, INPUT_CODES[source], INPUT_DATA.size, INPUT_DATA.pack(value))
+
+    def event(self, name, text=''):
+        data = text.encode(errors='replace')
+        self._put(EVENT, EVENT_CODES[name], len(data), data[:32])
+
+    def dump(self, reason, text='', force=False):
+        """
+        Record the event and write the buffer to a file (in a thread), rate limited unless force
+
+        :param reason: name in EVENTS, part of the file name
+        :param text: event detail (first 32 bytes are kept)
+        :return: file name or None if rate limited
+        """
+        t = time.monotonic()
+        self.event(reason, text)
+        if not force and self.dump_time is not None and t - self.dump_time < self.min_interval:
+            return None
+        self.dump_time = t
+        snapshot = bytes(self.buffer)
+        name = os.path.join(self.path, f"flight-{datetime.datetime.now():%Y%m%d-%H%M%S}-{reason}.bin")
+        threading.Thread(target=self._write, args=(name, snapshot), name='flight-dump', daemon=True).start()
+        self.dumps += 1
+        return name
+
+    def _write(self, name, snapshot):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(name + '.tmp', 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, self.records))
+                f.write(snapshot)
+            os.replace(name + '.tmp', name)
+            log.warning(f"flight recorder dumped to {name}")
+        except OSError as ex:
+            log.error(f"flight recorder dump {name}: {ex}")
+
+
+def make_recorder(section):
+    """
+    flight_records=16384 (0 = off), flight_path=flight_records, flight_min_interval=60 from a config section
+
+    :return: FlightRecorder or None
+    """
+    records = section.getint('flight_records', fallback=16384)
+    if not records:
+        return None
+    return FlightRecorder(records, section.get('flight_path', 'flight_records'),
+                          section.getfloat('flight_min_interval', fallback=60))
+
+
+def read_dump(name):
+    """
+    :return: records in order as dictionaries
+    """
+    with open(name, 'rb') as f:
+        magic, version, size, records = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION or size != RECORD.size:
+            raise ValueError(f"{name}: no flight recorder dump (version {VERSION})")
+        data = f.read(size * records)
+    rows = sorted((r for r in RECORD.iter_unpack(data) if r[0]), key=lambda r: r[0])
+    return [decode(*row) for row in rows]
+
+
+def decode(seq, t, kind, code, length, data):
+    r = {'seq': seq, 'time': round(t, 3), 'kind': KINDS.get(kind, kind)}
+    if kind in (TX, RX):
+        r['length'] = length
+        r['frame'] = data[:min(length, 32)].hex(' ').upper()
+    elif kind == TICK:
+        r.update(zip(TICK_FIELDS, (round(v, 2) for v in TICK_DATA.unpack(data[:TICK_DATA.size]))))
+    elif kind == INPUT:
+        r['source'] = INPUTS.get(code, code)
+        r['value'] = round(INPUT_DATA.unpack(data[:INPUT_DATA.size])[0], 2)
+    elif kind == EVENT:
+        r['event'] = EVENTS.get(code, code)
+        if length:
+            r['text'] = data[:length].decode(errors='replace')
+    return r
+
+
+def format_record(r):
+    t = datetime.datetime.fromtimestamp(r['time']).strftime('%H:%M:%S.%f')[:-3]
+    details = ' '.join(f"{k}={v}" for k, v in r.items() if k not in ('seq', 'time', 'kind'))
+    return f"{t} {r['seq']:>8} {r['kind']:<6} {details}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='decode a flight recorder dump')
+    parser.add_argument("file", help="flight-*.bin")
+    parser.add_argument("--json", help="print json lines", action="store_true")
+    parser.add_argument("--last", help="last n records only", type=int)
+    args = parser.parse_args()
+
+    rows = read_dump(args.file)
+    if args.last:
+        rows = rows[-args.last:]
+    for r in rows:
+        print(json.dumps(r) if args.json else format_record(r))
+
+
+if __name__ == '__main__':
+    main()
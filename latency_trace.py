@@ -0,0 +1,153 @@
+import bisect
+import json
+import logging
+import time
+
+"""
+End-to-end latency tracing smartmeter frame -> MultiPlus setpoint ACK
+
+Every meter frame gets a trace id and time.monotonic() stamps for each stage. The readers put the first
+stamps into the payload, update_setpoint.py adds the rest. Durations between consecutive stages go into
+fixed bucket histograms, every n-th trace is published completely on the diagnostics topic.
+
+CLOCK_MONOTONIC is shared by all processes of one host, stamps from another host are not comparable.
+
+Stages:
+frame        serial frame complete (reader)
+decoded      frame decrypted and decoded (reader)
+published    handed to mqtt / fastlink (reader)
+received     arrived in on_message / fastlink loop (controller)
+mp2_updated  mp2.update() done (controller)
+setpoint     new setpoint computed (controller)
+ack          MK3 0x87 ACK for set_power received (vebus)
+"""
+
+log = logging.getLogger(__name__)
+
+STAGES = ('frame', 'decoded', 'published', 'received', 'mp2_updated', 'setpoint', 'ack')
+
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one = overflow
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value_ms):
+        self.counts[bisect.bisect_left(self.buckets, value_ms)] += 1
+        self.count += 1
+        self.sum += value_ms
+        if value_ms > self.max:
+            self.max = value_ms
+
+    def quantile(self, q):
+        """
+        :return: upper bound of the bucket containing quantile q, limited to the observed max
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if n >= rank:
+                return min(self.buckets[i], round(self.max, 1)) if i < len(self.buckets) else round(self.max, 1)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'mean': round(self.sum / self.count, 1) if self.count else None,
+                'p50': self.quantile(0.5),
+                'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99),
+                'max': round(self.max, 1),
+                'buckets': dict(zip([str(b) for b in self.buckets] + ['inf'], self.counts))}
+
+
+class Trace:
+    __slots__ = ('trace_id', 'path', 'stamps')
+
+    def __init__(self, trace_id, path, stamps=None):
+        self.trace_id = trace_id
+        self.path = path
+        self.stamps = dict(stamps) if stamps else {}
+
+    def mark(self, stage, t=None):
+        self.stamps[stage] = time.monotonic() if t is None else t
+
+    def durations(self):
+        """
+        :return: list of (stage, milliseconds since previous present stage)
+        """
+        r = []
+        prev = None
+        for stage in STAGES:
+            t = self.stamps.get(stage)
+            if t is None:
+                continue
+            if prev is not None:
+                r.append((stage, (t - prev) * 1000))
+            prev = t
+        return r
+
+    def to_dict(self):
+        t0 = min(self.stamps.values()) if self.stamps else 0
+        return {'trace_id': self.trace_id,
+                'path': self.path,
+                'stages': {s: round((self.stamps[s] - t0) * 1000, 2) for s in STAGES if s in self.stamps}}
+
+
+class LatencyTracer:
+    def __init__(self, mqtt_client=None, topic=None, sample_every=100, report_interval=60):
+        """
+        :param mqtt_client: client for the diagnostics topic, None = log only
+        :param topic: diagnostics topic
+        :param sample_every: publish every n-th complete trace
+        :param report_interval: seconds between histogram reports
+        """
+        self.mqtt_client = mqtt_client
+        self.topic = topic
+        self.sample_every = sample_every
+        self.report_interval = report_interval
+        self.histograms = {}  # (path, stage) -> Histogram, stage 'total' = frame to last stamp
+        self.finished = 0
+        self.report_time = time.monotonic() + report_interval
+
+    def begin(self, trace_id, path, stamps=None):
+        return Trace(trace_id, path, stamps)
+
+    def finish(self, trace):
+        for stage, ms in trace.durations():
+            self._observe(trace.path, stage, ms)
+        if 'frame' in trace.stamps and len(trace.stamps) > 1:
+            self._observe(trace.path, 'total', (max(trace.stamps.values()) - trace.stamps['frame']) * 1000)
+
+        self.finished += 1
+        if self.sample_every and self.finished % self.sample_every == 0:
+            self.publish({'trace': trace.to_dict()})
+
+        if time.monotonic() > self.report_time:
+            self.report_time = time.monotonic() + self.report_interval
+            self.publish({'latency_ms': self.summary()})
+
+    def _observe(self, path, stage, ms):
+        h = self.histograms.get((path, stage))
+        if h is None:
+            h = self.histograms[(path, stage)] = Histogram()
+        h.observe(ms)
+
+    def summary(self):
+        r = {}
+        for (path, stage), h in self.histograms.items():
+            r.setdefault(path, {})[stage] = h.summary()
+        return r
+
+    def publish(self, doc):
+        if self.mqtt_client and self.topic:
+            self.mqtt_client.publish(self.topic, json.dumps(doc))
+        else:
+            log.info(json.dumps(doc))
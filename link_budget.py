@@ -0,0 +1,100 @@
+import collections
+import logging
+import threading
+import time
+
+"""
+Byte / frame accounting and a load budget for the 2400 baud MK3 link
+
+2400 baud 8N1 carries 240 bytes/s per direction. Every TX and RX byte is counted with its time, the utilisation
+(bytes / capacity) is computed over sliding windows (1, 10, 60 s) per direction. The control loop (update(),
+command()) always goes first. Low priority requests (fech_data, scans) wait before they start until the busier
+direction of the last `window` seconds is below `budget` (share of the capacity), at most max_wait seconds.
+
+[VICTRON]
+link_budget=0.6
+link_window=5
+"""
+
+log = logging.getLogger(__name__)
+
+DIRECTIONS = ('tx', 'rx')
+WINDOWS = (1, 10, 60)
+
+
+class LinkBudget:
+    def __init__(self, baud=2400, budget=0.6, window=5, max_wait=10, windows=WINDOWS):
+        """
+        :param baud: serial speed, 10 bits per byte
+        :param budget: share of the capacity low priority requests may start into
+        :param window: seconds, utilisation checked by wait()
+        :param max_wait: longest wait of a low priority request [s]
+        :param windows: reported sliding windows [s]
+        """
+        self.capacity = baud / 10  # bytes per second and direction
+        self.budget = budget
+        self.window = window
+        self.max_wait = max_wait
+        self.windows = windows
+        self.horizon = max(windows + (window,))
+        self.events = collections.deque()  # (time.monotonic(), direction index, bytes), last horizon seconds
+        self.bytes = [0, 0]  # totals per direction
+        self.frames = [0, 0]  # counted frames / responses per direction
+        self.waits = 0
+        self.wait_time = 0.0
+        self.lock = threading.Lock()
+
+    def count(self, direction, n):
+        """
+        :param direction: 'tx' or 'rx'
+        :param n: bytes of one frame / response (all bytes read for it, once per frame)
+        """
+        i = DIRECTIONS.index(direction)
+        t = time.monotonic()
+        with self.lock:
+            self.bytes[i] += n
+            self.frames[i] += 1
+            self.events.append((t, i, n))
+            while self.events and self.events[0][0] < t - self.horizon:
+                self.events.popleft()
+
+    def utilisation(self, window, direction=None):
+        """
+        :param direction: 'tx', 'rx' or None for the busier one
+        :return: share of the capacity used in the last window seconds
+        """
+        since = time.monotonic() - window
+        used = [0, 0]
+        with self.lock:
+            for t, i, n in reversed(self.events):
+                if t < since:
+                    break
+                used[i] += n
+        if direction:
+            used = used[DIRECTIONS.index(direction)]
+        else:
+            used = max(used)
+        return used / (self.capacity * window)
+
+    def wait(self):
+        """
+        Low priority request: wait until the link is below budget
+
+        :return: seconds waited
+        """
+        start = time.monotonic()
+        while self.utilisation(self.window) >= self.budget and time.monotonic() - start < self.max_wait:
+            time.sleep(0.1)
+        waited = time.monotonic() - start
+        if waited > 0.05:
+            self.waits += 1
+            self.wait_time += waited
+            log.debug("low priority request waited %.1fs for the link", waited)
+        return waited
+
+    def summary(self):
+        return {'bytes': dict(zip(DIRECTIONS, self.bytes)),
+                'frames': dict(zip(DIRECTIONS, self.frames)),
+                'utilisation': {f"{w}s": round(self.utilisation(w), 3) for w in self.windows},
+                'waits': self.waits,
+                'wait_time': round(self.wait_time, 1)}
@@ -0,0 +1,288 @@
+import bisect
+import http.server
+import logging
+import math
+import threading
+import time
+
+"""
+OpenMetrics exporter for controller and device health
+
+The hot paths only do attribute arithmetic on plain python numbers (no lock, no formatting): counter.inc(),
+gauge.set(), histogram.observe(). Values that already exist elsewhere (setpoint, data age, mqtt queue) are
+gauge functions evaluated on scrape. The text is rendered only when /metrics is requested, between two scrapes
+monitoring costs nothing else. Every metric has one writing thread, a scrape may see a histogram in the middle
+of an update (the count is taken from the buckets, so it stays consistent).
+
+The HTTP server listens on 127.0.0.1 by default (no authentication, local scraper or ssh tunnel):
+
+[METRICS]
+host=127.0.0.1
+port=9105
+
+  curl http://127.0.0.1:9105/metrics
+"""
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _number(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return 'NaN'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{str(value)}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Gauge:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets=SECONDS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one = +Inf, not cumulative
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Family:
+    def __init__(self, name, kind, help_text, label_names=(), factory=None):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self.factory = factory
+        self.children = {}  # label values -> Counter / Gauge / Histogram
+        self.func = None  # gauge function: () -> value or {label values: value}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children.setdefault(values, self.factory())
+        return child
+
+    def samples(self):
+        """
+        :return: [(suffix, label text, value)]
+        """
+        if self.func:
+            try:
+                result = self.func()
+            except Exception as ex:
+                log.debug(f"{self.name}: {ex}")
+                return []
+            items = result.items() if isinstance(result, dict) else [((), result)]
+            return [('', _labels(self.label_names, k if isinstance(k, tuple) else (k,)), v) for k, v in items]
+
+        r = []
+        for values, child in list(self.children.items()):
+            if self.kind == 'counter':
+                r.append(('_total', _labels(self.label_names, values), child.value))
+            elif self.kind == 'gauge':
+                r.append(('', _labels(self.label_names, values), child.value))
+            else:
+                counts = list(child.counts)
+                n = 0
+                for le, count in zip(child.buckets + ('+Inf',), counts):
+                    n += count
+                    r.append(('_bucket', _labels(self.label_names, values, ('le', le)), n))
+                r.append(('_sum', _labels(self.label_names, values), child.sum))
+                r.append(('_count', _labels(self.label_names, values), n))
+        return r
+
+    def render(self):
+        lines = [f"# TYPE {self.name} {self.kind}", f"# HELP {self.name} {self.help}"]
+        lines += [f"{self.name}{suffix}{labels} {_number(value)}" for suffix, labels, value in self.samples()]
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.families = {}
+        self.lock = threading.Lock()  # registration only
+
+    def _family(self, name, kind, help_text, label_names, factory):
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = Family(name, kind, help_text, label_names, factory)
+            elif family.kind != kind:
+                raise ValueError(f"metric {name} is a {family.kind}")
+        return family
+
+    def counter(self, name, help_text, label_names=()):
+        """
+        :param name: without _total
+        :return: Family, .labels(*values).inc(); without label_names the Counter itself
+        """
+        family = self._family(name, 'counter', help_text, label_names, Counter)
+        return family if label_names else family.labels()
+
+    def gauge(self, name, help_text, label_names=()):
+        family = self._family(name, 'gauge', help_text, label_names, Gauge)
+        return family if label_names else family.labels()
+
+    def histogram(self, name, help_text, label_names=(), buckets=SECONDS_BUCKETS):
+        family = self._family(name, 'histogram', help_text, label_names, lambda: Histogram(buckets))
+        return family if label_names else family.labels()
+
+    def gauge_func(self, name, help_text, func, label_names=()):
+        """
+        Gauge evaluated on scrape, registering the name again replaces the function (restarted component)
+
+        :param func: () -> value, or {label value(s): value} if label_names
+        """
+        family = self._family(name, 'gauge', help_text, label_names, Gauge)
+        family.func = func
+
+    def render(self):
+        lines = []
+        for family in list(self.families.values()):
+            lines += family.render()
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class VEBusMetrics:
+    """
+    Counters of one MK3 link, see vebus.VEBus.metrics
+    """
+    def __init__(self, registry=REGISTRY, link=None):
+        """
+        :param link: link_budget.LinkBudget of the port, utilisation per window on scrape
+        """
+        self.rtt = registry.histogram('vebus_rtt_seconds', 'MK3 request to response time', ('command',))
+        self.timeouts = registry.counter('vebus_timeouts', 'MK3 receive timeouts', ('command',))
+        self.checksum_errors = registry.counter('vebus_checksum_errors', 'MK3 frames with a wrong checksum')
+        self.invalid_frames = registry.counter('vebus_invalid_frames', 'MK3 responses without a valid frame')
+        self.frames = registry.counter('vebus_frames', 'MK3 frames', ('direction',))
+        self.bytes = registry.counter('vebus_bytes', 'MK3 bytes on the serial link', ('direction',))
+        self.tx_frames = self.frames.labels('tx')
+        self.rx_frames = self.frames.labels('rx')
+        self.tx_bytes = self.bytes.labels('tx')
+        self.rx_bytes = self.bytes.labels('rx')
+        if link:
+            registry.gauge_func('vebus_utilisation_ratio', 'share of the link capacity used',
+                                lambda: {(f"{w}s", d): link.utilisation(w, d) for w in link.windows for d in ('tx', 'rx')},
+                                ('window', 'direction'))
+            registry.gauge_func('vebus_budget_wait_seconds', 'time low priority requests waited for the budget',
+                                lambda: link.wait_time)
+
+
+class SetPointMetrics:
+    """
+    Control loop of update_setpoint.SetPoint, values of the SetPoint are read on scrape
+    """
+    def __init__(self, set_point, registry=REGISTRY):
+        self.duration = registry.histogram('setpoint_tick_seconds', 'duration of one control step')
+        self.interval = registry.histogram('setpoint_tick_interval_seconds', 'time between two control steps',
+                                           buckets=(0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 30))
+        self.ticks = registry.counter('setpoint_ticks', 'control steps')
+        self.last_tick = None  # time.perf_counter()
+        self.last_tick_time = None  # time.time()
+
+        mp2 = set_point.mp2
+        registry.gauge_func('setpoint_power_watts', 'MultiPlus setpoint, + = charge', lambda: set_point.mp2_power)
+        registry.gauge_func('setpoint_grid_power_watts', 'smartmeter power of the last step, + = feed in',
+                            lambda: set_point.sm_power)
+        registry.gauge_func('setpoint_soc_percent', 'battery soc used by the control', lambda: set_point.bms_soc)
+        registry.gauge_func('setpoint_max_invert_watts', 'current inverter limit', set_point.get_max_invert)
+        registry.gauge_func('mp2_online', 'MultiPlus answers', lambda: mp2.online)
+        registry.gauge_func('mqtt_queue_messages', 'messages waiting in the mqtt client',
+                            lambda: len(getattr(set_point.mqtt_client, '_out_messages', ())))
+
+        def ages():
+            now = time.time()
+            r = {'mp2': time.perf_counter() - (mp2.data_timeout - mp2.timeout)}
+            for device, t in (('smartmeter', self.last_tick_time), ('bms', set_point.last_bms_soc_data),
+                              ('mppt', set_point.last_mppt_power)):
+                if t:
+                    r[device] = now - t
+            return r
+        registry.gauge_func('device_data_age_seconds', 'seconds since the last data of a device', ages, ('device',))
+
+    def tick(self, start):
+        """
+        :param start: time.perf_counter() at the start of the step
+        """
+        end = time.perf_counter()
+        self.ticks.inc()
+        self.duration.observe(end - start)
+        if self.last_tick is not None:
+            self.interval.observe(start - self.last_tick)
+        self.last_tick = start
+        self.last_tick_time = time.time()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+_server = None
+
+
+def serve(section, registry=REGISTRY):
+    """
+    Start the HTTP server in a daemon thread, once per process (components restarted by supervisor.py call again)
+
+    :param section: config section with host (default 127.0.0.1) and port (default 9105)
+    """
+    global _server
+    if _server is not None:
+        return _server
+    handler = type('Handler', (_Handler,), {'registry': registry})
+    _server = http.server.ThreadingHTTPServer((section.get('host', '127.0.0.1'), int(section.get('port', 9105))), handler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name='metrics', daemon=True).start()
+    log.info(f"metrics on http://{_server.server_address[0]}:{_server.server_address[1]}/metrics")
+    return _server
@@ -1,11 +1,13 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-# continuously publish VE.Direct data to the topic prefix specified
+# continuously publish VE.Direct data of one or more devices to mqtt
 
 import argparse, os
 import paho.mqtt.client as mqtt
-from vedirect import VEDirect
+from vedirect_mux import VEDirectMux
+from publish_policy import WindowAggregator
+from payload_codec import make_encoder
 import logging
 import configparser
 import json
@@ -14,22 +16,77 @@ log = logging.getLogger(__name__)
 
 config=None
 client=None
+policies={}  # device name -> (WindowAggregator or None, PayloadEncoder)
 
 
-def mqtt_send_callback(packet):
+def make_policy(section):
+    """
+    publish_mode=full     every record (default)
+    publish_mode=change   changed fields (thresholds=PPV:5,V:20,...) marked with "_delta": 1 and a full snapshot
+                          every snapshot_interval s (default 10, update_setpoint.py treats PPV older than 20 s
+                          as missing), the change filter of the encoder, see payload_codec.make_encoder
+    window=10             mean/min/max of window_fields over 10 s on window_topic
+    payload=json          encoding of topic, json, delta or binary, see payload_codec.py
+    """
+    aggregator=None
+    if section.getfloat('window', fallback=0) > 0:
+        aggregator=WindowAggregator(section.get('window_fields', 'PPV,V,I').split(','), section.getfloat('window'))
+    return (aggregator, make_encoder(section))
+
+
+def mqtt_send_callback(device, packet):
     global config
     global client
 
-    print(packet)
+    record=packet.to_dict()
+    aggregator, encoder=policies[device.name]
+
+    if aggregator:
+        aggregate=aggregator.add(record)
+        if aggregate:
+            client.publish(config[device.name].get('window_topic', device.topic + '/window'), json.dumps(aggregate))
 
-    client.publish(config['MPPT']['TOPIC'], json.dumps(packet))
+    encoder.publish(client, device.topic, record)
 
 
-    # for key, value in packet.items():
-    #     if key != 'SER#': # topic cannot contain MQTT wildcards
-    #         log.info(f"{args.topicprefix + key}: {value}")
-    #         client.publish(args.topicprefix + key, value)
+def mqtt_hex_callback(device, values):
+    global client
 
+    client.publish(device.hex_topic, json.dumps(values))
+
+
+def mqtt_stats_callback(device, stats):
+    global config
+    global client
+
+    topic=config[device.name].get('stats_topic')
+    if topic:
+        client.publish(topic, json.dumps(stats))
+
+
+def make_mux(config_, client_, sections):
+    """
+    One selector loop for all ports of the given config sections, published with one mqtt connection
+
+    :return: VEDirectMux, run() blocks
+    """
+    global config
+    global client
+
+    config=config_
+    client=client_
+    mux = VEDirectMux(mqtt_send_callback, stats_interval=config[sections[0]].getint('stats_interval', fallback=60))
+    mux.on_stats = mqtt_stats_callback
+    mux.publish_hex = mqtt_hex_callback
+    for section in sections:
+        policies[section] = make_policy(config[section])
+        hex_registers = config[section].get('hex_registers')
+        mux.add(section, config[section]['serial_port'], config[section]['topic'],
+                hex_registers=hex_registers.split(',') if hex_registers else None,
+                hex_interval=config[section].getfloat('hex_interval', fallback=5),
+                hex_topic=config[section].get('hex_topic', config[section]['topic'] + '/hex'))
+
+    return mux
 
 
 def main():
@@ -38,46 +95,29 @@ def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", help="config.ini file", default="config.ini")
+    parser.add_argument("--section", help="config section of a VE.Direct device, can be repeated (default MPPT)",
+                        action="append")
     args = parser.parse_args()
 
-    logging.basicConfig()
+    logging.basicConfig(level=logging.INFO)
 
 
     config = configparser.ConfigParser()
     config.read(args.config)
-
+    sections = args.section or ['MPPT']
 
 
     client = mqtt.Client(f"MPPT_{args.config}")
     if config['MQTT'].get('user'):
         print("mqtt password given")
         client.username_pw_set(config['MQTT']['user'], config['MQTT']['password'])
-#    client.on_message = on_message
 
     print(f"connect to mqtt server {config['MQTT']['host']}")
     client.connect(config['MQTT']['host'], int(config['MQTT']['port']))
+    client.loop_start()
 
-
-    # parser = argparse.ArgumentParser(description='Process VE.Direct protocol')
-    # parser.add_argument('--port', help='Serial port')
-    # parser.add_argument('--timeout', help='Serial port read timeout', type=int, default='60')
-    # parser.add_argument('--mqttbroker', help='MQTT broker address', type=str, default='test.mosquitto.org')
-    # parser.add_argument('--mqttbrokerport', help='MQTT broker port', type=int, default='1883')
-    # parser.add_argument('--topicprefix', help='MQTT topic prefix', type=str, default='vedirect_device/')
-    # parser.add_argument('--emulate', help='emulate one of [ALL, BMV_600, BMV_700, MPPT, PHX_INVERTER]',
-    #                 default='', type=str)
-    # parser.add_argument('--loglevel', help='logging level - one of [DEBUG, INFO, WARNING, ERROR, CRITICAL]',
-    #                 default='ERROR')
-    # args = parser.parse_args()
-    ve = VEDirect(config['MPPT']['serial_port'], 60)
-
-    # client = mqtt.Client()
-    # client.connect(args.mqttbroker, args.mqttbrokerport, 60)
-    # client.loop_start()
-
-
-    ve.read_data_callback(mqtt_send_callback)
+    make_mux(config, client, sections).run()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
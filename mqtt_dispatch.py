@@ -0,0 +1,52 @@
+import logging
+import threading
+
+"""
+Fan-out of one mqtt client to several consumers of a topic
+
+paho keeps one callback per topic filter, message_callback_add replaces the callback another component
+registered for the same topic (e.g. the setpoint control and the display both read the smartmeter topic when
+they share the client of supervisor.py). Every component registers with a Dispatcher instead, the dispatcher
+registers itself once per filter and calls all callbacks of the filter.
+"""
+
+log = logging.getLogger(__name__)
+
+
+class Dispatcher:
+    def __init__(self, client):
+        self.client = client
+        self.callbacks = {}  # topic filter -> [callback]
+        self.lock = threading.Lock()
+
+    def subscribe(self, topic, callback, qos=0):
+        """
+        Add callback(client, userdata, message) for topic (filter, wildcards allowed) and subscribe it
+        """
+        with self.lock:
+            callbacks = self.callbacks.get(topic)
+            first = callbacks is None
+            if first:
+                callbacks = self.callbacks[topic] = []
+            if callback not in callbacks:
+                self.callbacks[topic] = callbacks + [callback]  # copy, dispatch() iterates without lock
+        if first:
+            self.client.message_callback_add(topic, lambda client, userdata, message: self.dispatch(
+                topic, client, userdata, message))
+        self.client.subscribe(topic, qos)
+
+    def remove(self, callback):
+        """
+        Remove callback from all topics (component closed), the broker subscription stays
+        """
+        with self.lock:
+            for topic, callbacks in self.callbacks.items():
+                if callback in callbacks:
+                    self.callbacks[topic] = [c for c in callbacks if c != callback]
+
+    def dispatch(self, topic, client, userdata, message):
+        for callback in self.callbacks.get(topic, ()):
+            try:
+                callback(client, userdata, message)
+            except Exception as ex:
+                log.error(f"{message.topic}: {ex}", exc_info=True)
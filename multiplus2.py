@@ -34,6 +34,10 @@ class MultiPlus2:
         self._wakeup = True
 
     def connect(self):
+        with self.vebus.transaction():
+            self._connect()
+
+    def _connect(self):
         version = self.vebus.get_version()  # hide errors while scanning
         if version:
             self.data = {'mk2_version': version}  # init dictionary
@@ -55,24 +59,28 @@ class MultiPlus2:
             if self._wakeup and not self.cmd_lock_time:
                 self.cmd_lock_time = t + 3  # lock command for 3 seconds
                 self._wakeup = False
-                self.vebus.wakeup()
+                with self.vebus.transaction():
+                    self.vebus.wakeup()
                 self.log.info("wakeup")
                 ret=True
             elif self._sleep and not self.cmd_lock_time:
                 self.cmd_lock_time = t + 3  # lock command for 3 seconds
                 self._sleep = False
-                self.vebus.sleep()
+                with self.vebus.transaction():
+                    self.vebus.sleep()
                 self.log.info("sleep")
                 ret=True
             else:
                 if abs(power) >= 1:
                     if self.power_delay_time is None:
                         self.log.info("set_power start {}".format(power))
-                    self.log.debug("set_power {}".format(power))
-                    ret=self.vebus.set_power(power)  # send command to multiplus
+                    self.log.debug("set_power %s", power)
+                    with self.vebus.transaction():
+                        ret=self.vebus.set_power(power)  # send command to multiplus
                     self.power_delay_time = t + 5  # send zero for 5seconds after last value >= 1
                 elif self.power_delay_time:
-                    ret=self.vebus.set_power(0)
+                    with self.vebus.transaction():
+                        ret=self.vebus.set_power(0)
                     if t > self.power_delay_time:
                         self.power_delay_time = None
                         self.log.debug("set_power zero trailing timer end")
@@ -93,6 +101,39 @@ class MultiPlus2:
             self.connect()
 
         else:
+            data = self.read(pause_time)
+            if data:
+                led = data.get('led_light', 0) + data.get('led_blink', 0)
+                state = data.get('device_state_id', None)
+                if state == 2:
+                    data['state'] = 'sleep'
+                elif led & 0x40:
+                    data['state'] = 'low_bat'
+                elif led & 0x80:
+                    data['state'] = 'temperature'
+                elif led & 0x20:
+                    data['state'] = 'overload'
+                elif state == 8 or state == 9:
+                    data['state'] = 'on'
+                elif state == 4:
+                    data['state'] = 'wait'
+                else:
+                    data['state'] = '?{}?0x{:02X}?'.format(state, led)
+
+                self.data = data
+                self.data_timeout = time.perf_counter() + self.timeout  # reset data timeout with valid rx
+
+        if time.perf_counter() > self.data_timeout:
+            self.online = False
+            self.data = {'error': 'offline', 'state': 'offline'}
+
+    def read(self, pause_time):
+        """
+        Snapshot, ac info and led in one transaction (a diagnostic read must not take the snapshot in between)
+
+        :return: dictionary or None
+        """
+        with self.vebus.transaction():
             self.vebus.send_snapshot_request_old()  # trigger snapshot
             time.sleep(pause_time)
             part1 = self.vebus.get_ac_info()  # read ac infos and append to data dictionary
@@ -107,26 +148,5 @@ class MultiPlus2:
                         data.update(part1)
                         data.update(part2)
                         data.update(part3)
-                        led = data.get('led_light', 0) + data.get('led_blink', 0)
-                        state = data.get('device_state_id', None)
-                        if state == 2:
-                            data['state'] = 'sleep'
-                        elif led & 0x40:
-                            data['state'] = 'low_bat'
-                        elif led & 0x80:
-                            data['state'] = 'temperature'
-                        elif led & 0x20:
-                            data['state'] = 'overload'
-                        elif state == 8 or state == 9:
-                            data['state'] = 'on'
-                        elif state == 4:
-                            data['state'] = 'wait'
-                        else:
-                            data['state'] = '?{}?0x{:02X}?'.format(state, led)
-
-                        self.data = data
-                        self.data_timeout = time.perf_counter() + self.timeout  # reset data timeout with valid rx
-
-        if time.perf_counter() > self.data_timeout:
-            self.online = False
-            self.data = {'error': 'offline', 'state': 'offline'}
+                        return data
+        return None
@@ -0,0 +1,204 @@
+import json
+import logging
+import math
+import struct
+
+from publish_policy import ChangeFilter, parse_thresholds
+
+"""
+Payload encodings for high rate telemetry topics
+
+json    the complete record as json (default, what every consumer understands)
+delta   json behind a publish_policy.ChangeFilter: the changed fields only and "_delta": 1, the complete record
+        (keyframe, plain json) every keyframe_interval seconds
+binary  fixed layout struct: magic 0xB5, schema id, one value per field. The layout is published retained on
+        <topic>/schema as {"id": 3, "format": "<BBdid", "fields": ["power", ...]} and republished with a new id
+        if the fields change. Numbers, bools and strings (utf-8, zero padded to a multiple of 8 bytes, the field widens
+for a longer one), other values are left out. Missing values are NaN / -2^31 / empty string.
+
+PayloadEncoder.publish(client, topic, record) encodes and publishes a record, PayloadDecoder.decode(topic, payload)
+returns the complete record for every encoding: records with "_delta": 1 (delta mode, or a change_filter in front
+of a binary encoder) are merged into the last complete record of the topic.
+"""
+
+log = logging.getLogger(__name__)
+
+MODES = ('json', 'delta', 'binary')
+MAGIC = 0xB5
+HEADER = '<BB'
+MISSING_INT = -2 ** 31
+TYPE_RANK = '?iqd'  # bool < int32 < int64 < float64, a field only gets wider
+
+
+def value_type(value):
+    if isinstance(value, bool):
+        return '?'
+    if isinstance(value, int):
+        return 'i' if -2 ** 31 < value < 2 ** 31 else 'q'
+    if isinstance(value, float):
+        return 'd'
+    if isinstance(value, str):
+        return f'{max(8, -(-len(value.encode()) // 8) * 8)}s'
+    return None
+
+
+def wider(t, old):
+    """
+    :return: True if a field of type old needs type t for a value
+    """
+    if t[-1] == 's' and old[-1] == 's':
+        return int(t[:-1]) > int(old[:-1])
+    if t[-1] == 's' or old[-1] == 's':
+        return t[-1] == 's'  # a field that carried text stays text, numbers are packed as text
+    return TYPE_RANK.index(t) > TYPE_RANK.index(old)
+
+
+class PayloadEncoder:
+    def __init__(self, mode='json', keyframe_interval=60, thresholds=None, change_filter=None):
+        """
+        :param mode: json, delta or binary
+        :param keyframe_interval: seconds between complete records in delta mode
+        :param thresholds: field -> minimum change in delta mode
+        :param change_filter: publish_policy.ChangeFilter applied before encoding (any mode), delta mode builds
+            one from keyframe_interval and thresholds if None
+        """
+        if mode not in MODES:
+            raise ValueError(f"unknown payload mode {mode}, use one of {', '.join(MODES)}")
+        self.mode = mode
+        if change_filter is None and mode == 'delta':
+            change_filter = ChangeFilter(thresholds, snapshot_interval=keyframe_interval)
+        self.change_filter = change_filter
+        self.schema_id = 0
+        self.fields = None
+        self.types = {}
+        self.struct = None
+        self.schema = None  # json to publish on <topic>/schema, None if already published
+
+    def _build_schema(self, record):
+        for key, value in record.items():
+            t = value_type(value)
+            old = self.types.get(key)
+            if t and (old is None or wider(t, old)):
+                self.types[key] = t
+        self.fields = list(self.types)  # every field seen so far in first seen order, _pack fills missing ones
+        fmt = HEADER + ''.join(self.types[key] for key in self.fields)
+        self.schema_id = (self.schema_id + 1) & 0xFF
+        self.struct = struct.Struct(fmt)
+        self.schema = json.dumps({'id': self.schema_id, 'format': fmt, 'fields': self.fields})
+        log.info(f"payload schema {self.schema}")
+
+    def _new_types(self, record):
+        types = self.types
+        for key, value in record.items():
+            t = value_type(value)
+            if t and (key not in types or t != types[key] and wider(t, types[key])):
+                return True
+        return False
+
+    def _pack(self, record):
+        values = []
+        for key in self.fields:
+            value = record.get(key)
+            t = self.types[key]
+            if t[-1] == 's':
+                value = b'' if value is None else str(value).encode()
+            elif value is None:
+                value = math.nan if t == 'd' else MISSING_INT if t != '?' else False
+            values.append(value)
+        return self.struct.pack(MAGIC, self.schema_id, *values)
+
+    def encode(self, record):
+        """
+        :return: payload (str or bytes) or None if nothing changed (change_filter)
+        """
+        if self.change_filter:
+            record = self.change_filter.filter(record)  # keyframe or changed fields with _delta
+            if record is None:
+                return None
+        if self.mode != 'binary':
+            return json.dumps(record)
+
+        if self.fields is None or self._new_types(record):
+            self._build_schema(record)
+        try:
+            return self._pack(record)
+        except struct.error:  # value no longer fits the type, e.g. int field got a float
+            self._build_schema(record)
+            return self._pack(record)
+
+    def publish(self, client, topic, record, **kwargs):
+        """
+        Encode and publish, the binary schema is published (retained) before the first record using it
+        """
+        payload = self.encode(record)
+        if payload is None:
+            return None
+        if self.schema:
+            client.publish(topic + '/schema', self.schema, retain=True)
+            self.schema = None
+        return client.publish(topic, payload, **kwargs)
+
+
+class PayloadDecoder:
+    def __init__(self):
+        self.schemas = {}  # topic -> {id: (Struct, fields)}
+        self.state = {}  # topic -> last complete record (delta)
+
+    def add_schema(self, topic, payload):
+        """
+        :param topic: data topic (without /schema)
+        :param payload: schema json
+        """
+        schema = json.loads(payload)
+        self.schemas.setdefault(topic, {})[schema['id']] = (struct.Struct(schema['format']), schema['fields'])
+
+    def decode(self, topic, payload):
+        """
+        :return: complete record as dictionary, None for a binary record without known schema
+        """
+        if topic.endswith('/schema'):
+            self.add_schema(topic[:-7], payload)
+            return None
+        if payload[:1] == bytes((MAGIC,)):
+            schema = self.schemas.get(topic, {}).get(payload[1])
+            if schema is None:
+                log.warning(f"{topic}: no schema {payload[1]}, subscribe {topic}/schema")
+                return None
+            s, fields = schema
+            record = {}
+            for key, value in zip(fields, s.unpack(payload)[2:]):
+                if isinstance(value, bytes):
+                    value = value.rstrip(b'\0').decode() or None
+                elif value == MISSING_INT or (isinstance(value, float) and math.isnan(value)):
+                    value = None
+                record[key] = value
+            if record.get('_delta'):  # fields missing in a partial record are unchanged, not unknown
+                record = {key: value for key, value in record.items() if value is not None}
+        else:
+            record = json.loads(payload)
+            if not isinstance(record, dict):
+                return record
+        if record.pop('_delta', None):
+            state = self.state.get(topic)
+            if state is None:  # no keyframe yet, changed fields only
+                return record
+            state.update(record)
+            return dict(state)
+        self.state[topic] = dict(record)
+        return record
+
+
+def make_encoder(section):
+    """
+    payload=json|delta|binary, keyframe_interval=60, thresholds=power:5,... (delta) from a config section
+
+    publish_mode=change (VE.Direct sections) is the same change filter with snapshot_interval (default 10) as
+    keyframe interval, for any payload encoding
+    """
+    mode = section.get('payload', 'json')
+    thresholds = parse_thresholds(section.get('thresholds'))
+    change_filter = None
+    if section.get('publish_mode', 'full') == 'change':
+        change_filter = ChangeFilter(thresholds, snapshot_interval=section.getfloat('snapshot_interval', fallback=10))
+    return PayloadEncoder(mode, keyframe_interval=section.getfloat('keyframe_interval', fallback=60),
+                          thresholds=thresholds, change_filter=change_filter)
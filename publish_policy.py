@@ -0,0 +1,123 @@
+import time
+
+"""
+Reduce telemetry traffic: publish changes only, periodic full snapshots and windowed aggregates
+
+ChangeFilter      fields that changed by more than their threshold since they were last sent, marked with
+                  "_delta": 1, the complete record every snapshot_interval seconds
+WindowAggregator  mean/min/max of selected fields over a fixed window, updated per sample
+"""
+
+
+def parse_thresholds(text):
+    """
+    'PPV:5,V:20' -> {'PPV': 5.0, 'V': 20.0}
+    """
+    r = {}
+    if text:
+        for item in text.split(','):
+            key, _, value = item.strip().partition(':')
+            r[key] = float(value)
+    return r
+
+
+class ChangeFilter:
+    def __init__(self, thresholds=None, snapshot_interval=60, default_threshold=0):
+        """
+        :param thresholds: field -> minimum absolute change for numeric fields
+        :param snapshot_interval: seconds between full records, 0 = only the first one
+        :param default_threshold: for numeric fields without own threshold
+        """
+        self.thresholds = thresholds or {}
+        self.default_threshold = default_threshold
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_time = None
+        self.sent = {}  # last sent value per field
+
+    def filter(self, record, t=None):
+        """
+        :param record: dictionary
+        :return: full record (snapshot), changed fields only with '_delta': 1, or None if nothing changed
+        """
+        t = time.monotonic() if t is None else t
+        if self.snapshot_time is None or (self.snapshot_interval and t >= self.snapshot_time):
+            self.snapshot_time = t + self.snapshot_interval
+            self.sent = dict(record)
+            return record
+
+        changed = {}
+        sent = self.sent
+        for key, value in record.items():
+            last = sent.get(key)
+            if not isinstance(value, (int, float)) or not isinstance(last, (int, float)):  # None, str, dict, ...
+                if value == last:
+                    continue
+            elif abs(value - last) <= self.thresholds.get(key, self.default_threshold):
+                continue
+            changed[key] = value
+            sent[key] = value
+        if not changed:
+            return None
+        changed['_delta'] = 1  # consumers merge it into the last snapshot
+        return changed
+
+
+class WindowAggregator:
+    def __init__(self, fields, window):
+        """
+        :param fields: numeric fields to aggregate
+        :param window: seconds
+        """
+        self.fields = fields
+        self.window = window
+        self.start = None
+        self.count = 0
+        self.n = dict.fromkeys(fields, 0)
+        self.sum = dict.fromkeys(fields, 0.0)
+        self.min = dict.fromkeys(fields)
+        self.max = dict.fromkeys(fields)
+
+    def add(self, record, t=None):
+        """
+        Add a sample, O(fields)
+
+        :return: aggregate of the finished window or None
+        """
+        t = time.monotonic() if t is None else t
+        result = None
+        if self.start is None:
+            self.start = t
+        elif t - self.start >= self.window:
+            result = self.result(t)
+            self.reset(t)
+
+        self.count += 1
+        for key in self.fields:
+            value = record.get(key)
+            if value is None:
+                continue
+            self.n[key] += 1
+            self.sum[key] += value
+            if self.min[key] is None or value < self.min[key]:
+                self.min[key] = value
+            if self.max[key] is None or value > self.max[key]:
+                self.max[key] = value
+        return result
+
+    def result(self, t):
+        r = {'window': round(t - self.start, 1), 'samples': self.count}
+        for key in self.fields:
+            if self.n[key]:
+                r[f'{key}_mean'] = round(self.sum[key] / self.n[key], 3)
+                r[f'{key}_min'] = self.min[key]
+                r[f'{key}_max'] = self.max[key]
+        return r
+
+    def reset(self, t):
+        self.start = t
+        self.count = 0
+        for key in self.fields:
+            self.n[key] = 0
+            self.sum[key] = 0.0
+            self.min[key] = None
+            self.max[key] = None
@@ -36,11 +36,16 @@
 import binascii
 import serial
 import paho.mqtt.client as mqtt
-import json
 import configparser
 #from Crypto.Cipher import AES
 from Cryptodome.Cipher import AES
 import argparse
+import time
+import logging
+from fastlink import SampleSender
+from payload_codec import make_encoder
+
+log = logging.getLogger(__name__)
 
 
 ##CRC-STUFF BEGIN
@@ -76,10 +81,9 @@ def verify_crc16(input, skip=0, last=2, cut=0):
 
 ##DECODE-STUFF BEGIN
 
-def decode_packet(input):  ##expects input to be bytearray.fromhex(hexstring), full packet  "7ea067..7e"
+def decode_packet(input, key, device):  ##expects input to be bytearray.fromhex(hexstring), full packet  "7ea067..7e"
  #   if verify_crc16(input, 1, 2, 1):
     if True:
-        global device
         if device=='WN350': add=2
         else: add=0
         nonce=bytes(input[14+add:22+add]+input[24+add:28+add])  #systemTitle+invocation counter
@@ -95,9 +99,8 @@ def bytes_to_int(bytes):
         result = result * 256 + b
     return result
 
-def show_data(s):
+def show_data(s, device):
     ret=""
-    global device
     if device=='WN' or device=='WN350':
         if device=='WN350': add=18
         else: add=0
@@ -137,8 +140,7 @@ def show_data(s):
 
 
 
-def get_data(s):
-    global device
+def get_data(s, device):
     if device=='WN' or device=='WN350':
         if device=='WN350': add=18
         else: add=0
@@ -175,72 +177,107 @@ def get_data(s):
         return None 
     return (a,b,e,f)
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--config", help="config.ini file", default="config.ini")
-args = parser.parse_args()
-
-config = configparser.ConfigParser()
-config.read(args.config)
-key=config['SMARTMETER']['aes_key']
-device=config['SMARTMETER']['country_code']
-
-client = mqtt.Client("smartmeter")
-
-if config['MQTT'].get('user'):
-    client.username_pw_set(config['MQTT']['user'], config['MQTT']['password'])
-client.connect(config['MQTT']['host'], int(config['MQTT']['port']))
-client.loop_start()
-
-while 1:
-    print("opening serial interface")
-    try:
-        ser=serial.Serial(config['SMARTMETER']['serial_port'], baudrate=int(config['SMARTMETER']['serial_baudrate']), timeout=1)
-    #ser=serial.Serial("/dev/ttyACM0",baudrate=115200)
-#        outfile=open("out.txt", mode="a")
-
-        count=0
-        while(1):
-
-            junk1=ser.read_until(expected=b'\x7e')
-            junk2=ser.read_until(expected=b'\xa0')
-        
-            data=ser.read(119)
-        
-            data2=b'\x7e\xa0'+data+b'\x7e'
-            dec=decode_packet(data2)
-            s=show_data(dec)
-            print(s)
-  
-            (sin, sout, pin, pout)=get_data(dec)
-            data={
-                "power_in": pin,
-                "power_out": pout,
-                "power": pin-pout,
-                "power_unit": "W",
-                "total_in": sin,
-                "total_out": sout,
-                "total_unit": "KWh",
-            }
-            print(data)
-            rc=client.publish(config['SMARTMETER']['TOPIC'], json.dumps(data))
-            print(rc)
-            dspl = {"title": "Smartmeter",
-                    "color": 24555,
-                    "main": {"unit": "W",
-                        "PwrSM": data["power"]
-                        },
-                    "stand": {
-                        "unit": "KWh",
-                        "In": "{:.1f}".format(data["sum_in"]),
-                        "Out": "{:.1f}".format(data["sum_out"])
-                        }
-                    }
-            client.publish("display", json.dumps(dspl))
-
-    except Exception as ex:
-        print(ex)
-        import time
-        time.sleep(1)
-    finally:
-        if ser:
-            ser.close()
+class SmartMeter:
+    """
+    Read and decode the smartmeter frames and publish them
+
+    run() returns only with an exception (serial port lost, ...), the caller reopens.
+    """
+    def __init__(self, config, mqtt_client, on_sample=None):
+        """
+        :param config: ConfigParser with [SMARTMETER]
+        :param mqtt_client: connected client
+        :param on_sample: optional function(t_frame, t_decoded, power_in, power_out, total_in, total_out) per frame,
+                          e.g. fastlink.SampleSender.send or a direct call into the controller
+        """
+        self.config = config
+        self.client = mqtt_client
+        self.on_sample = on_sample
+        self.key = config['SMARTMETER']['aes_key']
+        self.device = config['SMARTMETER']['country_code']
+        self.ser = None
+        self.count = 0
+        self.encoder = make_encoder(config['SMARTMETER'])
+
+    def close(self):
+        if self.ser:
+            self.ser.close()
+        self.ser = None
+
+    def run(self):
+        config = self.config
+        log.info("opening serial interface")
+        self.ser=serial.Serial(config['SMARTMETER']['serial_port'], baudrate=int(config['SMARTMETER']['serial_baudrate']), timeout=1)
+        try:
+            while True:
+                self.read_frame()
+        finally:
+            self.close()
+
+    def read_frame(self):
+        ser = self.ser
+        junk1=ser.read_until(expected=b'\x7e')
+        junk2=ser.read_until(expected=b'\xa0')
+
+        data=ser.read(119)
+        t_frame=time.monotonic()
+
+        data2=b'\x7e\xa0'+data+b'\x7e'
+        dec=decode_packet(data2, self.key, self.device)
+        (sin, sout, pin, pout)=get_data(dec, self.device)
+        t_decoded=time.monotonic()
+        if self.on_sample:
+            self.on_sample(t_frame, t_decoded, pin, pout, sin, sout)
+        log.debug(show_data(dec, self.device))
+
+        self.count+=1
+        data={
+            "power_in": pin,
+            "power_out": pout,
+            "power": pin-pout,
+            "power_unit": "W",
+            "total_in": sin,
+            "total_out": sout,
+            "total_unit": "KWh",
+            # latency trace stamps, see latency_trace.py
+            "trace": {"id": self.count, "frame": t_frame, "decoded": t_decoded, "published": time.monotonic()},
+        }
+        log.debug(data)
+        rc=self.encoder.publish(self.client, self.config['SMARTMETER']['TOPIC'], data)
+        log.debug(rc)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="config.ini file", default="config.ini")
+    parser.add_argument("-v", "--verbose", help="print every frame", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+
+    client = mqtt.Client("smartmeter")
+
+    if config['MQTT'].get('user'):
+        client.username_pw_set(config['MQTT']['user'], config['MQTT']['password'])
+    client.connect(config['MQTT']['host'], int(config['MQTT']['port']))
+    client.loop_start()
+
+    # optional direct transport to update_setpoint.py on the same host
+    fastlink=None
+    if config['SMARTMETER'].get('fastlink_socket'):
+        fastlink=SampleSender(config['SMARTMETER']['fastlink_socket'])
+
+    smartmeter=SmartMeter(config, client, on_sample=fastlink.send if fastlink else None)
+    while 1:
+        try:
+            smartmeter.run()
+        except Exception as ex:
+            log.error(ex)
+            time.sleep(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+
+import argparse
+import array
+import configparser
+import logging
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from archive import parse_sources
+from mqtt_dispatch import Dispatcher
+from payload_codec import PayloadDecoder, PayloadEncoder, make_encoder
+
+"""
+Multi resolution rollups of the telemetry topics for dashboards
+
+Per source and resolution (1s, 10s, 1m, 15m) mean/min/max/last of every numeric field. The accumulators are
+preallocated arrays (resolutions x max_fields), a sample costs one update per field and resolution, nothing
+grows with time. Buckets are aligned to the clock (15m = quarter hours). A finished bucket is published on
+
+  <topic>/<source>/<resolution>   {"t": bucket start, "n": samples, "power_mean": .., "power_min": .., "power_max": ..,
+                                   "power_last": .., ...}
+
+[ROLLUP]
+topic=tele/rollup
+sources=smartmeter:SMARTMETER,victron:VICTRON,bms1:BMS1,mppt:MPPT     name:config section with topic
+"""
+
+log = logging.getLogger(__name__)
+
+RESOLUTIONS = (('1s', 1), ('10s', 10), ('1m', 60), ('15m', 900))
+
+
+class Rollup:
+    def __init__(self, resolutions=RESOLUTIONS, max_fields=64):
+        """
+        :param resolutions: ((label, seconds), ...)
+        :param max_fields: numeric fields per source, more are ignored
+        """
+        self.resolutions = resolutions
+        self.max_fields = max_fields
+        self.slots = {}  # field -> slot
+        self._ignored = set()
+        n = len(resolutions) * max_fields
+        self.sum = array.array('d', [0.0]) * n
+        self.count = array.array('l', [0]) * n
+        self.min = array.array('d', [float('inf')]) * n
+        self.max = array.array('d', [float('-inf')]) * n
+        self.last = array.array('d', [0.0]) * n
+        self.bucket = [None] * len(resolutions)  # current bucket number per resolution
+        self.samples = [0] * len(resolutions)
+
+    def _slot(self, key):
+        slot = self.slots.get(key)
+        if slot is None and len(self.slots) < self.max_fields:
+            slot = self.slots[key] = len(self.slots)
+        elif slot is None and key not in self._ignored:
+            self._ignored.add(key)
+            log.warning(f"rollup: more than {self.max_fields} fields, {key} ignored")
+        return slot
+
+    def result(self, k):
+        label, seconds = self.resolutions[k]
+        r = {'t': self.bucket[k] * seconds, 'n': self.samples[k]}
+        base = k * self.max_fields
+        for key, slot in self.slots.items():
+            i = base + slot
+            n = self.count[i]
+            if n:
+                r[f'{key}_mean'] = round(self.sum[i] / n, 3)
+                r[f'{key}_min'] = self.min[i]
+                r[f'{key}_max'] = self.max[i]
+                r[f'{key}_last'] = self.last[i]
+        return r
+
+    def reset(self, k, bucket):
+        base = k * self.max_fields
+        for i in range(base, base + len(self.slots)):
+            self.sum[i] = 0.0
+            self.count[i] = 0
+            self.min[i] = float('inf')
+            self.max[i] = float('-inf')
+        self.bucket[k] = bucket
+        self.samples[k] = 0
+
+    def tick(self, t):
+        """
+        :return: [(resolution label, result)] of the buckets finished before t
+        """
+        done = []
+        for k, (label, seconds) in enumerate(self.resolutions):
+            bucket = int(t // seconds)
+            if self.bucket[k] is not None and bucket != self.bucket[k]:
+                if self.samples[k]:
+                    done.append((label, self.result(k)))
+                self.reset(k, bucket)
+            elif self.bucket[k] is None:
+                self.bucket[k] = bucket
+        return done
+
+    def add(self, record, t=None):
+        """
+        Add a sample, finished buckets are returned (see tick)
+        """
+        t = time.time() if t is None else t
+        done = self.tick(t)
+        values = [(self._slot(key), float(value)) for key, value in record.items()
+                  if isinstance(value, (int, float)) and not isinstance(value, bool)]
+        for k in range(len(self.resolutions)):
+            self.samples[k] += 1
+            base = k * self.max_fields
+            for slot, value in values:
+                if slot is None:
+                    continue
+                i = base + slot
+                self.sum[i] += value
+                self.count[i] += 1
+                if value < self.min[i]:
+                    self.min[i] = value
+                if value > self.max[i]:
+                    self.max[i] = value
+                self.last[i] = value
+        return done
+
+
+class RollupService:
+    def __init__(self, config, client, dispatcher=None):
+        """
+        :param config: ConfigParser with [ROLLUP]
+        :param client: connected mqtt client (shared)
+        :param dispatcher: mqtt_dispatch.Dispatcher of the shared client, None = own one
+        """
+        self.section = config['ROLLUP'] if config.has_section('ROLLUP') else None
+        cfg = self.section or {}
+        self.client = client
+        self.dispatcher = dispatcher or Dispatcher(client)
+        self.topic = cfg.get('topic', 'tele/rollup')
+        self.decoder = PayloadDecoder()
+        self.sources = {}  # topic -> source name
+        for name, section in parse_sources(cfg.get('sources')):
+            if config.has_option(section, 'topic'):
+                self.sources[config[section]['topic']] = name
+        self.rollups = {name: Rollup() for name in self.sources.values()}
+        self.encoders = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def publish(self, source, done):
+        for label, result in done:
+            topic = f"{self.topic}/{source}/{label}"
+            encoder = self.encoders.get(topic)
+            if encoder is None:
+                encoder = self.encoders[topic] = make_encoder(self.section) if self.section else PayloadEncoder()
+            encoder.publish(self.client, topic, result)
+
+    def on_message(self, client, userdata, message):
+        try:
+            data = self.decoder.decode(message.topic, message.payload)
+            if isinstance(data, dict):
+                source = self.sources[message.topic]
+                with self.lock:
+                    done = self.rollups[source].add(data)
+                self.publish(source, done)
+        except Exception as ex:
+            log.error(f"{message.topic}: {ex}")
+
+    def subscribe(self):
+        for topic in list(self.sources) + [topic + '/schema' for topic in self.sources]:
+            self.dispatcher.subscribe(topic, self.on_message)
+        log.info(f"rollups of {', '.join(self.sources)} on {self.topic}")
+
+    def run(self):
+        """
+        Publish buckets of sources that stopped sending
+        """
+        self.subscribe()
+        while not self.stopped.wait(1):
+            t = time.time()
+            for source, rollup in self.rollups.items():
+                with self.lock:
+                    done = rollup.tick(t)
+                self.publish(source, done)
+
+    def close(self):
+        self.stopped.set()
+        self.dispatcher.remove(self.on_message)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="config.ini file", default="config.ini")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+
+    client = mqtt.Client("ROLLUP")
+    if config['MQTT'].get('user'):
+        client.username_pw_set(config['MQTT']['user'], config['MQTT']['password'])
+    client.connect(config['MQTT']['host'], int(config['MQTT']['port']))
+    client.loop_start()
+
+    RollupService(config, client).run()
+
+
+if __name__ == '__main__':
+    main()
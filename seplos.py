@@ -1,193 +1,216 @@
-import struct
 import serial
 import paho.mqtt.client as mqtt
 import json
 import time
 import configparser
 import argparse
-
-
-def get_frame_checksum(frame: bytes):
-   sum = 0
-   for byte in frame:
-       sum += byte
-   sum = ~sum
-   sum %= 0x10000
-   sum += 1
-   return sum
-
-
-def     get_chk_sum(data):
-    sum = 0
-    for byte in data:
-        sum += byte
-    sum = ~sum
-    sum &= 0xFFFF
-    sum += 1
-    return sum
-
-def read_and_send(shelf):
-
+import logging
+import seplos_codec
+from mqtt_dispatch import Dispatcher
+
+"""
+Seplos BMS (protocol 2.0, RS485) to mqtt
+
+The serial port and the mqtt connection are opened once and kept, shelves are polled by SeplosScheduler.
+The port is reopened only after a serial error, paho reconnects the broker in its loop thread.
+Frames are built and decoded by seplos_codec.
+"""
+
+log = logging.getLogger(__name__)
+
+
+class PollJob:
+    __slots__ = ('shelf', 'command', 'interval', 'next_time', 'failures')
+
+    def __init__(self, shelf, command, interval, next_time):
+        self.shelf = shelf
+        self.command = command
+        self.interval = interval
+        self.next_time = next_time
+        self.failures = 0
+
+
+class SeplosScheduler:
+    """
+    Poll plan for all shelves on the shared RS485 bus
+
+    Each (shelf, command) has its own interval, e.g. telemetry fast, alarms and manufacturer info slow.
+    RS485 is half duplex, so there is only one request on the bus at a time, the job with the earliest due
+    time goes next (telemetry first on equal times). A shelf that does not answer is backed off exponentially
+    (interval * 2^failures, at most max_backoff) so a dead pack costs one timeout per backoff period instead
+    of stalling every round.
+    """
+    def __init__(self, shelves, intervals, max_backoff=60):
+        t = time.monotonic()
+        self.max_backoff = max_backoff
+        self.jobs = [PollJob(shelf, command, interval, t)
+                     for command, interval in intervals.items() if interval
+                     for shelf in shelves]
+
+    def next_job(self):
+        """
+        :return: (job, seconds to wait until it is due)
+        """
+        job = min(self.jobs, key=lambda j: (j.next_time, j.command != seplos_codec.TELEMETRY))
+        return job, max(0, job.next_time - time.monotonic())
+
+    def done(self, job, ok):
+        t = time.monotonic()
+        if ok:
+            job.failures = 0
+            job.next_time = max(job.next_time + job.interval, t)  # keep the rate, don't catch up
+        else:
+            job.failures += 1
+            job.next_time = t + min(job.interval * 2 ** job.failures, max(self.max_backoff, job.interval))
+
+    def shelf_online(self, shelf):
+        return all(j.failures == 0 for j in self.jobs if j.shelf == shelf)
+
+
+class SeplosBMS:
+    def __init__(self, config, mqtt_client=None, section='BMS1', dispatcher=None):
+        """
+        :param config: ConfigParser with [MQTT] and [section]
+        :param mqtt_client: shared, connected client or None to create an own connection
+        :param section: config section with serial_port, serial_baudrate, topic
+        :param dispatcher: mqtt_dispatch.Dispatcher of the shared client
+        """
+        self.config = config
+        self.section = section
+        self.ser = None
+        self.client = mqtt_client
+        self.dispatcher = dispatcher
+        cfg = config[section]
+        self.shelves = [int(s) for s in cfg.get('shelves', '1,2,3').split(',')]
+        self.shelf_timeout = cfg.getfloat('shelf_timeout', fallback=1.0)
+        self.scheduler = SeplosScheduler(self.shelves,
+                                         {seplos_codec.TELEMETRY: cfg.getfloat('telemetry_interval', fallback=2),
+                                          seplos_codec.ALARMS: cfg.getfloat('alarm_interval', fallback=30),
+                                          seplos_codec.MANUFACTURER: cfg.getfloat('info_interval', fallback=3600)},
+                                         max_backoff=cfg.getfloat('max_backoff', fallback=60))
+        self.history = None
+        if cfg.get('history_cmd_topic'):
+            from cell_history import CellHistory
+            self.history = CellHistory(self.shelves, cells=cfg.getint('cells', fallback=16),
+                                       samples=cfg.getint('history_samples', fallback=25920),
+                                       interval=cfg.getfloat('history_interval', fallback=10))
+
+    def open(self):
+        self.ser = serial.Serial(self.config[self.section]['serial_port'],
+                                 baudrate=int(self.config[self.section]['serial_baudrate']),
+                                 timeout=self.shelf_timeout)
+        log.info(f"opened {self.ser.port}")
+
+    def close(self):
+        if self.dispatcher:
+            self.dispatcher.remove(self.on_query)
+        if self.ser:
+            try:
+                self.ser.close()
+            except Exception:
+                pass
+        self.ser = None
+
+    def connect_mqtt(self):
+        config = self.config
+        self.client = mqtt.Client(self.section)
+        if config['MQTT'].get('user'):
+            self.client.username_pw_set(config['MQTT']['user'], config['MQTT']['password'])
+        self.client.connect(config['MQTT']['host'], int(config['MQTT']['port']))
+        self.client.loop_start()  # keeps the connection, reconnects on failure
+
+    def subscribe_history(self):
+        cmd_topic = self.config[self.section]['history_cmd_topic']
+        if self.dispatcher is None:
+            self.dispatcher = Dispatcher(self.client)
+        self.dispatcher.subscribe(cmd_topic, self.on_query)
+        log.info(f"cell history queries on {cmd_topic}")
+
+    def on_query(self, client, userdata, message):
+        cfg = self.config[self.section]
+        self.history.on_query(client, cfg.get('history_topic', cfg['history_cmd_topic'] + '/result'), message.payload)
+
+    def topic(self, shelf, suffix=None):
+        topic=self.config[self.section]['topic']
+        if shelf>1:
+            topic=topic+"/"+str(shelf)
+        if suffix:
+            topic=topic+"/"+suffix
+        return topic
+
+    def request(self, shelf, command=seplos_codec.TELEMETRY):
+        """
+        Send one request and wait for the answer, at most shelf_timeout seconds
+
+        :return: decoded record
+        """
+        if self.ser is None:
+            self.open()
+        self.ser.reset_input_buffer()
+        self.ser.write(seplos_codec.REQUESTS[(shelf, command)])
+        raw_frame = self.ser.read_until(expected=b'\r')
+        if not raw_frame.endswith(b'\r'):
+            raise TimeoutError(f"shelf {shelf}: no answer to 0x{command:02X} within {self.shelf_timeout}s, got {raw_frame}")
+        log.debug(raw_frame)
+        return seplos_codec.decode(raw_frame, command)
+
+    def poll(self, shelf, command=seplos_codec.TELEMETRY):
+        """
+        Request one command of one shelf and publish it
+
+        :return: dictionary
+        """
+        record = self.request(shelf, command)
+        if self.history and command == seplos_codec.TELEMETRY:
+            self.history.add(shelf, record.cells, record.current)
+        data = record if isinstance(record, dict) else record.to_dict()
+        data['time'] = round(time.time(), 1)  # retained, a restarted controller can tell the age
+        if command == seplos_codec.TELEMETRY:
+            topic = self.topic(shelf)
+        elif command == seplos_codec.ALARMS:
+            topic = self.topic(shelf, 'alarms')
+        else:
+            topic = self.topic(shelf, 'info')
+        (rc,mqttid) = self.client.publish(topic, json.dumps(data), retain=True)
+        log.debug(f"Publish to {topic} RC: {rc}")
+        return data
+
+    def run(self):
+        if self.client is None:
+            self.connect_mqtt()
+        if self.history:
+            self.subscribe_history()
+        while True:
+            job, wait = self.scheduler.next_job()
+            if wait:
+                time.sleep(wait)
+            ok = False
+            try:
+                self.poll(job.shelf, job.command)
+                ok = True
+            except (serial.SerialException, OSError) as ex:
+                if isinstance(ex, TimeoutError):
+                    log.warning(ex)
+                else:
+                    log.error(f"serial port failed: {ex}")
+                    self.close()  # reopen with the next request
+            except Exception as ex:
+                log.error(f"shelf {job.shelf} cmd 0x{job.command:02X}: {ex}")
+            self.scheduler.done(job, ok)
+
+
+def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", help="config.ini file", default="config.ini")
     args = parser.parse_args()
 
+    logging.basicConfig(level=logging.INFO)
+
     config = configparser.ConfigParser()
     config.read(args.config)
 
-    try:
-        ser=serial.Serial(config['BMS1']['serial_port'], baudrate=int(config['BMS1']['serial_baudrate']), timeout=1)
-
-        client = mqtt.Client("BMS1")
-
-        if config['MQTT'].get('user'):
-            client.username_pw_set(config['MQTT']['user'], config['MQTT']['password'])
-        client.connect(config['MQTT']['host'], int(config['MQTT']['port']))
-
-        bms_data={}
-
-
-
-
-        seplos_get_protocol_version="~2001464F0000FD99$"
-        # ~ 
-        # 20 Protocol Version 2.0
-        # 01 Device Address 01
-        # 46 4F LiFePO4 BMS, 4FAcquisition of the communication protocol version number
-        # 00 00 length
-        # FD 99 Checksum
-        # $ End of Frame
-        seplos_get_manufacturer="~200246510000FDAC\n"
-        seplos_get_telemetry_data="~20014642E00201FD35$"
-        seplos_get_remote_communication_data="~20014644E00201FD33$"
-        # x=b'\x7E\x32\x30\x30\x32\x34\x36\x34\x32\x45\x30\x30\x32\x30\x32\x46\x44\x33\x33\x0D'
-        # y=b'\x7E\x32\x30\x30\x32\x34\x36\x34\x32\x45\x30\x30\x32\x30\x32'
-
-  
-        seplos_get_data=f"200{shelf}4642E0020{shelf}".encode()
-        chksum = get_chk_sum(seplos_get_data)
-        package = ("~" + seplos_get_data.decode() + "{:04X}".format(chksum) + "\r").encode()
-        # print(package)
-        # cs=""
-        # for b in package:
-        #     cs+=hex(b)+","
-        # print(cs)
-
-
-        
-
-
-   #     seplos_cmd='~20004642E00201FD36\r\n'.encode()
-     #   seplos_cmd=seplos_get_manufacturer.encode()
-        seplos_cmd=package
-        print(seplos_cmd)
-        ser.write(seplos_cmd)
-        print("waiting for answer")
-        #raw_frame=ser.readline()
-#        raw_frame=ser.read_until(expected='\r')
-        raw_frame=ser.read_until(expected='$')
-        print(raw_frame)
-        frame_data = raw_frame[1:len(raw_frame) - 5]
-        frame_chksum = raw_frame[len(raw_frame) - 5:-1]
-
-        got_frame_checksum=get_frame_checksum(frame_data)
-        assert got_frame_checksum == int(frame_chksum, 16)
-
-
-        fmt=">2s2sHHI"
-        ver, adr, cid1, cid2, infolength = struct.unpack(fmt, frame_data[:struct.calcsize(fmt)])
-        print(f"ver {ver}, adr {adr}, cid1 0x{cid1:02x}, cid2 0x{cid2:02x}, infolength 0x{infolength:02x}")
-        infolength1=(infolength & 0xFFF0) >> 4
-        print(infolength1)
-        print(f"infolength1 {infolength1}")
-        print(f"start of data {struct.calcsize(fmt)}")
-        info=frame_data[struct.calcsize(fmt):]
-
-        print(info)
-        info=bytearray.fromhex(info.decode())
-        print(info)
-        fmt=">xxB"
-        (number_of_cells,) = struct.unpack(fmt, info[:3])
-
-        start=3
-        
-        cell_low=0xFFFF
-        cell_high=0
-        for i in range(0, number_of_cells):
-            (voltage,) = struct.unpack(">H", info[start+i*2:start+2+i*2])
-            voltage=voltage/1000.0
-            print(f"cell{i}: {voltage}")
-            bms_data[f"cell{i+1}_voltage"]=voltage
-            cell_low=min(cell_low, voltage)
-            cell_high=max(cell_high, voltage)
-        
-        bms_data['cell_low']=cell_low
-        bms_data['cell_high']=cell_high
-        bms_data['cell_diff']=round(cell_high-cell_low, 4)
-        
-        start+=number_of_cells*2
-        start+=1
-        temp_list=[]
-        for i in range(0, 6):
-            (temp,) = struct.unpack(">H", info[start+i*2:start+2+i*2])
-            temp=(temp-2731)/10.0
-            print(f"temp{i}: {temp}")
-            temp_list.append(temp)
-
-        bms_data['cellblock1_temp']=temp_list[0]
-        bms_data['cellblock2_temp']=temp_list[1]
-        bms_data['cellblock3_temp']=temp_list[2]
-        bms_data['cellblock4_temp']=temp_list[3]
-        bms_data['environment_temp']=temp_list[4]
-        bms_data['power_temp']=temp_list[5]
-
-
-        start+=6*2
-        (current, voltage, capacity_residual, capacity_total, soc, rated_capacity, number_of_cycle, soh, port_voltage) = struct.unpack(">HHHxHHHHHH", info[start:start+19])
-        current/=100
-        voltage/=100
-        capacity_residual/=100
-        capacity_total/=100
-        rated_capacity/=100
-        soh/=10
-        soc/=10
-        port_voltage/=100
-        print(f"current: {current}, voltage: {voltage}, capacity_residual: {capacity_residual}, capacity_total: {capacity_total}, soc: {soc}, rated_capacity: {rated_capacity}")
-        print(f"number_of_cycle {number_of_cycle}, soh {soh} port_voltage {port_voltage}")
-
-        print(f"number_of_cells: {number_of_cells}")
-
-        print(info[:5])
-
-        bms_data['current']=current
-        bms_data['voltage']=voltage
-        bms_data['capacity_residual']=capacity_residual
-        bms_data['capacity_total']=capacity_total
-        bms_data['soc']=soc
-        bms_data['rated_capacity']=rated_capacity
-        bms_data['number_of_cycle']=number_of_cycle
-        bms_data['soh']=soh
-        bms_data['port_voltage']=port_voltage
-
-        print(json.dumps(bms_data))
-        topic=config['BMS1']['topic']
-        if shelf>1:
-            topic=topic+"/"+str(shelf)
-        (rc,mqttid) = client.publish(topic, json.dumps(bms_data))
-        print(f"Publish to {topic} RC: {rc}")
-
-    except Exception as ex:
-        print(ex)
-        time.sleep(10)
-    finally:
-        if ser:
-            ser.close()
-        if client:
-            client.disconnect()
+    SeplosBMS(config).run()
 
 
 if __name__ == '__main__':
-    while True:
-        for shelf in range(1, 4):
-            read_and_send(shelf)
-    #    time.sleep(10)
+    main()
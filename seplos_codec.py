@@ -0,0 +1,288 @@
+#!/usr/bin/python3
+
+import argparse
+import struct
+import time
+
+"""
+Seplos BMS protocol 2.0 codec
+
+Frame (ASCII hex between SOI and EOI):
+
+~ <VER 2> <ADR 2> <CID1 2> <CID2 2> <LENGTH 4> <INFO n> <CHKSUM 4> \\r
+
+LENGTH  = LCHKSUM (1 nibble) + LENID (12 bit, number of INFO characters)
+LCHKSUM = two's complement of the sum of the LENID nibbles (modulo 16)
+CHKSUM  = two's complement of the sum of all characters between SOI and CHKSUM (modulo 65536)
+CID2    = command in requests, return code in responses (00 = ok)
+
+Requests are prebuilt for every address and command, responses are validated with one sum() over the
+bytes and decoded with precompiled structs into typed records.
+"""
+
+VERSION = b'20'
+CID1 = b'46'  # LiFePO4 BMS
+
+TELEMETRY = 0x42
+ALARMS = 0x44
+PARAMETERS = 0x47
+MANUFACTURER = 0x51
+
+TEMPERATURE_NAMES = ('cellblock1_temp', 'cellblock2_temp', 'cellblock3_temp', 'cellblock4_temp',
+                     'environment_temp', 'power_temp')
+
+
+class SeplosError(Exception):
+    pass
+
+
+def checksum(data):
+    return -sum(data) & 0xFFFF
+
+
+def length_field(lenid):
+    lchksum = -((lenid & 0xF) + ((lenid >> 4) & 0xF) + ((lenid >> 8) & 0xF)) & 0xF
+    return b'%04X' % (lchksum << 12 | lenid)
+
+
+def build_frame(address, cid2, info=b'', cid1=CID1):
+    body = VERSION + b'%02X' % address + cid1 + b'%02X' % cid2 + length_field(len(info)) + info
+    return b'~' + body + b'%04X' % checksum(body) + b'\r'
+
+
+def build_request(address, command):
+    # telemetry / alarms / parameters address the pack in INFO, manufacturer info has no INFO
+    info = b'' if command == MANUFACTURER else b'%02X' % address
+    return build_frame(address, command, info)
+
+
+REQUESTS = {(address, command): build_request(address, command)
+            for address in range(0, 16) for command in (TELEMETRY, ALARMS, PARAMETERS, MANUFACTURER)}
+
+
+def validate_frame(frame):
+    """
+    Check SOI/EOI, checksum, length and return code
+
+    :param frame: b'~...\\r' as read from the port
+    :return: (address, INFO as bytes)
+    """
+    if len(frame) < 18 or frame[0] != 0x7E or frame[-1] != 0x0D:
+        raise SeplosError(f"invalid frame {frame[:20]}")
+    body = frame[1:-5]
+    try:
+        if checksum(body) != int(frame[-5:-1], 16):
+            raise SeplosError(f"invalid checksum {frame[-5:-1]}")
+        address = int(body[2:4], 16)
+        rtn = int(body[6:8], 16)
+        length = int(body[8:12], 16)
+    except ValueError:
+        raise SeplosError(f"invalid frame {frame[:20]}")
+    if rtn:
+        raise SeplosError(f"return code 0x{rtn:02X}")
+    lenid = length & 0xFFF
+    if length_field(lenid) != body[8:12].upper() or lenid != len(body) - 12:
+        raise SeplosError(f"invalid length {body[8:12]}")
+    try:
+        return address, bytes.fromhex(body[12:].decode())
+    except ValueError:
+        raise SeplosError("invalid info")
+
+
+_cell_structs = {}
+
+
+def _words(n, signed=False):
+    key = (n, signed)
+    s = _cell_structs.get(key)
+    if s is None:
+        s = _cell_structs[key] = struct.Struct(f">{n}{'h' if signed else 'H'}")
+    return s
+
+
+PACK = struct.Struct(">hHHxHHHHHH")  # current .. port_voltage, x = number of custom values
+
+
+class SeplosTelemetry:
+    __slots__ = ('address', 'cells', 'temperatures', 'current', 'voltage', 'capacity_residual', 'capacity_total',
+                 'soc', 'rated_capacity', 'number_of_cycle', 'soh', 'port_voltage')
+
+    @property
+    def cell_low(self):
+        return min(self.cells)
+
+    @property
+    def cell_high(self):
+        return max(self.cells)
+
+    def to_dict(self):
+        """
+        Flat dictionary as published on mqtt
+        """
+        r = {f"cell{i + 1}_voltage": v for i, v in enumerate(self.cells)}
+        cell_low = min(self.cells)
+        cell_high = max(self.cells)
+        r['cell_low'] = cell_low
+        r['cell_high'] = cell_high
+        r['cell_diff'] = round(cell_high - cell_low, 4)
+        for i, t in enumerate(self.temperatures):
+            r[TEMPERATURE_NAMES[i] if i < len(TEMPERATURE_NAMES) else f"temp{i + 1}"] = t
+        for key in ('current', 'voltage', 'capacity_residual', 'capacity_total', 'soc', 'rated_capacity',
+                    'number_of_cycle', 'soh', 'port_voltage'):
+            r[key] = getattr(self, key)
+        return r
+
+
+def decode_telemetry(info):
+    """
+    INFO of a 0x42 response
+
+    <DATAFLAG> <ADR> <cells M> M*<mV> <temps N> N*<0.1K> <current 0.01A signed> <voltage 0.01V>
+    <residual 0.01Ah> <custom P> <capacity 0.01Ah> <soc 0.1%> <rated 0.01Ah> <cycles> <soh 0.1%> <port 0.01V> ...
+    """
+    try:
+        r = SeplosTelemetry()
+        r.address = info[1]
+        n = info[2]
+        pos = 3
+        r.cells = tuple(v / 1000 for v in _words(n).unpack_from(info, pos))
+        pos += 2 * n
+        n = info[pos]
+        pos += 1
+        r.temperatures = tuple((v - 2731) / 10 for v in _words(n).unpack_from(info, pos))
+        pos += 2 * n
+        (current, voltage, residual, capacity, soc, rated, cycles, soh, port) = PACK.unpack_from(info, pos)
+    except (IndexError, struct.error) as e:
+        raise SeplosError(f"telemetry too short: {e}")
+    r.current = current / 100
+    r.voltage = voltage / 100
+    r.capacity_residual = residual / 100
+    r.capacity_total = capacity / 100
+    r.soc = soc / 10
+    r.rated_capacity = rated / 100
+    r.number_of_cycle = cycles
+    r.soh = soh / 10
+    r.port_voltage = port / 100
+    return r
+
+
+class SeplosAlarms:
+    """
+    Alarm codes: 0x00 normal, 0x01 below lower limit, 0x02 above upper limit, 0xF0 other
+    """
+    __slots__ = ('address', 'cells', 'temperatures', 'charge_current', 'voltage', 'discharge_current', 'status')
+
+    @property
+    def active(self):
+        r = [f"cell{i + 1}" for i, a in enumerate(self.cells) if a]
+        r += [f"temp{i + 1}" for i, a in enumerate(self.temperatures) if a]
+        r += [k for k in ('charge_current', 'voltage', 'discharge_current') if getattr(self, k)]
+        return r
+
+    def to_dict(self):
+        return {'cell_alarms': list(self.cells),
+                'temp_alarms': list(self.temperatures),
+                'charge_current_alarm': self.charge_current,
+                'voltage_alarm': self.voltage,
+                'discharge_current_alarm': self.discharge_current,
+                'status': self.status.hex(),
+                'active': self.active}
+
+
+def decode_alarms(info):
+    """
+    INFO of a 0x44 response
+
+    <DATAFLAG> <ADR> <cells M> M*<alarm> <temps N> N*<alarm> <charge current> <voltage> <discharge current> <status ...>
+    """
+    try:
+        r = SeplosAlarms()
+        r.address = info[1]
+        n = info[2]
+        r.cells = tuple(info[3:3 + n])
+        pos = 3 + n
+        n = info[pos]
+        r.temperatures = tuple(info[pos + 1:pos + 1 + n])
+        pos += 1 + n
+        r.charge_current, r.voltage, r.discharge_current = info[pos:pos + 3]
+        r.status = bytes(info[pos + 3:])
+    except (IndexError, ValueError) as e:
+        raise SeplosError(f"alarms too short: {e}")
+    return r
+
+
+def decode_manufacturer(info):
+    """
+    INFO of a 0x51 response: <device name 20> <software version 2> <manufacturer 20>
+    """
+    return {'device_name': info[0:20].decode('ascii', 'replace').strip('\x00 '),
+            'software_version': f"{info[20]}.{info[21]}" if len(info) >= 22 else None,
+            'manufacturer': info[22:42].decode('ascii', 'replace').strip('\x00 ')}
+
+
+def decode_parameters(info):
+    """
+    INFO of a 0x47 response, layout depends on the firmware, passed on as hex
+    """
+    return {'parameters': info.hex()}
+
+
+DECODERS = {TELEMETRY: decode_telemetry,
+            ALARMS: decode_alarms,
+            PARAMETERS: decode_parameters,
+            MANUFACTURER: decode_manufacturer}
+
+
+def decode(frame, command=TELEMETRY):
+    """
+    Validate a response frame and decode its INFO
+
+    :return: typed record (SeplosTelemetry, SeplosAlarms) or dictionary
+    """
+    address, info = validate_frame(frame)
+    return DECODERS[command](info)
+
+
+def encode_telemetry(address, cells, temperatures, current, voltage, residual, capacity, soc, rated, cycles, soh,
+                     port_voltage):
+    """
+    Response frame for tests and the benchmark, inverse of decode_telemetry
+    """
+    info = bytes((0x00, address, len(cells)))
+    info += _words(len(cells)).pack(*[round(v * 1000) for v in cells])
+    info += bytes((len(temperatures),)) + _words(len(temperatures)).pack(*[round(t * 10 + 2731) for t in temperatures])
+    info += struct.pack(">hHHBHHHHHH", round(current * 100), round(voltage * 100), round(residual * 100), 10,
+                        round(capacity * 100), round(soc * 10), round(rated * 100), cycles, round(soh * 10),
+                        round(port_voltage * 100))
+    info += bytes(4)
+    return build_frame(address, 0x00, info.hex().upper().encode())
+
+
+def bench(frames, n):
+    t = time.perf_counter()
+    for i in range(n):
+        for frame in frames:
+            decode(frame).to_dict()
+    dt = time.perf_counter() - t
+    count = n * len(frames)
+    print(f"{count} frames in {dt:.3f}s: {dt / count * 1e6:.1f} us/frame")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seplos codec benchmark')
+    parser.add_argument('--frames', help='file with captured telemetry frames, one per line', default=None)
+    parser.add_argument('--n', help='iterations', type=int, default=10000)
+    args = parser.parse_args()
+
+    if args.frames:
+        with open(args.frames, 'rb') as f:
+            frames = [line.strip() + b'\r' for line in f if line.strip()]
+    else:
+        frames = [encode_telemetry(1, [3.301 + i / 1000 for i in range(16)], [21.5, 21.7, 22.0, 21.9, 20.1, 25.3],
+                                   -12.34, 53.12, 150.5, 280.0, 53.7, 280.0, 123, 100.0, 53.1)]
+    print(decode(frames[0]).to_dict())
+    bench(frames, args.n)
+
+
+if __name__ == '__main__':
+    main()
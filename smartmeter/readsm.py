@@ -59,18 +59,7 @@ while 1:
             rc=client.publish('tele/smartmeter/state', json.dumps(data))
 
 
-            dspl = {"title": "Smartmeter",
-                    "color": 24555,
-                    "main": {"unit": "W",
-                        "PwrSM": data["power"]
-                        },
-                    "stand": {
-                        "unit": "KWh",
-                        "In": "{:.1f}".format(data["total_in"]),
-                        "Out": "{:.1f}".format(data["total_out"])
-                    }
-                    }
-            client.publish("display", json.dumps(dspl))
+            # display page: display.py
             
 
   
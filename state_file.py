@@ -0,0 +1,77 @@
+import json
+import logging
+import os
+import threading
+import time
+
+"""
+Small json state file, written atomically at a bounded rate
+
+save() writes to <path>.tmp, fsyncs and renames it over <path>, a crash leaves the old or the new file, never
+a partial one. Between two writes are at least min_interval seconds (the sd card of a Pi does not like a
+write per second), force=True writes anyway (shutdown). The caller's state is copied in save(), the file is
+written in a thread (an fsync can take long on an sd card), force=True writes synchronously.
+"""
+
+log = logging.getLogger(__name__)
+
+
+class StateFile:
+    def __init__(self, path, min_interval=10):
+        self.path = path
+        self.min_interval = min_interval
+        self.save_time = None
+        self.saved_at = 0  # saved_at of the file on disk
+        self.lock = threading.Lock()  # one writer of <path>.tmp
+
+    def save(self, state, force=False):
+        """
+        :param state: json serializable dictionary of plain values, copied here, 'saved_at' is added
+        :param force: ignore min_interval and write before returning
+        :return: True if written (force) or the write was started
+        """
+        t = time.monotonic()
+        if not force and self.save_time is not None and t - self.save_time < self.min_interval:
+            return False
+        self.save_time = t
+        snapshot = dict(state, saved_at=time.time())
+        if force:
+            return self._write(snapshot)
+        threading.Thread(target=self._write, args=(snapshot,), name='state-save', daemon=True).start()
+        return True
+
+    def _write(self, snapshot):
+        tmp = self.path + '.tmp'
+        with self.lock:
+            if snapshot['saved_at'] < self.saved_at:  # a newer state was written first
+                return False
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump(snapshot, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+            except OSError as ex:
+                log.warning(f"unable to save state {self.path}: {ex}")
+                return False
+            self.saved_at = snapshot['saved_at']
+        return True
+
+    def load(self, max_age=None):
+        """
+        :param max_age: seconds, older states are ignored
+        :return: dictionary or None
+        """
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as ex:
+            log.warning(f"unable to load state {self.path}: {ex}")
+            return None
+        age = time.time() - state.get('saved_at', 0)
+        if max_age is not None and age > max_age:
+            log.info(f"state {self.path} too old ({age:.0f}s), ignored")
+            return None
+        return state
@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import configparser
+import json
+import logging
+import logging.config
+import signal
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from mqtt_dispatch import Dispatcher
+
+"""
+Run smartmeter, Seplos BMS, VE.Direct (MPPT), the MultiPlus setpoint control and the display in one process
+
+One interpreter and one mqtt connection instead of readsm.py, seplos.py, mppt_to_mqtt.py and update_setpoint.py.
+Every component is an asyncio task that starts the blocking reader (serial ports) in a daemon thread and
+restarts it with exponential backoff (1s .. max_backoff) if it fails. The smartmeter samples are passed to
+SetPoint.update_sm_power directly, without mqtt or fastlink.
+
+[SUPERVISOR]
+components=smartmeter,bms,mppt,setpoint,display
+bms_sections=BMS1
+mppt_sections=MPPT
+status_topic=tele/supervisor/state    state, restarts and last error per component every status_interval s
+"""
+
+log = logging.getLogger(__name__)
+
+
+def run_in_thread(func, name):
+    """
+    Run a blocking function in a daemon thread (the process can exit while a serial read blocks)
+
+    :return: future with the result or the exception of func
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def done(setter, value):
+        if not future.done():
+            setter(value)
+
+    def target():
+        try:
+            result = func()
+        except BaseException as ex:
+            loop.call_soon_threadsafe(done, future.set_exception, ex)
+        else:
+            loop.call_soon_threadsafe(done, future.set_result, result)
+
+    threading.Thread(target=target, name=name, daemon=True).start()
+    return future
+
+
+class Component:
+    def __init__(self, name, factory, max_backoff=60):
+        """
+        :param name: for logging and status
+        :param factory: function() -> object with a blocking run() and optional close(), called again on restart
+        :param max_backoff: longest pause between restarts [s]
+        """
+        self.name = name
+        self.factory = factory
+        self.max_backoff = max_backoff
+        self.worker = None
+        self.state = 'init'
+        self.restarts = 0
+        self.last_error = None
+        self.started = None
+
+    def close(self):
+        close = getattr(self.worker, 'close', None)
+        if close:
+            try:
+                close()
+            except Exception as ex:
+                log.debug(f"{self.name}: close {ex}")
+        self.worker = None
+
+    async def supervise(self):
+        backoff = 1
+        while True:
+            self.state = 'starting'
+            self.started = time.monotonic()
+            try:
+                self.worker = await run_in_thread(self.factory, f"{self.name}-init")
+                self.state = 'running'
+                log.info(f"{self.name}: running")
+                await run_in_thread(self.worker.run, self.name)
+                self.last_error = 'stopped'
+                log.warning(f"{self.name}: stopped")
+            except asyncio.CancelledError:
+                self.close()
+                raise
+            except Exception as ex:
+                self.last_error = f"{type(ex).__name__}: {ex}"
+                log.error(f"{self.name}: {self.last_error}", exc_info=True)
+            self.close()
+            if time.monotonic() - self.started > 10 * self.max_backoff:  # ran for a long time, start fast again
+                backoff = 1
+            self.state = 'backoff'
+            self.restarts += 1
+            log.info(f"{self.name}: restart in {backoff}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def status(self):
+        return {'state': self.state,
+                'restarts': self.restarts,
+                'uptime': round(time.monotonic() - self.started) if self.state == 'running' else 0,
+                'last_error': self.last_error}
+
+
+class SetPointWorker:
+    """
+    Control loop of update_setpoint.py, driven by the smartmeter component and the subscribed topics
+    """
+    def __init__(self, config, client, direct_smartmeter, dispatcher):
+        import update_setpoint
+        self.set_point = update_setpoint.SetPoint(client, config)
+        self.dispatcher = dispatcher
+        self.on_message = update_setpoint.on_message
+        client.user_data_set(self.set_point)
+        update_setpoint.subscribe(client, self.set_point, config, smartmeter=not direct_smartmeter, dispatcher=dispatcher)
+        self.stopped = threading.Event()
+
+    def run(self):
+        self.stopped.wait()
+
+    def close(self):
+        self.stopped.set()
+        self.dispatcher.remove(self.on_message)
+        if self.set_point.state_file:
+            self.set_point.state_file.save(self.set_point.state(), force=True)
+        # a restarted worker opens the MK3 port again
+        vebus = self.set_point.mp2.vebus
+        if vebus.serial:
+            vebus.serial.close()
+            vebus.serial = None
+
+
+class Supervisor:
+    def __init__(self, config):
+        self.config = config
+        self.components = []
+        self.setpoint = None
+        self.samples = 0
+        cfg = config['SUPERVISOR'] if config.has_section('SUPERVISOR') else {}
+        self.enabled = [c.strip() for c in cfg.get('components', 'smartmeter,bms,mppt,setpoint,display').split(',')]
+        self.max_backoff = float(cfg.get('max_backoff', 60))
+        self.status_topic = cfg.get('status_topic')
+        self.status_interval = float(cfg.get('status_interval', 60))
+
+        # clean_session=False: the broker keeps the subscriptions of all components over a reconnect
+        self.client = mqtt.Client("SUPERVISOR", clean_session=False)
+        if config['MQTT'].get('user'):
+            self.client.username_pw_set(config['MQTT']['user'], config['MQTT']['password'])
+        # components register their topics here, paho keeps one callback per topic
+        self.dispatcher = Dispatcher(self.client)
+
+        self.add_components(cfg)
+        if config.has_section('METRICS'):
+            import metrics
+            metrics.REGISTRY.gauge_func('supervisor_component_running', 'component running',
+                                        lambda: {c.name: c.state == 'running' for c in self.components}, ('component',))
+            metrics.REGISTRY.gauge_func('supervisor_component_restarts', 'restarts of a component',
+                                        lambda: {c.name: c.restarts for c in self.components}, ('component',))
+
+    def add(self, name, factory):
+        self.components.append(Component(name, factory, self.max_backoff))
+
+    def add_components(self, cfg):
+        config = self.config
+        client = self.client
+        dispatcher = self.dispatcher
+        direct = 'smartmeter' in self.enabled and 'setpoint' in self.enabled
+
+        if 'setpoint' in self.enabled:
+            def setpoint():
+                self.setpoint = SetPointWorker(config, client, direct, dispatcher)
+                return self.setpoint
+            self.add('setpoint', setpoint)
+
+        if 'smartmeter' in self.enabled:
+            def smartmeter():
+                import readsm
+                return readsm.SmartMeter(config, client, on_sample=self.on_smartmeter_sample if direct else None)
+            self.add('smartmeter', smartmeter)
+
+        if 'bms' in self.enabled:
+            for section in cfg.get('bms_sections', 'BMS1').split(','):
+                def bms(section=section.strip()):
+                    import seplos
+                    return seplos.SeplosBMS(config, client, section, dispatcher)
+                self.add(section.strip(), bms)
+
+        if 'display' in self.enabled:
+            def display():
+                import display
+                return display.Display(config, client, dispatcher)
+            self.add('display', display)
+
+        if 'archive' in self.enabled:
+            def archive():
+                import archive
+                return archive.Archive(config, client, dispatcher)
+            self.add('archive', archive)
+
+        if 'rollup' in self.enabled:
+            def rollup():
+                import rollup
+                return rollup.RollupService(config, client, dispatcher)
+            self.add('rollup', rollup)
+
+        if 'mppt' in self.enabled:
+            sections = [s.strip() for s in cfg.get('mppt_sections', 'MPPT').split(',')]
+
+            def mppt():
+                import mppt_to_mqtt
+                return mppt_to_mqtt.make_mux(config, client, sections)
+            self.add('mppt', mppt)
+
+    def on_smartmeter_sample(self, t_frame, t_decoded, power_in, power_out, total_in, total_out):
+        """
+        Smartmeter thread: one control step per frame, the same as a fastlink sample in update_setpoint.py
+        """
+        worker = self.setpoint
+        if worker is None or worker.stopped.is_set():
+            return
+        import update_setpoint
+        self.samples += 1
+        sample = {'trace': {'id': self.samples, 'frame': t_frame, 'decoded': t_decoded, 'published': time.monotonic()}}
+        try:
+            trace = update_setpoint.make_trace(worker.set_point, sample, 'direct', time.monotonic())
+            worker.set_point.update_sm_power((power_in - power_out) * -1, trace)
+        except Exception as ex:
+            log.error(f"setpoint: {ex}", exc_info=True)
+
+    def status(self):
+        return {c.name: c.status() for c in self.components}
+
+    async def publish_status(self):
+        while True:
+            await asyncio.sleep(self.status_interval)
+            status = self.status()
+            log.info(status)
+            if self.status_topic:
+                self.client.publish(self.status_topic, json.dumps(status))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+
+        log.info(f"connect to mqtt server {self.config['MQTT']['host']}")
+        self.client.connect(self.config['MQTT']['host'], int(self.config['MQTT']['port']))
+        self.client.loop_start()
+        if self.config.has_section('METRICS'):
+            import metrics
+            metrics.serve(self.config['METRICS'])
+
+        tasks = [asyncio.create_task(c.supervise(), name=c.name) for c in self.components]
+        tasks.append(asyncio.create_task(self.publish_status(), name='status'))
+        await stop.wait()
+
+        log.warning("stopping")
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="config.ini file", default="config.ini")
+    args = parser.parse_args()
+
+    try:
+        logging.config.fileConfig('logging.ini')
+    except Exception:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(threadName)s %(message)s')
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+
+    asyncio.run(Supervisor(config).run())
+
+
+if __name__ == '__main__':
+    main()
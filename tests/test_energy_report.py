@@ -0,0 +1,39 @@
+import math
+
+import numpy
+import pytest
+
+from energy_report import integrate
+
+
+def test_constant_power_over_a_day():
+    ts = numpy.arange(0, 86400 + 1, 1.0)
+    positive, negative = integrate(ts, numpy.full(len(ts), 1000.0))
+    assert positive == pytest.approx(24.0)
+    assert negative == 0
+
+
+def test_missing_values_hold_the_last_one():
+    # archive rows of other fields: every second power value is NaN
+    ts = numpy.arange(0, 86400 + 1, 1.0)
+    power = numpy.full(len(ts), 1000.0)
+    power[1::2] = math.nan
+    positive, negative = integrate(ts, power)
+    assert positive == pytest.approx(24.0)
+
+
+def test_gap_longer_than_max_gap_is_not_bridged():
+    ts = numpy.arange(0, 7200 + 1, 1.0)
+    power = numpy.full(len(ts), -1000.0)
+    power[1000:4600] = math.nan  # one hour without power values
+    positive, negative = integrate(ts, power, max_gap=60)
+    assert positive == 0
+    assert negative == pytest.approx((999 + 60 + 2600) / 3600)  # held for max_gap after the last value
+
+
+def test_nan_before_the_first_value():
+    ts = numpy.arange(0, 3600 + 1, 1.0)
+    power = numpy.full(len(ts), 1000.0)
+    power[:1800] = math.nan
+    positive, negative = integrate(ts, power)
+    assert positive == pytest.approx(0.5)
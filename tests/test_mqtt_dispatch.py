@@ -0,0 +1,68 @@
+import paho.mqtt.client as mqtt
+
+from mqtt_dispatch import Dispatcher
+
+
+class FakeClient:
+    """
+    paho keeps one callback per topic filter, message_callback_add replaces it
+    """
+    def __init__(self):
+        self.callbacks = {}
+        self.subscribed = []
+
+    def message_callback_add(self, topic, callback):
+        self.callbacks[topic] = callback
+
+    def subscribe(self, topic, qos=0):
+        self.subscribed.append(topic)
+
+    def deliver(self, topic, payload):
+        message = mqtt.MQTTMessage(topic=topic.encode())
+        message.payload = payload
+        self.callbacks[topic](self, None, message)
+
+
+def test_two_subscribers_on_one_topic_both_receive():
+    client = FakeClient()
+    dispatcher = Dispatcher(client)
+    received = []
+    dispatcher.subscribe('tele/smartmeter', lambda c, u, m: received.append(('archive', m.payload)))
+    dispatcher.subscribe('tele/smartmeter', lambda c, u, m: received.append(('setpoint', m.payload)))
+
+    client.deliver('tele/smartmeter', b'{"power": 100}')
+
+    assert received == [('archive', b'{"power": 100}'), ('setpoint', b'{"power": 100}')]
+
+
+def test_failing_subscriber_does_not_stop_the_others():
+    client = FakeClient()
+    dispatcher = Dispatcher(client)
+    received = []
+
+    def fail(c, u, m):
+        raise ValueError('bad payload')
+    dispatcher.subscribe('t', fail)
+    dispatcher.subscribe('t', lambda c, u, m: received.append(m.topic))
+
+    client.deliver('t', b'')
+
+    assert received == ['t']
+
+
+def test_remove_and_subscribe_again_on_restart():
+    client = FakeClient()
+    dispatcher = Dispatcher(client)
+    received = []
+
+    def on_message(c, u, m):
+        received.append(m.topic)
+    dispatcher.subscribe('t', on_message)
+    dispatcher.subscribe('t', on_message)  # registered once
+    client.deliver('t', b'')
+    dispatcher.remove(on_message)
+    client.deliver('t', b'')
+    dispatcher.subscribe('t', on_message)
+    client.deliver('t', b'')
+
+    assert received == ['t', 't']
@@ -0,0 +1,87 @@
+import configparser
+import math
+
+from payload_codec import PayloadDecoder, PayloadEncoder, make_encoder
+from publish_policy import ChangeFilter
+
+
+class FakeClient:
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, topic, payload, retain=False, **kwargs):
+        self.messages.append((topic, payload))
+
+
+def round_trip(encoder, records, topic='tele/test'):
+    """
+    Publish the records and decode every message like a subscriber of topic and topic/schema
+    """
+    client = FakeClient()
+    decoder = PayloadDecoder()
+    for record in records:
+        encoder.publish(client, topic, record)
+    r = [decoder.decode(t, payload) for t, payload in client.messages]
+    return [record for record in r if record is not None]
+
+
+def test_json():
+    records = [{'power': 100, 'state': 'ok'}, {'power': -20}]
+    assert round_trip(PayloadEncoder('json'), records) == records
+
+
+def test_binary():
+    records = [{'power': 100, 'voltage': 230.1, 'on': True, 'name': 'x'}, {'power': 2 ** 40, 'voltage': 229.5, 'on': False}]
+    assert round_trip(PayloadEncoder('binary'), records) == [
+        {'power': 100, 'voltage': 230.1, 'on': True, 'name': 'x'},
+        {'power': 2 ** 40, 'voltage': 229.5, 'on': False, 'name': None}]
+
+
+def test_binary_string_field_widens():
+    records = [{'state': 'off', 'error': 'No error'}, {'state': 'bulk charging', 'error': 'No error'}]
+    assert round_trip(PayloadEncoder('binary'), records) == records
+
+
+def test_binary_int_becomes_float():
+    assert round_trip(PayloadEncoder('binary'), [{'power': 1}, {'power': 1.5}]) == [{'power': 1}, {'power': 1.5}]
+
+
+def test_binary_missing_values():
+    decoded = round_trip(PayloadEncoder('binary'), [{'power': 1, 'voltage': 230.0}, {'power': None, 'voltage': math.nan}])
+    assert decoded[1] == {'power': None, 'voltage': None}
+
+
+def test_binary_keeps_fields_absent_from_the_triggering_record():
+    # the new field c rebuilds the schema, a and b must stay in it
+    decoded = round_trip(PayloadEncoder('binary'), [{'a': 1, 'b': 2.0}, {'c': 3}, {'a': 4, 'b': 5.0, 'c': 6}])
+    assert decoded[1] == {'a': None, 'b': None, 'c': 3}
+    assert decoded[2] == {'a': 4, 'b': 5.0, 'c': 6}
+
+
+def test_binary_schema_published_once():
+    client = FakeClient()
+    encoder = PayloadEncoder('binary')
+    for power in range(3):
+        encoder.publish(client, 't', {'power': power})
+    assert [t for t, payload in client.messages] == ['t/schema', 't', 't', 't']
+
+
+def test_delta_merged_into_keyframe():
+    encoder = PayloadEncoder('delta', keyframe_interval=0, thresholds={'power': 5})
+    records = [{'power': 100, 'voltage': 230}, {'power': 102, 'voltage': 230}, {'power': 110, 'voltage': 231}]
+    assert round_trip(encoder, records) == [{'power': 100, 'voltage': 230}, {'power': 110, 'voltage': 231}]
+
+
+def test_binary_partial_records_merged():
+    change_filter = ChangeFilter(snapshot_interval=10)
+    records = [change_filter.filter(r, t) for t, r in enumerate([{'PPV': 100, 'V': 12.5}, {'PPV': 120, 'V': 12.5}])]
+    assert round_trip(PayloadEncoder('binary'), records) == [{'PPV': 100, 'V': 12.5}, {'PPV': 120, 'V': 12.5}]
+
+
+def test_publish_mode_change_is_the_encoder_change_filter():
+    config = configparser.ConfigParser()
+    config.read_string("[MPPT]\npublish_mode=change\nsnapshot_interval=10\npayload=binary\n")
+    encoder = make_encoder(config['MPPT'])
+    assert encoder.mode == 'binary' and encoder.change_filter.snapshot_interval == 10
+    records = [{'PPV': 100, 'V': 12.5}, {'PPV': 100, 'V': 12.5}, {'PPV': 120, 'V': 12.5}]
+    assert round_trip(encoder, records) == [{'PPV': 100, 'V': 12.5}, {'PPV': 120, 'V': 12.5}]
@@ -0,0 +1,29 @@
+from publish_policy import ChangeFilter, WindowAggregator, parse_thresholds
+
+
+def test_parse_thresholds():
+    assert parse_thresholds('PPV:5, V:20') == {'PPV': 5.0, 'V': 20.0}
+    assert parse_thresholds(None) == {}
+
+
+def test_change_filter_marks_partial_records():
+    change_filter = ChangeFilter(parse_thresholds('PPV:5'), snapshot_interval=10)
+    assert change_filter.filter({'PPV': 100, 'V': 12}, t=0) == {'PPV': 100, 'V': 12}
+    assert change_filter.filter({'PPV': 104, 'V': 12}, t=1) is None
+    assert change_filter.filter({'PPV': 120, 'V': 12}, t=2) == {'PPV': 120, '_delta': 1}
+    assert change_filter.filter({'PPV': 120, 'V': 12}, t=10) == {'PPV': 120, 'V': 12}
+
+
+def test_change_filter_non_numeric_fields():
+    change_filter = ChangeFilter(snapshot_interval=0)
+    change_filter.filter({'CS': 'Bulk', 'ERR': None}, t=0)
+    assert change_filter.filter({'CS': 'Bulk', 'ERR': None}, t=100) is None
+    assert change_filter.filter({'CS': 'Float', 'ERR': None}, t=101) == {'CS': 'Float', '_delta': 1}
+
+
+def test_window_aggregator():
+    aggregator = WindowAggregator(['PPV'], 10)
+    for t, ppv in enumerate((100, 200, None, 300)):
+        assert aggregator.add({'PPV': ppv}, t=t) is None
+    assert aggregator.add({'PPV': 0}, t=10) == {'window': 10, 'samples': 4, 'PPV_mean': 200.0, 'PPV_min': 100,
+                                                  'PPV_max': 300}
@@ -0,0 +1,57 @@
+import pytest
+
+from rollup import Rollup
+
+RESOLUTIONS = (('1s', 1), ('10s', 10))
+
+
+def test_buckets_finish_on_the_next_sample():
+    rollup = Rollup(RESOLUTIONS)
+    assert rollup.add({'power': 100}, t=1000.1) == []
+    assert rollup.add({'power': 300}, t=1000.6) == []
+    done = rollup.add({'power': 50}, t=1001.2)
+    assert done == [('1s', {'t': 1000, 'n': 2, 'power_mean': 200.0, 'power_min': 100.0, 'power_max': 300.0,
+                            'power_last': 300.0})]
+
+
+def test_resolutions_are_aligned_to_the_clock():
+    rollup = Rollup(RESOLUTIONS)
+    finished = []
+    for i in range(25):
+        finished += [(label, result['t'], result['n']) for label, result in rollup.add({'power': i}, t=1005 + i)
+                     if label == '10s']
+    assert finished == [('10s', 1000, 5), ('10s', 1010, 10)]
+
+
+def test_tick_publishes_buckets_of_a_silent_source():
+    rollup = Rollup(RESOLUTIONS)
+    rollup.add({'power': 10}, t=100.5)
+    assert rollup.tick(100.9) == []
+    assert [label for label, result in rollup.tick(101.1)] == ['1s']
+    assert rollup.tick(102.5) == []  # empty buckets are not published
+
+
+def test_non_numeric_and_missing_fields():
+    rollup = Rollup(RESOLUTIONS)
+    rollup.add({'power': 1, 'state': 'ok', 'on': True}, t=0.1)
+    rollup.add({'voltage': 230.0}, t=0.2)
+    result = dict(rollup.tick(1.0))['1s']
+    assert result['n'] == 2
+    assert result['power_mean'] == 1.0
+    assert result['voltage_mean'] == pytest.approx(230.0)
+    assert not any(key.startswith(('state', 'on')) for key in result)
+
+
+def test_max_fields():
+    rollup = Rollup(RESOLUTIONS, max_fields=2)
+    rollup.add({'a': 1, 'b': 2, 'c': 3}, t=0.1)
+    result = dict(rollup.tick(1.0))['1s']
+    assert 'a_mean' in result and 'b_mean' in result and 'c_mean' not in result
+
+
+def test_reset_between_buckets():
+    rollup = Rollup(RESOLUTIONS)
+    rollup.add({'power': 1000}, t=0.1)
+    rollup.add({'power': 1}, t=1.1)
+    result = dict(rollup.tick(2.0))['1s']
+    assert result == {'t': 1, 'n': 1, 'power_mean': 1.0, 'power_min': 1.0, 'power_max': 1.0, 'power_last': 1.0}
@@ -0,0 +1,72 @@
+import pytest
+
+import seplos_codec
+from seplos_codec import SeplosError
+
+CELLS = [3.301 + i / 1000 for i in range(16)]
+TEMPERATURES = [21.5, 21.7, 22.0, 21.9, 20.1, 25.3]
+
+
+def telemetry_frame(address=1):
+    return seplos_codec.encode_telemetry(address, CELLS, TEMPERATURES, -12.34, 53.12, 150.5, 280.0, 53.7, 280.0,
+                                         123, 100.0, 53.1)
+
+
+def test_requests():
+    # telemetry request of pack 0 as documented for protocol 2.0
+    assert seplos_codec.REQUESTS[(0, seplos_codec.TELEMETRY)] == b'~20004642E00200FD37\r'
+    assert seplos_codec.REQUESTS[(1, seplos_codec.TELEMETRY)] == b'~20014642E00201FD35\r'
+    assert seplos_codec.REQUESTS[(1, seplos_codec.MANUFACTURER)].startswith(b'~20014651000')
+
+
+def test_length_field():
+    assert seplos_codec.length_field(2) == b'E002'
+    assert seplos_codec.length_field(0) == b'0000'
+    assert seplos_codec.length_field(0x12) == b'D012'
+
+
+def test_decode_telemetry():
+    r = seplos_codec.decode(telemetry_frame())
+    assert r.address == 1
+    assert r.cells == pytest.approx(CELLS)
+    assert r.temperatures == pytest.approx(TEMPERATURES)
+    assert r.current == pytest.approx(-12.34)
+    assert r.voltage == pytest.approx(53.12)
+    assert r.soc == pytest.approx(53.7)
+    assert r.number_of_cycle == 123
+    d = r.to_dict()
+    assert d['cell1_voltage'] == pytest.approx(3.301)
+    assert d['cell_diff'] == pytest.approx(0.015)
+    assert d['power_temp'] == pytest.approx(25.3)
+
+
+def test_checksum_error():
+    frame = bytearray(telemetry_frame())
+    frame[20] = ord('F') if frame[20] != ord('F') else ord('E')
+    with pytest.raises(SeplosError, match='checksum'):
+        seplos_codec.decode(bytes(frame))
+
+
+def test_return_code():
+    frame = seplos_codec.build_frame(1, 0x02)
+    with pytest.raises(SeplosError, match='return code 0x02'):
+        seplos_codec.validate_frame(frame)
+
+
+def test_invalid_frames():
+    for frame in (b'', b'~2001\r', telemetry_frame()[:-1], b'x' + telemetry_frame()[1:]):
+        with pytest.raises(SeplosError):
+            seplos_codec.decode(frame)
+
+
+def test_telemetry_too_short():
+    frame = seplos_codec.build_frame(1, 0x00, b'000110')
+    with pytest.raises(SeplosError, match='too short'):
+        seplos_codec.decode(frame)
+
+
+def test_decode_alarms():
+    info = bytes((0x00, 1, 16)) + bytes(15) + b'\x02' + bytes((6,)) + bytes(6) + b'\x00\x01\x00' + b'\x00\x10'
+    r = seplos_codec.decode(seplos_codec.build_frame(1, 0x00, info.hex().upper().encode()), seplos_codec.ALARMS)
+    assert r.active == ['cell16', 'voltage']
+    assert r.to_dict()['status'] == '0010'
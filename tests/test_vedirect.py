@@ -0,0 +1,100 @@
+import struct
+
+from vedirect import VEDirect, VEDirectHex, VEDirectParser, VEDirectSchema
+
+
+def block(fields):
+    """
+    Text block with a valid checksum from [(key, value), ...]
+    """
+    data = b''.join(b'\r\n%s\t%s' % (key.encode(), value.encode()) for key, value in fields) + b'\r\nChecksum\t'
+    return data + bytes(((-sum(data)) & 0xFF,))
+
+
+FIELDS = [('PID', '0xA060'), ('V', '26201'), ('I', '2000'), ('VPV', '53400'), ('PPV', '55'), ('CS', '3')]
+
+
+def test_one_block():
+    parser = VEDirectParser()
+    records = parser.feed(block(FIELDS))
+    assert records == [(tuple(k for k, v in FIELDS), [v for k, v in FIELDS])]
+    assert parser.records == 1
+    assert parser.buf == b''
+
+
+def test_byte_by_byte():
+    parser = VEDirectParser()
+    records = []
+    for b in block(FIELDS) * 3:
+        records += parser.feed(bytes((b,)))
+    assert len(records) == 3
+    assert records[0][1][4] == '55'
+    assert parser.checksum_errors == 0
+
+
+def test_block_split_at_every_position():
+    data = block(FIELDS) + block(FIELDS)
+    for i in range(len(data)):
+        parser = VEDirectParser()
+        assert len(parser.feed(data[:i]) + parser.feed(data[i:])) == 2, i
+
+
+def test_checksum_error_resyncs():
+    bad = bytearray(block(FIELDS))
+    bad[10] ^= 1
+    parser = VEDirectParser()
+    records = parser.feed(b'\x00garbage' + bytes(bad) + block(FIELDS))
+    assert len(records) == 1
+    assert parser.checksum_errors == 1
+
+
+def test_hex_frame_inside_a_block():
+    frames = []
+    parser = VEDirectParser(hex_callback=frames.append)
+    data = block(FIELDS)
+    middle = data.index(b'\r\nPPV')
+    records = parser.feed(data[:middle] + b':7BCED0002E80B42\n' + data[middle:])
+    assert len(records) == 1
+    assert frames == [b'7BCED0002E80B42']
+    assert parser.hex_frames == 1
+
+
+def test_hex_frame_between_blocks():
+    frames = []
+    parser = VEDirectParser(hex_callback=frames.append)
+    records = parser.feed(block(FIELDS) + b':A0102000543\n' + block(FIELDS))
+    assert len(records) == 2
+    assert frames == [b'A0102000543']
+
+
+def test_hex_register_answer():
+    values = []
+    hex_ = VEDirectHex(None, ['PPV'], callback=values.append)
+    hex_.pending = {0xEDBC: 0}
+    frame = VEDirectHex.build_frame(VEDirectHex.GET, struct.pack('<HBI', 0xEDBC, 0, 12345))
+    assert frame.startswith(b':7BCED00') and frame.endswith(b'\n')
+    hex_.handle_frame(frame[1:-1])
+    assert values == [{'PPV': 123.45}]
+    assert hex_.errors == 0
+
+
+def test_hex_checksum_error():
+    hex_ = VEDirectHex(None, ['PPV'])
+    frame = VEDirectHex.build_frame(VEDirectHex.GET, struct.pack('<HBI', 0xEDBC, 0, 12345))
+    hex_.handle_frame(frame[1:-3] + b'00')
+    assert hex_.errors == 1
+    assert hex_.values == {}
+
+
+def test_schema_record():
+    keys, values = VEDirectParser().feed(block(FIELDS))[0]
+    record = VEDirectSchema(keys).decode(values)
+    assert record.PPV == 55 and record['V'] == 26201 and record.get('LOAD') is None
+    assert record.to_dict(scaled=True)['V'] == 26.2
+    record = VEDirectSchema(keys).decode(values[:4] + ['x'] + values[5:])  # invalid value, field by field
+    assert record.PPV is None and record.VPV == 53400
+
+
+def test_read_data_single_returns_dict():
+    record = VEDirect(emulate='MPPT', emulate_rate=0).read_data_single()
+    assert isinstance(record, dict) and 'PPV' in record
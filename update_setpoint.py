@@ -16,7 +16,17 @@ import sys
 import signal
 import datetime
 import pprint
+import threading
 import vebus_constants
+from fastlink import SampleReceiver
+from latency_trace import LatencyTracer
+from mqtt_dispatch import Dispatcher
+from state_file import StateFile
+from payload_codec import PayloadDecoder, make_encoder
+from flight_recorder import make_recorder
+from debug_trace import MqttSink
+import diagnostics
+import metrics
 
 log = logging.getLogger(__name__)
 
@@ -39,19 +49,69 @@ class SetPoint:
         self.mp2_standby=False
         self.mp2_device_state_name=None
         self.mppt_topic=None
+        self.mppt_hex_topic=None
         self.cmd_topic=None
         self.mppt_power=0
+        self.sm_power=None
         self.last_mppt_power=None
         self.counter=0
+        self.lock=threading.Lock()  # smartmeter samples may come from mqtt and fastlink thread
+        self.fastlink=None
+        self.tracer=LatencyTracer(mqtt_client, config['VICTRON'].get('diag_topic'),
+                                  sample_every=config['VICTRON'].getint('trace_sample_every', fallback=100))
+        self.encoder=make_encoder(config['VICTRON'])
+        self.decoder=PayloadDecoder()  # input topics may be json, delta or binary
+        self.recorder=make_recorder(config['VICTRON'])  # ticks, frames and inputs, dumped on faults
+        self.mp2.vebus.recorder=self.recorder
+        link=self.mp2.vebus.link
+        link.budget=config['VICTRON'].getfloat('link_budget', fallback=link.budget)
+        link.window=config['VICTRON'].getfloat('link_window', fallback=link.window)
+        self.metrics=None
+        if config.has_section('METRICS'):
+            self.metrics=metrics.SetPointMetrics(self)
+            self.mp2.vebus.metrics=metrics.VEBusMetrics(link=self.mp2.vebus.link)
+        self.diagnostics=diagnostics.Diagnostics(mqtt_client, config['VICTRON'].get('diag_topic'),
+                                                 config['VICTRON'].get('diag_path', 'diagnostics'))
+        self.state_file=None
+        if config['VICTRON'].get('state_file'):
+            self.state_file=StateFile(config['VICTRON']['state_file'], config['VICTRON'].getfloat('state_interval', fallback=10))
+            self.restore(self.state_file.load(max_age=config['VICTRON'].getfloat('state_max_age', fallback=300)))
         
 
-    def update_bms_soc(self, bms_soc):
+    # controller state kept over a restart, timestamps are time.time()
+    STATE_KEYS=('mp2_power', 'mp2_charge', 'mp2_invert', 'mp2_standby', 'battery_empty_ts',
+                'bms_soc', 'last_bms_soc_data', 'mppt_power', 'last_mppt_power')
+
+    def state(self):
+        return {key: getattr(self, key) for key in self.STATE_KEYS}
+
+    def restore(self, state):
+        """
+        Continue with the integrator, timers and soc of the last run instead of ramping up from 0
+        """
+        if not state:
+            return
+        for key in self.STATE_KEYS:
+            if key in state:
+                setattr(self, key, state[key])
+        log.warning(f"restored state from {datetime.datetime.fromtimestamp(state.get('saved_at', 0))}: {self.state()}")
+
+    def update_bms_soc(self, bms_soc, t=None):
+        """
+        :param t: time.time() of the measurement if known (retained messages may be old)
+        """
         self.bms_soc=bms_soc
-        self.last_bms_soc_data=time.time()
+        self.last_bms_soc_data=t or time.time()
+        if self.recorder:
+            self.recorder.input('bms_soc', bms_soc)
 
     def update_mppt(self, data):
-        self.mppt_power=data.get('PPV',0)
+        if 'PPV' not in data:  # change-only payload without panel power
+            return
+        self.mppt_power=data['PPV']
         self.last_mppt_power=time.time()
+        if self.recorder:
+            self.recorder.input('mppt', self.mppt_power)
         log.info(f"mppt power: {self.mppt_power}")
 
     def get_max_charge(self):
@@ -60,6 +120,8 @@ class SetPoint:
     def get_max_invert(self):
         max_invert=float(self.config['VICTRON']['MAX_INVERT'])
         min_soc=float(self.config['VICTRON']['MIN_SOC'])
+        if self.bms_soc is None:  # no soc yet, minimum power only
+            return 300
 
         max_invert2=math.tanh(((self.bms_soc-min_soc) / 10))*max_invert
 
@@ -113,34 +175,50 @@ class SetPoint:
         return ret
 
     def custom_update(self, data):
-        dspl = {"title": "Victron",
-            "color": 22142,
-            "main": {"unit": "%",
-                "Bat": data.get("soc")
-                },
-            "stand0": {
-                "unit": "",
-                "State": f"{data.get('state')}/{data.get('device_state_id')}",
-            },
-            "stand1": {
-                "unit": "W",
-                "Bat": "{:.1f}".format(data.get("bat_p", 0)),
-            },
-            "stand2": {
-                "unit": "A",
-                "Bat": "{:.1f}".format(data.get("bat_i", 0)),
-            }
-        }
-        self.mqtt_client.publish("display", json.dumps(dspl))
-        print(json.dumps(dspl))
-
-
-    def update_sm_power(self, sm_power):
+        """
+        Hook for own code after each control step, the display page is rendered by display.py from VICTRON topic
+        """
+        pass
+
+
+    def update_sm_power(self, sm_power, trace=None):
+        """
+        One control step for a new smartmeter value
+
+        :param sm_power: grid power, positive = feed in
+        :param trace: latency_trace.Trace of the meter frame or None
+        """
+        with self.lock:
+            start=time.perf_counter()  # the step, not the wait for a fetch_data or command holding the lock
+            self.sm_power=sm_power
+            try:
+                self._update_sm_power(sm_power, trace)
+            except Exception as ex:
+                if self.recorder:
+                    self.recorder.dump('exception', f"{type(ex).__name__}: {ex}")
+                raise
+            finally:
+                if self.metrics:
+                    self.metrics.tick(start)
+        if trace:
+            self.tracer.finish(trace)
+
+    def _update_sm_power(self, sm_power, trace):
         # multiplus2
         if not self.mp2:
             log.error("no mp2")
             return
+        if self.diagnostics.active:
+            self.diagnostics.tick()
+        was_online=self.mp2.online
         self.mp2.update()
+        if self.recorder and was_online != self.mp2.online:
+            if self.mp2.online:
+                self.recorder.event('online')
+            else:
+                self.recorder.dump('offline')
+        if trace:
+            trace.mark('mp2_updated')
         log.info(self.mp2.data)
         data=self.mp2.data.copy()
         self.mp2_device_state_name=data.get('device_state_name',None)
@@ -182,6 +260,7 @@ class SetPoint:
             self.mp2_power=0
 
         data['mp2_power_request']=self.mp2_power
+        data['vebus_util']=round(self.mp2.vebus.link.utilisation(10), 3)  # share of the 2400 baud link, last 10s
         if data.get('inv_p',0) >=0:
             data['inv_p_in']=data.get('inv_p',0)
             data['inv_p_out']=0
@@ -196,7 +275,7 @@ class SetPoint:
             log.warning(f"got incomplete data from victron {data}")
 
 
-        rc=self.mqtt_client.publish(self.config['VICTRON']['topic'], json.dumps(data))
+        rc=self.encoder.publish(self.mqtt_client, self.config['VICTRON']['topic'], data)
         log.debug(rc)
 
 #        batu_hyst=52.3 - 0.5 if self.mp2_invert else 0
@@ -205,6 +284,10 @@ class SetPoint:
 #            self.bms_soc=21
         set_power_ok=False
         log.info(f"mp2_power={self.mp2_power}, soc: {self.bms_soc}, bat_u: {bat_u}")
+        if trace:
+            trace.mark('setpoint')
+        ack_count=self.mp2.vebus.ack_count
+        set_power_errors=self.mp2.vebus.set_power_errors
         if self.mp2_power>0:
             max_soc_hyst=float(self.config['VICTRON']['MAX_SOC']) + (float(self.config['VICTRON']['SOC_HYSTERESIS']) if self.mp2_charge else 0)
             if self.bms_soc < max_soc_hyst:
@@ -235,6 +318,14 @@ class SetPoint:
         if not set_power_ok:
             log.warning("unable to set power")
             victron_ok=False
+        elif trace and self.mp2.vebus.ack_count != ack_count:
+            trace.mark('ack', self.mp2.vebus.last_ack_time)
+
+        if self.recorder:
+            self.recorder.tick(sm_power, self.mp2_power, self.mp2_power_old, self.bms_soc, data.get('bat_u'),
+                               data.get('inv_p'), set_power_ok, self.mp2.online)
+            if self.mp2.vebus.set_power_errors != set_power_errors:
+                self.recorder.dump('set_power')
 
         try:
             self.custom_update(data)
@@ -242,6 +333,8 @@ class SetPoint:
             log.warning(f"unable to call custom code, got {ex}", exc_info=True) 
 
         self.counter+=1
+        if self.state_file:
+            self.state_file.save(self.state())  # copied under self.lock, written in a thread
 
         if victron_ok:
             if self.counter > 10:
@@ -279,9 +372,11 @@ class SetPoint:
 
         phase_dict={1:{}, 2:{}, 3:{}}
 
+        vebus=self.mp2.vebus  # low priority reads, they wait while the control loop keeps the link busy
         for phase in range (1,4):
             print(f"Phase {phase}")
-            ac_info = self.mp2.vebus.get_ac_info(phase)
+            with vebus.transaction(low_priority=True):
+                ac_info = self.mp2.vebus.get_ac_info(phase)
             print(ac_info)
             phase_dict[phase].update({"ac_info": ac_info })
 
@@ -289,33 +384,36 @@ class SetPoint:
             ids = list(filter(lambda x: x not in [10], range(page*5, page*5+5)))        # 10 cannot be read, virtual switches
 
             print(f"ids: {ids}")
-            self.mp2.vebus.send_snapshot_request(ids)
-#            time.sleep(0.1)
-            for phase in range(1,4):
-                try:
-                    print(f"Phase {phase}")
-                    ret = self.mp2.vebus.read_snapshot(ids, phase=phase)
-                    print(ret)
-                    if ret:
-                        phase_dict[phase].update(ret)
-                #    print(phase_dict)
-                except Exception as ex:
-                    print(ex)
-                    traceback.print_exc()
+            with vebus.transaction(low_priority=True):
+                self.mp2.vebus.send_snapshot_request(ids)
+#                time.sleep(0.1)
+                for phase in range(1,4):
+                    try:
+                        print(f"Phase {phase}")
+                        ret = self.mp2.vebus.read_snapshot(ids, phase=phase)
+                        print(ret)
+                        if ret:
+                            phase_dict[phase].update(ret)
+                    #    print(phase_dict)
+                    except Exception as ex:
+                        print(ex)
+                        traceback.print_exc()
 
         pprint.pprint(phase_dict)
 
 #        settings_to_read = [0, 1, 2, 3, 4, 14, 64]
         
         for phase in range(1,4):
-            flag0_15 = self.mp2.vebus.read_settings(0, phase=phase)
+            with vebus.transaction(low_priority=True):
+                flag0_15 = self.mp2.vebus.read_settings(0, phase=phase)
             flag0_16_text = '{0:016b}'.format(flag0_15)
             phase_dict[phase].update({f"flag0_16_text": flag0_16_text})
 
             for i, bit in enumerate(reversed(flag0_16_text), start=0):
                 print(f"bit {i} = {'true' if bit == '1' else 'false'}")
 
-            flag16_31 = self.mp2.vebus.read_settings(1, phase=phase)
+            with vebus.transaction(low_priority=True):
+                flag16_31 = self.mp2.vebus.read_settings(1, phase=phase)
             flag16_31_text = '{0:016b}'.format(flag16_31)
             phase_dict[phase].update({f"flag16_31_text": flag16_31_text})
 
@@ -326,7 +424,8 @@ class SetPoint:
         for setting_id in settings_to_read:
             print(f"setting {setting_id}")
             for phase in range(1,2):
-                ret = self.mp2.vebus.read_settings(setting_id, phase=phase)
+                with vebus.transaction(low_priority=True):
+                    ret = self.mp2.vebus.read_settings(setting_id, phase=phase)
                 print(f"phase {phase} setting {setting_id} = {ret}, {bin(ret)} {int(ret)}")
                 # bit_string = bin(ret)[2:]  # Remove '0b' prefix
                 # for i, bit in enumerate(bit_string, start=1):
@@ -359,35 +458,67 @@ class SetPoint:
 
 
     def call_cmd(self, data):
+        with self.lock:
+            self._call_cmd(data)
+
+    def _call_cmd(self, data):
         log.info(f"got cmd: {data}")
         cmd = data.get('cmd')
+        if self.recorder:
+            self.recorder.event('cmd', str(cmd))
+        # the commands own the link, a fetch_data read in its thread must not interleave its frames
         if cmd == 'reset':
             log.info("reset mp2")
-            self.mp2.vebus.reset_device(0)
+            with self.mp2.vebus.transaction():
+                self.mp2.vebus.reset_device(0)
         elif cmd == 'sleep':
             log.info("sleep mp2")
-            self.mp2.vebus.sleep()
+            with self.mp2.vebus.transaction():
+                self.mp2.vebus.sleep()
         elif cmd == 'wakeup':
             log.info("wakeup mp2")
-            self.mp2.vebus.wakeup()
+            with self.mp2.vebus.transaction():
+                self.mp2.vebus.wakeup()
         elif cmd == 'fetch_data':
             log.info("fetch data")
-            self.fetch_data()
+            # not under self.lock: the reads wait for link budget, the control loop goes on between them
+            threading.Thread(target=self.fech_data, name='fetch_data', daemon=True).start()
+        elif cmd == 'trace':
+            # {"cmd": "trace", "enable": true, "sample_every": 10}: VE.Bus frames as json on trace_topic
+            sink=MqttSink(self.mqtt_client, self.config['VICTRON'].get('trace_topic', 'diag/victron/vebus')) if data.get('enable') else None
+            self.mp2.vebus.trace.set_sink(sink, data.get('sample_every'))
+        elif cmd in diagnostics.COMMANDS:
+            self.diagnostics.command(data)
+        elif cmd == 'dump':
+            if self.recorder:
+                log.warning(f"flight recorder dump {self.recorder.dump('cmd', force=True)}")
+            else:
+                log.warning("flight recorder disabled (flight_records=0)")
         else:
             log.warning(f"unknown cmd {cmd}")
 
 def on_message(mqtt_client, set_point_class, message):
-    log.debug(f"message received topic: {message.topic} {str(message.payload.decode('utf-8'))}")
+    t_received=time.monotonic()
+    log.debug("message received topic: %s %s", message.topic, message.payload)
     try:
-        data = json.loads(str(message.payload.decode("utf-8")))
+        data = set_point_class.decoder.decode(message.topic, message.payload)
+        if data is None:  # schema of a binary topic, or binary record before its schema
+            return
 
         if message.topic == set_point_class.smartmeter_topic:
-            log.debug(f"update from smartmeter: {data['power']}")
-            set_point_class.update_sm_power(data['power']*-1)
+            if set_point_class.fastlink and set_point_class.fastlink.is_active():
+                log.debug("smartmeter via fastlink active, ignore mqtt value")
+            else:
+                log.debug(f"update from smartmeter: {data['power']}")
+                set_point_class.update_sm_power(data['power']*-1, make_trace(set_point_class, data, 'mqtt', t_received))
+        elif message.topic == set_point_class.bms_system_topic:
+            log.info(f"update from battery: soc: {data['soc']}, voltage: {data.get('voltage')}, stale shelves: {data.get('stale')}")
+            if data['soc'] is not None:
+                set_point_class.update_bms_soc(data['soc'], data.get('time'))
         elif message.topic == set_point_class.bms1_topic:
             log.info(f"update from bms1: soc: {data['soc']}, voltage: {data['voltage']}")
-            set_point_class.update_bms_soc(data['soc'])
-        elif message.topic == set_point_class.mppt_topic:
+            set_point_class.update_bms_soc(data['soc'], data.get('time'))
+        elif message.topic == set_point_class.mppt_topic or message.topic == set_point_class.mppt_hex_topic:
             set_point_class.update_mppt(data)
         elif message.topic == set_point_class.cmd_topic:
             set_point_class.call_cmd(data)
@@ -404,6 +535,48 @@ def on_message(mqtt_client, set_point_class, message):
     except Exception as ex:
         log.error(ex, exc_info=True)
 
+def make_trace(set_point_class, data, path, t_received):
+    stamps=data.get('trace')
+    if not stamps:
+        return None
+    trace=set_point_class.tracer.begin(stamps.get('id'), path, {k: v for k, v in stamps.items() if k != 'id'})
+    trace.mark('received', t_received)
+    return trace
+
+def subscribe(mqtt_client, set_point_class, config, smartmeter=True, dispatcher=None):
+    """
+    Subscribe the input topics, messages go to on_message with set_point_class as userdata
+
+    :param smartmeter: False if the smartmeter samples are passed to update_sm_power directly (supervisor.py)
+    :param dispatcher: mqtt_dispatch.Dispatcher of a client shared with other components, None = own one
+    """
+    if dispatcher is None:
+        dispatcher = Dispatcher(mqtt_client)
+    topics = {
+        'smartmeter_topic': config['SMARTMETER']['topic'] if smartmeter else None,
+        # combined record of all shelves (battery_aggregate.py) replaces the soc of shelf 1
+        'bms_system_topic': config['BMS1'].get('system_topic'),
+        'bms1_topic': None if config['BMS1'].get('system_topic') else config['BMS1']['topic'],
+        'mppt_topic': config['VICTRON'].get('mppt_topic'),
+        'mppt_hex_topic': config['VICTRON'].get('mppt_hex_topic'),  # PPV of the HEX polls, see vedirect.VEDirectHex
+        'cmd_topic': config['VICTRON'].get('cmd_topic'),
+        'soc_min_topic': config['VICTRON'].get('soc_min_topic'),
+        'soc_max_topic': config['VICTRON'].get('soc_max_topic'),
+    }
+
+    # Subscribe to each topic
+    for topic_name, topic in topics.items():
+        if topic:  # Check if topic is not None
+            log.info(f"Subscribe {topic}")
+            dispatcher.subscribe(topic, on_message)
+        setattr(set_point_class, topic_name, topic)
+
+    # layouts of binary payloads, see payload_codec.py
+    for topic in (topics['smartmeter_topic'], topics['mppt_topic']):
+        if topic:
+            dispatcher.subscribe(topic + '/schema', on_message)
+
+
 def read_config():
     global config
     global config_file
@@ -455,24 +628,12 @@ def main():
     log.info(f"connect to mqtt server {config['MQTT']['host']}")
     mqtt_client.connect(config['MQTT']['host'], int(config['MQTT']['port']))
 
-    topics = {
-        'smartmeter_topic': config['SMARTMETER']['topic'],
-        'bms1_topic': config['BMS1']['topic'],
-        'mppt_topic': config['VICTRON'].get('mppt_topic'),
-        'cmd_topic': config['VICTRON'].get('cmd_topic'),
-        'soc_min_topic': config['VICTRON'].get('soc_min_topic'),
-        'soc_max_topic': config['VICTRON'].get('soc_max_topic'),
-    }
-
-    # Subscribe to each topic
-    for topic_name, topic in topics.items():
-        if topic:  # Check if topic is not None
-            log.info(f"Subscribe {topic}")
-            mqtt_client.subscribe(topic)
-        setattr(set_point_class, topic_name, topic)
-
+    subscribe(mqtt_client, set_point_class, config)
     mqtt_client.user_data_set(set_point_class)
 
+    if config.has_section('METRICS'):
+        metrics.serve(config['METRICS'])
+
 
     #client.subscribe("#")
 
@@ -482,6 +643,20 @@ def main():
         set_point_class.fech_data()
         return None
 
+    if config['SMARTMETER'].get('fastlink_socket'):
+        # smartmeter samples directly from readsm.py, mqtt handles everything else in its own thread
+        set_point_class.fastlink=SampleReceiver(config['SMARTMETER']['fastlink_socket'])
+        log.info(f"start loop, smartmeter via {set_point_class.fastlink.path}")
+        mqtt_client.loop_start()
+        while True:
+            sample=set_point_class.fastlink.receive(timeout=1)
+            if sample:
+                try:
+                    trace=make_trace(set_point_class, sample, 'fastlink', time.monotonic())
+                    set_point_class.update_sm_power(sample['power']*-1, trace)
+                except Exception as ex:
+                    log.error(ex, exc_info=True)
+
     log.info("start loop")
     mqtt_client.loop_forever()
 
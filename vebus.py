@@ -1,9 +1,14 @@
+import contextlib
 import logging
 import struct
+import threading
 import time
 
 import serial
 import vebus_constants
+from debug_trace import DebugTrace
+from flight_recorder import RX, TX
+from link_budget import LinkBudget
 
 """
 Victron Energy MK3 Bus Interface
@@ -32,7 +37,17 @@ class VEBus:
         self.port = port
         self.ess_setpoint_ram_id = None  # RAM-ID for ESS Assistant  MP2 3000 = 131
         self.log = logging.getLogger(log)
+        self.trace = DebugTrace(self.log)  # frames and per tick results, see debug_trace.py
         self.serial = None
+        self.ack_count = 0  # number of set_power ACKs (0x87)
+        self.last_ack_time = None  # time.monotonic() of the last set_power ACK
+        self.set_power_errors = 0  # number of failed set_power calls
+        self.recorder = None  # flight_recorder.FlightRecorder, every TX and RX frame
+        self.metrics = None  # metrics.VEBusMetrics
+        self.tx_command = None  # metrics label and time.perf_counter() of the last request
+        self.tx_time = None
+        self.link = LinkBudget(2400)  # bytes per direction, utilisation and budget, see link_budget.py
+        self.bus_lock = threading.RLock()  # one request / response sequence at a time, see transaction()
         self.open_port()
 
     def open_port(self):
@@ -115,7 +130,8 @@ class VEBus:
 
             led_info = self.make_led_names(led_light | led_blink)
 
-            self.log.debug("led_light=0x{:02X} led_blink=0x{:02X}".format(led_light, led_blink))
+            if self.trace.enabled:
+                self.trace.emit('led', light=led_light, blink=led_blink)
             return {'led_light': led_light, 'led_blink': led_blink, 'led_info': led_info}
         except IOError:
             self.serial = None
@@ -150,8 +166,6 @@ class VEBus:
         try:
             self.send_frame('F', [phase])
             rx = self.receive_generic_frame(0x20)
-            
-            self.log.debug(f"get_ac_info({phase}) => {self.format_hex(rx)}")
 
             bf_factor, inv_factor, device_state_id, phase_info, mains_u, mains_i, inv_u, inv_i, mains_period = struct.unpack(
 #                "<BBxBBhhhhB", rx)
@@ -172,8 +186,9 @@ class VEBus:
                 'inv_factor': inv_factor,
             }
             r['own_p_calc'] = round(r['mains_p_calc']-r['inv_p_calc'])
-            
-            self.log.info(r)
+
+            if self.trace.enabled:
+                self.trace.emit('ac_info', phase=phase, result=r)
             return r
         except IOError:
             self.serial = None
@@ -262,7 +277,8 @@ class VEBus:
                  'bat_i': round(bat_i / 10, 1),
                  'bat_p': round(bat_u / 100 * bat_i / 10),
                  'soc': round(soc / 2, 1)}
-            self.log.debug("read_snapshot: {}".format(r))
+            if self.trace.enabled:
+                self.trace.emit('snapshot', result=r)
             return r
         except IOError:
             self.serial = None
@@ -289,9 +305,9 @@ class VEBus:
             ret = {}
 
             for i, ram_var in enumerate(ram_vars):
-                print(f"unpach: {frame[4+i*2:4+i*2+2]}")
                 v=struct.unpack("<h", frame[4+i*2:4+i*2+2])[0]
-                self.log.debug(f"read_snapshot: {ram_var}={v}")
+                if self.trace.enabled:
+                    self.trace.emit('snapshot_var', ram_var=ram_var, value=v)
 
 #                ret.update({ram_var: v})
                 key = next((k for k, v in vebus_constants.RAM_IDS.items() if v == ram_var), f"unknown_{ram_var}")
@@ -328,7 +344,8 @@ class VEBus:
                 raise Exception(f"invalid response {frame[3]}")
             
             v=struct.unpack("<H", frame[5:])[0]
-            self.log.debug(f"read_settings: {setting_id}={v}")
+            if self.trace.enabled:
+                self.trace.emit('setting', setting_id=setting_id, value=v)
             return v
 
         except IOError:
@@ -417,14 +434,19 @@ class VEBus:
             self.send_frame('X', data)
             rx = self.receive_frame([b'\x05\xFF\x58', b'\x03\xFF\x58'])  # two different answers are possible
             if rx[3] == 0x87:
-                self.log.info("set_ess_power to {}W done".format(power))
+                self.last_ack_time = time.monotonic()
+                self.ack_count += 1
+                if self.trace.enabled:
+                    self.trace.emit('set_power', power=power)
                 return True
             else:
                 raise Exception("invalid response")
         except IOError:
             self.serial = None
+            self.set_power_errors += 1
             self.log.error("serial port failed")
         except Exception as e:
+            self.set_power_errors += 1
             self.log.error("set_ess_power: power={} error={}".format(power, e))
             return False
 
@@ -486,14 +508,16 @@ class VEBus:
             ok_count=0
             while len(waiting_frames)>0:
                 data = self.receive_mk2_frame()
-                self.log.debug("got frame {}".format(data))
+                if self.trace.enabled:
+                    self.trace.emit('rx_3p', frame=data)
                 if not data or len(data)<4:
                     logging.error(f"set_ess_power_3p: invalid frame {data}")
                     continue
                 if chr(data[2]) in waiting_frames:
                     waiting_frames.remove(chr(data[2]))
                     if data[3] == 0x87:
-                        self.log.debug(f"set_ess_power {data[1]} done")
+                        if self.trace.enabled:
+                            self.trace.emit('set_power_3p', phase=data[2])
                         ok_count+=1
                     else:
                         self.log.error(f"set_ess_power {data[1]} failed. got {chr(data[2])}")
@@ -603,9 +627,53 @@ class VEBus:
     def format_hex(self, data):
         return " ".join(["{:02X}".format(b) for b in data])
 
+    @contextlib.contextmanager
+    def transaction(self, low_priority=False):
+        """
+        Exclusive use of the link for a request / response sequence (e.g. snapshot request, ac info, snapshot read)
+
+        :param low_priority: wait until the link is below its budget first (diagnostic reads)
+        """
+        if low_priority:
+            self.link.wait()
+        with self.bus_lock:
+            yield
+
+    def count_tx(self, frame, command):
+        m = self.metrics
+        m.tx_frames.inc()
+        m.tx_bytes.inc(len(frame))
+        self.tx_command = command
+        self.tx_time = time.perf_counter()
+
+    def count_rx(self, rx, result='ok'):
+        """
+        :param rx: all bytes read for the response
+        :param result: ok, checksum, invalid or timeout
+        """
+        m = self.metrics
+        m.rx_bytes.inc(len(rx))
+        if result == 'ok':
+            m.rx_frames.inc()
+            if self.tx_time is not None:
+                m.rtt.labels(self.tx_command).observe(time.perf_counter() - self.tx_time)
+        elif result == 'checksum':
+            m.checksum_errors.inc()
+        elif result == 'timeout':
+            m.timeouts.labels(self.tx_command).inc()
+        else:
+            m.invalid_frames.inc()
+        self.tx_time = None
+
     def send_frame(self, cmd, data):
         frame = self.build_frame(cmd, data)
-        self.log.debug("TX: cmd={} frame={}".format(cmd, self.format_hex(frame)))
+        if self.trace.enabled:
+            self.trace.emit('tx', cmd=cmd, frame=frame)
+        self.link.count('tx', len(frame))
+        if self.recorder:
+            self.recorder.frame(TX, frame)
+        if self.metrics:
+            self.count_tx(frame, f"{cmd}{data[0]:02X}" if cmd in 'Xx' and len(data) else cmd)
         self.serial.reset_input_buffer()  # test ob es was hilft ?
         self.serial.write(frame)
 
@@ -689,29 +757,37 @@ class VEBus:
                 
                 start_found = True
             elif pos == 0:
-                logging.debug(f"got lenght? {next_byte}")
+                pass  # length of the frame
             else:
-                logging.debug(f"receive_frame_2: invalid byte {next_byte}, skiping, waiting for {frame_prefix}")
+                if self.trace.enabled:
+                    self.trace.emit('rx_skip', sample=True, byte=next_byte, prefix=frame_prefix)
                 start_found = False
 
             last_byte=next_byte
             pos+=1
 
 
+        if rx:
+            self.link.count('rx', len(rx))
+            if self.recorder:
+                self.recorder.frame(RX, rx)
+
         if frame_end and crc_byte!=None:
             crc = 256 - sum(rx[:-1]) & 0xFF
             if crc == crc_byte:
-                logging.debug(f"receive_frame_2: valid frame {data}, length={len(data)}")
-          #      data2=data[1:]
-                logging.debug(f"receive_frame_2: valid frame {rx}, length={len(rx)}")
-                logging.debug(self.format_hex(rx))
+                if self.trace.enabled:
+                    self.trace.emit('rx', frame=rx)
+                if self.metrics:
+                    self.count_rx(rx)
                 return rx
             else:
-                logging.error(f"receive_frame_2: invalid frame {data}, crc={crc:02X}, crc_byte={crc_byte:02X}")
-                data2=data[1:]
-                logging.debug(f"receive_frame_2: invalid frame {rx}, length={len(rx)}")
+                if self.metrics:
+                    self.count_rx(rx, 'checksum')
+                self.log.error(f"receive_frame_2: invalid frame {self.format_hex(rx)}, crc={crc:02X}, crc_byte={crc_byte:02X}")
                 return rx
         else:
+            if self.metrics:
+                self.count_rx(rx, 'invalid' if rx else 'timeout')
             logging.error(f"receive_frame_2: invalid frame, frame_end {frame_end}, crc {crc_byte}, data: {data}, hex: {self.format_hex(rx)}, length={len(data)}")
             return rx
         
@@ -753,7 +829,9 @@ class VEBus:
         rx = bytes()
         tout = time.perf_counter() + timeout
         while time.perf_counter() < tout:
-            rx += self.serial.read(500)
+            chunk = self.serial.read(500)
+            if chunk:
+                rx += chunk
             time.sleep(0.010)
             if isinstance(head, (list, tuple)):
                 for h in head:
@@ -766,9 +844,21 @@ class VEBus:
             if (p >= 0):
                 flen = rx[p] + 2  # expected full package length
                 if (len(rx) - p) >= flen:  # rx matches expected full package length
-                    self.log.debug("RX: frame={}".format(self.format_hex(rx[p:p + flen])))
+                    self.link.count('rx', len(rx))
+                    if self.trace.enabled:
+                        self.trace.emit('rx', frame=rx[p:p + flen])
+                    if self.recorder:
+                        self.recorder.frame(RX, rx[p:p + flen])
+                    if self.metrics:
+                        self.count_rx(rx)
                     return rx[p:p + flen]
 
+        if rx:
+            self.link.count('rx', len(rx))
+        if self.recorder and rx:
+            self.recorder.frame(RX, rx)
+        if self.metrics:
+            self.count_rx(rx, 'invalid' if rx else 'timeout')
         if rx:
             raise Exception("invalid rx frame {}".format(self.format_hex(rx)))
         else:
@@ -776,7 +866,13 @@ class VEBus:
 
     def wakeup(self):
         try:
-            self.serial.write(bytes([0x05, 0x3F, 0x07, 0x00, 0x00, 0x00, 0xC2]))
+            frame = bytes([0x05, 0x3F, 0x07, 0x00, 0x00, 0x00, 0xC2])
+            if self.recorder:
+                self.recorder.frame(TX, frame)
+            if self.metrics:
+                self.count_tx(frame, 'wakeup')
+            self.link.count('tx', len(frame))
+            self.serial.write(frame)
             self.log.info("WAKEUP !!!")
         except IOError:
             self.serial = None
@@ -791,7 +887,13 @@ class VEBus:
         Standby consumption: ~1,3 Watt     DC: 27mA AC: 0.0 Watt
         """
         try:
-            self.serial.write(bytes([0x05, 0x3F, 0x04, 0x00, 0x00, 0x00, 0xC5]))
+            frame = bytes([0x05, 0x3F, 0x04, 0x00, 0x00, 0x00, 0xC5])
+            if self.recorder:
+                self.recorder.frame(TX, frame)
+            if self.metrics:
+                self.count_tx(frame, 'sleep')
+            self.link.count('tx', len(frame))
+            self.serial.write(frame)
             self.log.info("SLEEP !!!")
         except IOError:
             self.serial = None
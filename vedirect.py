@@ -8,15 +8,19 @@
 
 import serial
 import argparse
+import keyword
+import struct
 import time
-#from .vedirect_device_emulator import VEDirectDeviceEmulator
 import sys
 import logging
 log = logging.getLogger(__name__)
 
 
 def int_base_guess(string_val):
-    return int(string_val, 0)
+    # int(s, 0) rejects decimal values with leading zeros
+    if string_val[:2] in ('0x', '0X'):
+        return int(string_val, 16)
+    return int(string_val)
 
 
 class VEDirect:
@@ -248,133 +252,405 @@ class VEDirect:
         'W': ['W', 1, 0]
     }
 
-    def __init__(self, serialport='', timeout=60, emulate=''):
+    def __init__(self, serialport='', timeout=60, emulate='', emulate_rate=1.0, emulate_script=None):
         """ Constructor for a Victron VEDirect serial communication session.
 
         Params:
             serialport (str): The name of the serial port to open
             timeout (float): Read timeout value (seconds)
             emulate (str): One of ['', 'ALL', 'BMV_600', 'BMV_700', 'MPPT', 'PHX_INVERTER']
+            emulate_rate (float): emulated text blocks per second, 0 = as fast as possible
+            emulate_script (dict): value trajectories, see vedirect_device_emulator
         """
         self.emulate = emulate
-        if not emulate:
+        self.parser = VEDirectParser(self.encoding)
+        self.hex = None
+        self.schemas = {}  # tuple of keys -> VEDirectSchema, compiled on the first record of each layout
+        if emulate:
+            from vedirect_device_emulator import VEDirectDeviceEmulator
+            self.emulator = VEDirectDeviceEmulator(emulate, emulate_rate, emulate_script)
+            self.emulate_time = time.monotonic()
+        else:
             self.serialport = serialport
             self.ser = serial.Serial(port=serialport, baudrate=19200, timeout=timeout)
-            self.header1 = b'\r'
-            self.header2 = b'\n'
-            self.hexmarker = b':'
-            self.delimiter = b'\t'
-            self.key = b''
-            self.value = b''
-            self.bytes_sum = 0
-            self.state = self.WAIT_HEADER1
-            self.dict = {}
             self.ser.flushInput()
 
-    (HEX, WAIT_HEADER1, WAIT_HEADER2, IN_KEY, IN_VALUE, IN_CHECKSUM) = range(6)
+    def enable_hex(self, registers, interval=5, callback=None):
+        """ Poll HEX protocol registers in addition to the text stream, see VEDirectHex.
+        The read functions call poll(), so the serial timeout should not be longer than interval.
 
-    def _input(self, byte):
-        """ Accepts a new byte and tries to finish constructing a record.
-        When a record is complete, it will be returned as a dictionary
+        Params:
+            registers (list): names from VEDirectHex.registers
+            interval (float): seconds between two polls, the text blocks pause for a while after each poll
+            callback (function): called with a dictionary of register values after each poll
         """
-        if byte == self.hexmarker and self.state != self.IN_CHECKSUM:
-            self.state = self.HEX
+        self.hex = VEDirectHex(self.ser, registers, interval, callback=callback)
+        self.parser.hex_callback = self.hex.handle_frame
 
-        if self.state == self.WAIT_HEADER1:
-            if byte == self.header1:
-                self.bytes_sum += ord(byte)
-                self.state = self.WAIT_HEADER2
-            return None
-        if self.state == self.WAIT_HEADER2:
-            if byte == self.header2:
-                self.bytes_sum += ord(byte)
-                self.state = self.IN_KEY
-            return None
-        elif self.state == self.IN_KEY:
-            self.bytes_sum += ord(byte)
-            if byte == self.delimiter:
-                if self.key == b'Checksum':
-                    self.state = self.IN_CHECKSUM
-                else:
-                    self.state = self.IN_VALUE
-            else:
-                self.key += byte
-            return None
-        elif self.state == self.IN_VALUE:
-            self.bytes_sum += ord(byte)
-            if byte == self.header1:
-                self.state = self.WAIT_HEADER2
-                try:
-                    self.dict[str(self.key.decode(self.encoding))] = str(
-                        self.value.decode(self.encoding))
-                except UnicodeDecodeError:
-                    log.warning(f"Could not decode key {self.key} and value {self.value}")
-                self.key = b''
-                self.value = b''
-            else:
-                self.value += byte
-            return None
-        elif self.state == self.IN_CHECKSUM:
-            self.bytes_sum += ord(byte)
-            self.key = b''
-            self.value = b''
-            self.state = self.WAIT_HEADER1
-            if self.bytes_sum % 256 == 0:
-                self.bytes_sum = 0
-                dict_copy = self.dict.copy()
-                self.dict = {}  # clear the holder - ready for a new record
-                return dict_copy
-            else:
-                # print('Malformed record')
-                self.bytes_sum = 0
-        elif self.state == self.HEX:
-            self.bytes_sum = 0
-            if byte == self.header2:
-                self.state = self.WAIT_HEADER1
-        else:
-            raise AssertionError()
+    def _read_records(self):
+        """ Read everything in the receive buffer (at least one byte, blocks up to timeout)
+        and return the completed records.
+        """
+        if self.emulate:
+            if self.emulator.rate:
+                self.emulate_time += 1 / self.emulator.rate
+                time.sleep(max(0, self.emulate_time - time.monotonic()))
+            return self.parser.feed(self.emulator.next_bytes())
+
+        data = self.ser.read(self.ser.in_waiting or 1)
+        records = self.parser.feed(data) if data else []
+        if self.hex:
+            self.hex.poll()
+        return records
+
+    def read_records(self):
+        """ Read everything in the receive buffer and return the completed records (VEDirectRecord).
+        With timeout=0 this never blocks, e.g. when the port is driven by a selector.
+        """
+        return [self.decode(record) for record in self._read_records()]
+
+    def decode(self, record):
+        """ Convert (keys, values) from the parser into a VEDirectRecord
+        """
+        keys, values = record
+        schema = self.schemas.get(keys)
+        if schema is None:
+            if len(self.schemas) >= 8:  # firmware change or garbage, start over
+                self.schemas.clear()
+            schema = self.schemas[keys] = VEDirectSchema(keys)
+        return schema.decode(values)
 
     def read_data_single(self, flush=True):
-        """ Wait until we get a single complete record, then return it
+        """ Wait until we get a single complete record, then return it as dictionary
         """
-        if self.emulate:
-            time.sleep(1.0)
-            return self.typecast(VEDirectDeviceEmulator.data[self.emulate])
-        else:
-            if flush:
-                self.ser.flushInput()
-            while True:
-                byte = self.ser.read()
-                if byte:
-                    # got a byte (didn't time out)
-                    record = self._input(byte)
-                    if record is not None:
-                        return self.typecast(record)
+        if flush and not self.emulate:
+            self.ser.flushInput()
+            self.parser.reset()
+        while True:
+            records = self._read_records()
+            if records:
+                return self.decode(records[0]).to_dict()
 
     def read_data_single_callback(self, callbackfunction, **kwargs):
-        """ Continue to wait until we get a single complete record, then call the callback function with the result.
+        """ Continue to wait until we get a single complete record, then call the callback function with the result
+        (dictionary).
         """
         callbackfunction(self.read_data_single(), **kwargs)
 
     def read_data_callback(self, callbackfunction, n=-1, **kwargs):
         """ Non-blocking service to continuously read records, and when one is formed, call the
-        callback function with the record as the first argument.
+        callback function with the record (dictionary) as the first argument.
         """
         while n != 0:
-            if self.emulate:
-                time.sleep(1.0)
-                callbackfunction(self.typecast(VEDirectDeviceEmulator.data[self.emulate]), **kwargs)
+            for record in self._read_records():
+                callbackfunction(self.decode(record).to_dict(), **kwargs)
                 if n > 0:
                     n = n - 1
+                    if n == 0:
+                        break
+
+
+class VEDirectRecord:
+    """ Base class of the record classes built by VEDirectSchema, one slot per field
+    """
+    __slots__ = ()
+    _keys = ()  # field names as sent by the device
+    _attrs = ()  # slot names (valid identifiers)
+    _scales = ()  # (divisor, digits) or None per field, from VEDirect.units / VEDirect.fmt
+    _converters = ()  # per field, str for text fields
+
+    def __init__(self, values):
+        for attr, conv, value in zip(self._attrs, self._converters, values):
+            setattr(self, attr, value if conv is str else conv(value))
+
+    def to_dict(self, scaled=False):
+        """ Field name -> value, scaled=True converts to the units of VEDirect.fmt (mV -> V, mA -> A, ...)
+        """
+        if not scaled:
+            return {k: getattr(self, a) for k, a in zip(self._keys, self._attrs)}
+        r = {}
+        for k, a, scale in zip(self._keys, self._attrs, self._scales):
+            v = getattr(self, a)
+            if scale and isinstance(v, int):
+                v = round(v / scale[0], scale[1])
+            r[k] = v
+        return r
+
+    def get(self, key, default=None):
+        try:
+            return getattr(self, self._attrs[self._keys.index(key)])
+        except ValueError:
+            return default
+
+    def __getitem__(self, key):
+        return getattr(self, self._attrs[self._keys.index(key)])
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class VEDirectSchema:
+    """ Field list of one record layout with converters and unit scales, compiled once
+    """
+    def __init__(self, keys):
+        self.keys = keys
+        attrs = []
+        for i, k in enumerate(keys):  # record.PPV, record.SER_ ...
+            attr = ''.join(c if c.isalnum() else '_' for c in k)
+            if not attr.isidentifier() or keyword.iskeyword(attr) or attr in attrs:
+                attr = f'f{i}_{attr}'
+            attrs.append(attr)
+        attrs = tuple(attrs)
+        unknown = [k for k in keys if k not in VEDirect.types]
+        if unknown:
+            log.warning(f"unknown fields {unknown}, kept as text")
+        self.converters = tuple(VEDirect.types.get(k, str) for k in keys)
+        scales = []
+        for k in keys:
+            fmt = VEDirect.fmt.get(VEDirect.units.get(k))
+            scales.append((fmt[1], fmt[2]) if fmt else None)
+
+        self.record_class = type('VEDirectRecord', (VEDirectRecord,),
+                                 {'__slots__': attrs, '_keys': keys, '_attrs': attrs, '_scales': tuple(scales),
+                                  '_converters': self.converters})
+        self.fields = tuple(zip(attrs, self.converters))
+        self.errors = 0
+
+    def decode(self, values):
+        try:
+            return self.record_class(values)
+        except ValueError:  # invalid value, convert field by field
+            pass
+        record = self.record_class.__new__(self.record_class)
+        for (attr, conv), value in zip(self.fields, values):
+            try:
+                value = conv(value)
+            except ValueError:
+                self.errors += 1
+                value = None
+            setattr(record, attr, value)
+        return record
+
+
+class VEDirectParser:
+    """ Chunked parser for the VE.Direct text protocol
+
+    A text block is a sequence of fields '\\r\\n<key>\\t<value>', the last field is 'Checksum' with a single byte
+    value that makes the sum of all bytes of the block 0 (modulo 256). HEX protocol frames ':<hex>\\n' may be
+    interleaved, also in the middle of a block. They are cut out of the stream and handed to hex_callback,
+    the remaining block is validated as usual.
+
+    feed() takes any chunk of bytes and returns the completed records as (tuple of keys, list of values),
+    a partial block stays in the buffer.
+    """
+    checksum_marker = b'\r\nChecksum\t'
+    max_block = 1024  # a text block is at most a few hundred bytes
+
+    def __init__(self, encoding='utf-8', hex_callback=None):
+        self.encoding = encoding
+        self.hex_callback = hex_callback  # called with each HEX frame (bytes, without ':' and newline)
+        self.buf = bytearray()
+        self.records = 0
+        self.checksum_errors = 0
+        self.decode_errors = 0
+        self.hex_frames = 0
+
+    def reset(self):
+        self.buf.clear()
+
+    def feed(self, data):
+        buf = self.buf
+        buf += data
+        records = []
+        pos = 0
+        while True:
+            block_start = buf.find(b'\r\n', pos)
+            hex_start = buf.find(b':', pos, block_start if block_start >= 0 else len(buf))
+            if hex_start >= 0:  # hex frame between blocks
+                hex_end = buf.find(b'\n', hex_start)
+                if hex_end < 0:
+                    pos = hex_start
+                    break
+                self._hex(buf[hex_start + 1:hex_end].rstrip(b'\r'))
+                pos = hex_end + 1
+                continue
+            if block_start < 0:
+                pos = len(buf) - 1 if buf.endswith(b'\r') else len(buf)
+                break
+
+            marker = buf.find(self.checksum_marker, block_start)
+            if marker < 0 or marker + len(self.checksum_marker) >= len(buf):
+                if len(buf) - block_start > self.max_block:  # no checksum field, garbage
+                    self.checksum_errors += 1
+                    pos = block_start + 2
+                    continue
+                pos = block_start  # block not complete yet
+                break
+            block_end = marker + len(self.checksum_marker) + 1  # including checksum byte
+            pos = block_end
+
+            if buf.find(b':', block_start, marker) >= 0:
+                block = self._cut_hex(buf[block_start:block_end], marker - block_start)
+                checksum = sum(block)
+                fields = bytes(block[2:len(block) - len(self.checksum_marker) - 1])
             else:
-                byte = self.ser.read()
-                if byte:
-                    # got a byte (didn't time out)
-                    record = self._input(byte)
-                    if record is not None:
-                        callbackfunction(self.typecast(record), **kwargs)
-                        if n > 0:
-                            n = n - 1
+                with memoryview(buf) as mv:
+                    checksum = sum(mv[block_start:block_end])
+                fields = bytes(buf[block_start + 2:marker])
+
+            if checksum & 0xFF:
+                self.checksum_errors += 1
+                continue
+            record = self._split(fields)
+            if record is not None:
+                self.records += 1
+                records.append(record)
+
+        if pos:
+            del buf[:pos]
+        return records
+
+    def _cut_hex(self, block, marker):
+        """ Remove hex frames from a block (everything before the checksum marker), return the rest
+        """
+        head = bytes(block[:marker])
+        out = bytearray()
+        start = 0
+        while True:
+            hex_start = head.find(b':', start)
+            if hex_start < 0:
+                break
+            hex_end = head.find(b'\n', hex_start)
+            if hex_end < 0:
+                hex_end = len(head) - 1
+            out += head[start:hex_start]
+            self._hex(head[hex_start + 1:hex_end].rstrip(b'\r'))
+            start = hex_end + 1
+        out += head[start:]
+        out += block[marker:]
+        return out
+
+    def _hex(self, frame):
+        self.hex_frames += 1
+        if self.hex_callback:
+            self.hex_callback(bytes(frame))
+
+    def _split(self, fields):
+        try:
+            text = fields.decode(self.encoding)
+        except UnicodeDecodeError:
+            log.warning(f"Could not decode record {fields}")
+            self.decode_errors += 1
+            return None
+        keys = []
+        values = []
+        for field in text.split('\r\n'):
+            key, sep, value = field.partition('\t')
+            if sep:
+                keys.append(key)
+                values.append(value)
+        return tuple(keys), values
+
+
+class VEDirectHex:
+    """ VE.Direct HEX protocol register access, sharing the port with the text protocol
+
+    Frame: ':' <command nibble> <data bytes as hex> <checksum byte as hex> '\\n'
+    command + all data bytes + checksum = 0x55 (modulo 256)
+
+    GET     :7 <id lo> <id hi> <flags>
+    answer  :7 <id lo> <id hi> <flags> <value little endian>
+    async   :A <id lo> <id hi> <flags> <value little endian>     (sent by the device on changes)
+
+    All registers of a poll are requested at once, answers are matched by the register id in the response.
+    Values are scaled to the units of the text protocol (W, mV, mA), so records of both protocols are
+    interchangeable. While HEX requests are coming in the device pauses its text blocks, a poll every few
+    seconds (default 5) leaves the text blocks flowing in between, short intervals suppress them.
+    """
+    GET = 0x7
+    ASYNC = 0xA
+
+    # name: (register id, struct format, scale to text protocol units)
+    registers = {
+        'PPV': (0xEDBC, '<I', 0.01),  # panel power 0.01 W -> W
+        'VPV': (0xEDBB, '<H', 10),  # panel voltage 0.01 V -> mV
+        'IPV': (0xEDBD, '<H', 100),  # panel current 0.1 A -> mA
+        'V': (0xEDD5, '<H', 10),  # charger voltage 0.01 V -> mV
+        'I': (0xEDD7, '<H', 100),  # charger current 0.1 A -> mA
+        'CS': (0x0201, '<B', 1),  # device state
+        'ERR': (0xEDDA, '<B', 1),  # charger error code
+    }
+
+    def __init__(self, ser, registers, interval=5, timeout=0.5, callback=None):
+        self.ser = ser
+        self.interval = interval
+        self.timeout = timeout
+        self.callback = callback
+        self.by_id = {}
+        for name in registers:
+            reg_id, fmt, scale = self.registers[name]
+            self.by_id[reg_id] = (name, struct.Struct(fmt), scale)
+        self.requests = {reg_id: self.build_frame(self.GET, struct.pack('<HB', reg_id, 0)) for reg_id in self.by_id}
+        self.pending = {}  # register id -> time.monotonic() of the request
+        self.values = {}
+        self.poll_time = 0
+        self.timeouts = 0
+        self.errors = 0  # checksum errors, flags set
+
+    @staticmethod
+    def build_frame(command, data):
+        checksum = (0x55 - command - sum(data)) & 0xFF
+        return b':' + b'%X' % command + data.hex().upper().encode() + b'%02X\n' % checksum
+
+    def poll(self):
+        """ Send the next GET requests if the interval is over and expire unanswered ones
+        """
+        t = time.monotonic()
+        if self.pending:
+            if t - min(self.pending.values()) < self.timeout:
+                return
+            self.timeouts += len(self.pending)
+            log.debug(f"hex timeout {[hex(r) for r in self.pending]}")
+            self._complete()
+        if t >= self.poll_time:
+            self.poll_time = t + self.interval
+            self.ser.write(b''.join(self.requests.values()))
+            self.pending = dict.fromkeys(self.requests, t)
+
+    def handle_frame(self, frame):
+        """ Handle one frame from VEDirectParser (without ':' and newline)
+        """
+        try:
+            command = int(frame[:1], 16)
+            data = bytes.fromhex(frame[1:].decode())
+        except ValueError:
+            self.errors += 1
+            return
+        if (command + sum(data)) & 0xFF != 0x55:
+            self.errors += 1
+            return
+        if command not in (self.GET, self.ASYNC) or len(data) < 4:
+            return
+        reg_id, flags = struct.unpack_from('<HB', data)
+        entry = self.by_id.get(reg_id)
+        if entry is None:
+            return
+        self.pending.pop(reg_id, None)
+        name, fmt, scale = entry
+        if flags or len(data) - 4 < fmt.size:
+            self.errors += 1
+        else:
+            self.values[name] = fmt.unpack_from(data, 3)[0] * scale
+        if command == self.GET and not self.pending:
+            self._complete()
+
+    def _complete(self):
+        self.pending = {}
+        if self.callback and self.values:
+            self.callback(dict(self.values))
 
 
 def print_data_callback(data):
@@ -389,6 +665,7 @@ def main():
     parser.add_argument('--timeout', help='Serial port read timeout, seconds', type=int, default='60')
     parser.add_argument('--emulate', help='emulate one of [ALL, BMV_600, BMV_700, MPPT, PHX_INVERTER]',
                         default='', type=str)
+    parser.add_argument('--rate', help='emulated records per second (0 = no pacing)', default=1.0, type=float)
     parser.add_argument('--loglevel', help='logging level - one of [DEBUG, INFO, WARNING, ERROR, CRITICAL]',
                         default='ERROR')
     args = parser.parse_args()
@@ -396,7 +673,7 @@ def main():
     if not args.port and not args.emulate:
         print("Must specify a port to listen.")
         sys.exit(1)
-    ve = VEDirect(args.port, args.timeout, args.emulate.upper())
+    ve = VEDirect(args.port, args.timeout, args.emulate.upper(), args.rate)
     ve.read_data_callback(print_data_callback, args.n)
 
 
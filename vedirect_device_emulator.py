@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import select
+import struct
+import sys
+import time
+import tty
+
+from vedirect import VEDirectHex, VEDirectParser
+
+"""
+Deterministic VE.Direct device emulator
+
+Generates valid, checksummed text blocks (and optionally HEX async frames / answers to HEX GET requests)
+for MPPT, BMV and Phoenix inverter profiles. Values follow scripted trajectories, noise is seeded, so
+two runs with the same arguments produce the same byte stream.
+
+Used by VEDirect(emulate=...) and standalone on a pty:
+
+  python vedirect_device_emulator.py --profile MPPT --rate 5 --link /tmp/vedirect_mppt
+  python mppt_to_mqtt.py ...   (serial_port=/tmp/vedirect_mppt)
+
+  python vedirect_device_emulator.py --profile MPPT --bench 10000     parser throughput without hardware
+
+Script file (json), per field one trajectory, time in seconds since start (loops after the last point):
+  {"PPV": {"sine": [0, 400, 60]},                  min, max, period
+   "V": {"points": [[0, 26000], [30, 28000]]},     linear interpolation
+   "I": {"noise": [2000, 150]}}                    mean, standard deviation
+"""
+
+log = logging.getLogger(__name__)
+
+BAUDRATE = 19200
+BYTES_PER_SECOND = BAUDRATE / 10  # 8N1
+
+
+class VEDirectDeviceEmulator:
+    data = {
+        'MPPT': {'PID': '0xA053', 'FW': '159', 'SER#': 'HQ1828EMUL1', 'V': '26201', 'I': '2000',
+                 'VPV': '36880', 'PPV': '55', 'CS': '3', 'MPPT': '2', 'OR': '0x00000000', 'ERR': '0',
+                 'LOAD': 'ON', 'IL': '0', 'H19': '10483', 'H20': '5', 'H21': '54', 'H22': '10', 'H23': '72',
+                 'HSDS': '120'},
+        'BMV_600': {'V': '26201', 'VS': '13201', 'I': '-1500', 'CE': '-12000', 'SOC': '876', 'TTG': '240',
+                    'Alarm': 'OFF', 'Relay': 'OFF', 'AR': '0', 'BMV': '600S', 'FW': '212',
+                    'H1': '-55000', 'H2': '-12000', 'H3': '-40000', 'H4': '45', 'H5': '2', 'H6': '-3500000',
+                    'H7': '11000', 'H8': '14500', 'H9': '86400', 'H10': '5', 'H11': '0', 'H12': '0'},
+        'BMV_700': {'PID': '0x203', 'V': '26201', 'VS': '13201', 'I': '-1500', 'P': '-39', 'CE': '-12000',
+                    'SOC': '876', 'TTG': '240', 'Alarm': 'OFF', 'Relay': 'OFF', 'AR': '0', 'BMV': '700',
+                    'FW': '0308', 'H1': '-55000', 'H2': '-12000', 'H3': '-40000', 'H4': '45', 'H5': '2',
+                    'H6': '-3500000', 'H7': '11000', 'H8': '14500', 'H9': '86400', 'H10': '5', 'H11': '0',
+                    'H12': '0', 'H15': '0', 'H16': '0', 'H17': '1500', 'H18': '1800'},
+        'PHX_INVERTER': {'PID': '0xA231', 'FW': '0129', 'SER#': 'HQ1745EMUL1', 'MODE': '2', 'CS': '9',
+                         'AR': '0', 'WARN': '0', 'AC_OUT_V': '23000', 'AC_OUT_I': '13', 'AC_OUT_S': '300',
+                         'V': '12800', 'OR': '0x00000000'},
+    }
+    data['ALL'] = {**data['BMV_700'], **data['MPPT'], **data['PHX_INVERTER']}
+
+    def __init__(self, profile='MPPT', rate=1.0, script=None, seed=0, hex_async=False):
+        """
+        :param profile: key of data
+        :param rate: text blocks per second, 0 = as fast as possible (no pacing)
+        :param script: dictionary field -> trajectory, see module doc
+        :param seed: seed for noise trajectories
+        :param hex_async: append a HEX async frame (:A) for PPV after each block
+        """
+        self.profile = profile
+        self.values = dict(self.data[profile])
+        self.script = script or {}
+        self.random = random.Random(seed)
+        self.hex_async = hex_async
+        self.t = 0.0  # emulated time since start
+        self.blocks = 0
+
+        block_size = len(self.block())
+        self.max_rate = BYTES_PER_SECOND / block_size
+        if rate > self.max_rate:
+            log.warning(f"rate {rate} above line limit, use {self.max_rate:.1f} blocks/s")
+            rate = self.max_rate
+        self.rate = rate
+
+    def value_at(self, trajectory, t):
+        if 'sine' in trajectory:
+            lo, hi, period = trajectory['sine']
+            return lo + (hi - lo) * (0.5 + 0.5 * math.sin(2 * math.pi * t / period))
+        if 'points' in trajectory:
+            points = trajectory['points']
+            t = t % points[-1][0] if points[-1][0] else 0
+            for (t0, v0), (t1, v1) in zip(points, points[1:]):
+                if t0 <= t <= t1:
+                    return v0 + (v1 - v0) * (t - t0) / (t1 - t0) if t1 > t0 else v1
+            return points[-1][1]
+        if 'noise' in trajectory:
+            mean, sigma = trajectory['noise']
+            return self.random.gauss(mean, sigma)
+        raise ValueError(f"unknown trajectory {trajectory}")
+
+    def step(self, dt):
+        """ Advance emulated time and update scripted values
+        """
+        self.t += dt
+        for key, trajectory in self.script.items():
+            self.values[key] = str(int(round(self.value_at(trajectory, self.t))))
+
+    @staticmethod
+    def make_block(values):
+        block = b''.join(b'\r\n%s\t%s' % (k.encode(), v.encode()) for k, v in values.items()) + b'\r\nChecksum\t'
+        return block + bytes(((256 - sum(block)) & 0xFF,))
+
+    def block(self):
+        return self.make_block(self.values)
+
+    def next_bytes(self):
+        """ Next text block (plus optional HEX frame) after advancing one block period
+        """
+        self.step(1 / self.rate if self.rate else 1.0)
+        self.blocks += 1
+        data = self.block()
+        if self.hex_async and 'PPV' in self.values:
+            data += self.hex_answer(VEDirectHex.ASYNC, VEDirectHex.registers['PPV'][0])
+        return data
+
+    def hex_answer(self, command, reg_id):
+        """ HEX frame with the current value of a register, flags=0x01 (unknown id) if not emulated
+        """
+        for name, (rid, fmt, scale) in VEDirectHex.registers.items():
+            if rid == reg_id and name in self.values:
+                try:
+                    value = int(self.values[name], 0) if name in ('CS', 'ERR') else float(self.values[name])
+                except ValueError:
+                    break
+                raw = int(round(value / scale)) & ((1 << (8 * struct.calcsize(fmt))) - 1)
+                return VEDirectHex.build_frame(command, struct.pack('<HB', reg_id, 0) + struct.pack(fmt, raw))
+        return VEDirectHex.build_frame(command, struct.pack('<HB', reg_id, 0x01))
+
+    def handle_request(self, frame):
+        """ Answer a HEX frame received from the host (without ':' and newline), GET only
+        """
+        try:
+            command = int(frame[:1], 16)
+            data = bytes.fromhex(frame[1:].decode())
+        except ValueError:
+            return b''
+        if command != VEDirectHex.GET or len(data) < 3 or (command + sum(data)) & 0xFF != 0x55:
+            return b''
+        return self.hex_answer(VEDirectHex.GET, struct.unpack_from('<H', data)[0])
+
+    def serve(self, fd, duration=None):
+        """ Write blocks to fd (pty master) at the configured rate and answer HEX GET requests
+        """
+        start = time.monotonic()
+        next_time = start
+        rx = bytearray()
+        while duration is None or time.monotonic() - start < duration:
+            timeout = max(0, next_time - time.monotonic())
+            readable, _, _ = select.select([fd], [], [], timeout)
+            if readable:
+                try:
+                    rx += os.read(fd, 256)
+                except OSError:  # no reader on the slave side yet
+                    time.sleep(0.1)
+                while b'\n' in rx:
+                    line, _, rest = bytes(rx).partition(b'\n')
+                    rx = bytearray(rest)
+                    if line.startswith(b':'):
+                        answer = self.handle_request(line[1:].rstrip(b'\r'))
+                        if answer:
+                            os.write(fd, answer)
+            if time.monotonic() >= next_time:
+                os.write(fd, self.next_bytes())
+                next_time += 1 / self.rate if self.rate else 0
+
+
+def bench(emulator, n):
+    """ Parser throughput over n emulated blocks, fed in chunks like a serial read
+    """
+    stream = b''.join(emulator.next_bytes() for i in range(n))
+    parser = VEDirectParser()
+    t = time.perf_counter()
+    records = 0
+    for i in range(0, len(stream), 64):
+        records += len(parser.feed(stream[i:i + 64]))
+    dt = time.perf_counter() - t
+    print(f"{records} records, {len(stream)} bytes in {dt:.3f}s: {records / dt:.0f} records/s, "
+          f"{dt / records * 1e6:.1f} us/record, checksum errors {parser.checksum_errors}, "
+          f"line limit {emulator.max_rate:.1f} records/s per port")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulate a VE.Direct device on a pty')
+    parser.add_argument('--profile', help='one of ' + ', '.join(VEDirectDeviceEmulator.data), default='MPPT')
+    parser.add_argument('--rate', help='text blocks per second (0 = line limit)', type=float, default=1.0)
+    parser.add_argument('--script', help='json file with value trajectories', default=None)
+    parser.add_argument('--seed', help='random seed for noise', type=int, default=0)
+    parser.add_argument('--hex-async', help='send HEX async PPV frames', action='store_true')
+    parser.add_argument('--link', help='create a symlink to the pty slave', default=None)
+    parser.add_argument('--duration', help='stop after seconds', type=float, default=None)
+    parser.add_argument('--bench', help='benchmark the parser with n blocks and exit', type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    script = None
+    if args.script:
+        with open(args.script) as f:
+            script = json.load(f)
+
+    emulator = VEDirectDeviceEmulator(args.profile.upper(), args.rate or 1e9, script, args.seed, args.hex_async)
+
+    if args.bench:
+        bench(emulator, args.bench)
+        return
+
+    master, slave = os.openpty()
+    tty.setraw(master)
+    name = os.ttyname(slave)
+    if args.link:
+        if os.path.islink(args.link):
+            os.unlink(args.link)
+        os.symlink(name, args.link)
+        name = args.link
+    print(f"emulating {args.profile} at {emulator.rate:.1f} blocks/s on {name}")
+    sys.stdout.flush()
+    try:
+        emulator.serve(master, args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.link and os.path.islink(args.link):
+            os.unlink(args.link)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+import functools
+import logging
+import selectors
+import time
+
+from vedirect import VEDirect
+
+"""
+Serve several VE.Direct ports (MPPT, BMV, ...) from one process
+
+All ports are non-blocking and registered in one selector, each device has its own parser (independent
+resync), topic and statistics. A failing port is closed and reopened with backoff, the others keep running.
+Devices with hex_registers are additionally polled via the HEX protocol (VEDirectHex).
+"""
+
+log = logging.getLogger(__name__)
+
+
+class VEDirectDevice:
+    def __init__(self, name, serialport, topic, hex_registers=None, hex_interval=5, hex_topic=None):
+        self.name = name
+        self.serialport = serialport
+        self.topic = topic
+        self.hex_registers = hex_registers
+        self.hex_interval = hex_interval
+        self.hex_topic = hex_topic
+        self.ve = None
+        self.records = 0
+        self.read_errors = 0
+        self.reopen_time = 0  # time.monotonic() for the next open attempt
+        self.backoff = 1
+        self.stats_time = time.monotonic()
+        self.stats_records = 0
+
+    def open(self):
+        self.ve = VEDirect(self.serialport, timeout=0)
+        self.backoff = 1
+        log.info(f"{self.name}: opened {self.serialport}")
+
+    def close(self, error=None):
+        if error:
+            self.read_errors += 1
+            log.error(f"{self.name}: {error}, reopen in {self.backoff}s")
+        if self.ve:
+            try:
+                self.ve.ser.close()
+            except Exception:
+                pass
+        self.ve = None
+        self.reopen_time = time.monotonic() + self.backoff
+        self.backoff = min(self.backoff * 2, 60)
+
+    def stats(self):
+        """
+        :return: statistics since the last call
+        """
+        t = time.monotonic()
+        parser = self.ve.parser if self.ve else None
+        r = {'device': self.name,
+             'online': self.ve is not None,
+             'records': self.records,
+             'rate': round((self.records - self.stats_records) / (t - self.stats_time), 2),
+             'checksum_errors': parser.checksum_errors if parser else None,
+             'decode_errors': parser.decode_errors if parser else None,
+             'read_errors': self.read_errors}
+        if self.ve and self.ve.hex:
+            r['hex_timeouts'] = self.ve.hex.timeouts
+            r['hex_errors'] = self.ve.hex.errors
+        self.stats_time = t
+        self.stats_records = self.records
+        return r
+
+
+class VEDirectMux:
+    def __init__(self, publish, stats_interval=60):
+        """
+        :param publish: function(device, record) called for every valid record
+        :param stats_interval: seconds between statistics, see on_stats
+        """
+        self.publish = publish
+        self.publish_hex = None  # function(device, values) for HEX register polls
+        self.stats_interval = stats_interval
+        self.on_stats = None  # optional function(device, stats)
+        self.selector = selectors.DefaultSelector()
+        self.devices = []
+
+    def add(self, name, serialport, topic, **kwargs):
+        device = VEDirectDevice(name, serialport, topic, **kwargs)
+        self.devices.append(device)
+        return device
+
+    def _open(self, device):
+        try:
+            device.open()
+            if device.hex_registers:
+                device.ve.enable_hex(device.hex_registers, device.hex_interval,
+                                     callback=functools.partial(self._publish_hex, device))
+            self.selector.register(device.ve.ser.fileno(), selectors.EVENT_READ, device)
+        except Exception as e:
+            device.close(e)
+
+    def _close(self, device, error):
+        if device.ve:
+            try:
+                self.selector.unregister(device.ve.ser.fileno())
+            except (KeyError, ValueError):
+                pass
+        device.close(error)
+
+    def _publish_hex(self, device, values):
+        if self.publish_hex:
+            try:
+                self.publish_hex(device, values)
+            except Exception as e:
+                log.error(f"{device.name}: publish hex failed {e}", exc_info=True)
+
+    def run(self):
+        stats_time = time.monotonic() + self.stats_interval
+        select_timeout = min([1] + [d.hex_interval for d in self.devices if d.hex_registers])
+        while True:
+            t = time.monotonic()
+            for device in self.devices:
+                if device.ve is None and t >= device.reopen_time:
+                    self._open(device)
+
+            if self.selector.get_map():
+                events = self.selector.select(timeout=select_timeout)
+            else:  # all ports down
+                time.sleep(1)
+                events = []
+
+            for key, mask in events:
+                device = key.data
+                try:
+                    records = device.ve.read_records()
+                except Exception as e:
+                    self._close(device, e)
+                    continue
+                for record in records:
+                    device.records += 1
+                    try:
+                        self.publish(device, record)
+                    except Exception as e:
+                        log.error(f"{device.name}: publish failed {e}", exc_info=True)
+
+            for device in self.devices:
+                if device.ve and device.ve.hex:
+                    try:
+                        device.ve.hex.poll()
+                    except Exception as e:
+                        self._close(device, e)
+
+            if time.monotonic() > stats_time:
+                stats_time = time.monotonic() + self.stats_interval
+                for device in self.devices:
+                    stats = device.stats()
+                    log.info(stats)
+                    if self.on_stats:
+                        self.on_stats(device, stats)